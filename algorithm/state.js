@@ -21,24 +21,41 @@ THE SOFTWARE.
 */
 
 /**
- * @class Stores state vectors.
+ * @class Stores state vectors. A vector keeps the users it has a component
+ * for in ascending order, along with their components, so comparing vectors
+ * walks both lists side by side without parsing or allocating, and neither
+ * the size of a vector nor iterating over it depend on users it does not
+ * refer to. Components that are 0 are left out. The string form of a vector
+ * is computed once.
  * @param [value] Pre-initialize the vector with existing values. This can be
  * a Vector object, a generic Object with numeric properties, or a string of
  * the form "1:2;3:4;5:6".
  */
 function Vector(value) {
-	if(typeof(value) == "object")
+	// The users in ascending order, and the component of each. Copies of a
+	// vector share its list of users until a user is added or removed.
+	this.ids = [];
+	this.components = [];
+	this.string = null;
+	
+	if(value instanceof Vector)
 	{
+		this.ids = value.ids;
+		this.components = value.components.slice(0);
+		this.string = value.string;
+	} else if(typeof(value) == "object") {
 		for(var user in value) {
 			if(user.match(Vector.user_regex) && value[user] > 0)
-				this[user] = value[user];
+				this.set(parseInt(user), value[user]);
 		}
+		this.ids = Vector.share(this.ids);
 	} else if (typeof(value) == "string") {
 		var match = Vector.timestring_regex.exec(value);
 		while (match != null) {
-			this[match[1]] = parseInt(match[2]);
+			this.set(parseInt(match[1]), parseInt(match[2]));
 			match = Vector.timestring_regex.exec(value);
 		}
+		this.ids = Vector.share(this.ids);
 	}
 }
 
@@ -49,7 +66,63 @@ Vector.user_regex = /\d+/;
  *  @static */
 Vector.timestring_regex = /(\d+):(\d+)/g;
 
-/** Helper function to easily iterate over all users in this vector.
+/** Lists of users shared by the vectors with the same users, so that
+ *  comparing them goes component by component. They only save work, so they
+ *  are dropped once there are sharedLimit of them, and users coming and
+ *  going do not pile up.
+ *  @static */
+Vector.shared = {};
+/** @static */
+Vector.sharedCount = 0;
+/** @static */
+Vector.sharedLimit = 1000;
+
+/** Returns the shared list of users equal to the given one.
+ *  @param {Array} ids
+ *  @static
+ *  @ignore
+ *  @type Array
+ */
+Vector.share = function(ids) {
+	var key = ids.join(",");
+	var shared = Vector.shared[key];
+	if(shared == undefined) {
+		if(Vector.sharedCount >= Vector.sharedLimit) {
+			Vector.shared = {};
+			Vector.sharedCount = 0;
+		}
+		
+		shared = ids;
+		Vector.shared[key] = shared;
+		Vector.sharedCount++;
+	}
+	
+	return shared;
+};
+
+/** Returns the position of the given user in this vector's list of users, or
+ *  the position it would be inserted at if it has no component.
+ *  @param {Number} user
+ *  @ignore
+ *  @type Number
+ */
+Vector.prototype.find = function(user) {
+	var ids = this.ids;
+	var low = 0;
+	var high = ids.length;
+	while(low < high) {
+		var middle = (low + high) >> 1;
+		if(ids[middle] < user)
+			low = middle + 1;
+		else
+			high = middle;
+	}
+	
+	return low;
+};
+
+/** Helper function to easily iterate over all users in this vector, in
+ *  ascending order. Components that are 0 are left out.
  *  @param {function} callback Callback function which is called with the user
  *  and the value of each component. If this callback function returns false,
  *  iteration is stopped at that point and false is returned.
@@ -58,20 +131,30 @@ Vector.timestring_regex = /(\d+):(\d+)/g;
  *  False otherwise.
  */
 Vector.prototype.eachUser = function(callback) {
-	for(var user in this) {
-		if(user.match(Vector.user_regex)) {
-			if(callback(parseInt(user), this[user]) == false)
-				return false;
-		}
+	var ids = this.ids;
+	var components = this.components;
+	for(var index = 0; index < ids.length; index++) {
+		if(callback(ids[index], components[index]) == false)
+			return false;
 	}
 	
 	return true;
 };
 
+/** Returns the users in this vector in ascending order.
+ *  @type Array
+ */
+Vector.prototype.users = function() {
+	return this.ids.slice(0);
+};
+
 /** Returns this vector as a string of the form "1:2;3:4;5:6"
  *  @type String
  */
 Vector.prototype.toString = function() {
+	if(this.string != null)
+		return this.string;
+	
 	var components = new Array();
 	
 	this.eachUser(function(u, v) {
@@ -81,22 +164,58 @@ Vector.prototype.toString = function() {
 	
 	components.sort();
 	
-	return components.join(";");
+	this.string = components.join(";");
+	return this.string;
 };
 
 Vector.prototype.toHTML = Vector.prototype.toString;
 
+/** Returns a new vector combining the components of two vectors, by walking
+ *  their lists of users side by side.
+ *  @param {Vector} v1
+ *  @param {Vector} v2
+ *  @param {function} combine Called with the components of a user in both
+ *  vectors, either of which may be 0; returns the user's new component.
+ *  @static
+ *  @ignore
+ *  @type Vector
+ */
+Vector.combine = function(v1, v2, combine) {
+	var result = new Vector();
+	var i = 0;
+	var j = 0;
+	while(i < v1.ids.length || j < v2.ids.length) {
+		var user;
+		var a = 0;
+		var b = 0;
+		if(j == v2.ids.length || (i < v1.ids.length && v1.ids[i] < v2.ids[j])) {
+			user = v1.ids[i];
+			a = v1.components[i++];
+		} else if(i == v1.ids.length || v2.ids[j] < v1.ids[i]) {
+			user = v2.ids[j];
+			b = v2.components[j++];
+		} else {
+			user = v1.ids[i];
+			a = v1.components[i++];
+			b = v2.components[j++];
+		}
+		
+		var value = combine(a, b);
+		if(value != 0) {
+			result.ids.push(user);
+			result.components.push(value);
+		}
+	}
+	
+	result.ids = Vector.share(result.ids);
+	return result;
+};
+
 /** Returns the sum of two vectors.
  *  @param {Vector} other
  */ 
 Vector.prototype.add = function(other) {
-	var result = new Vector(this);
-	
-	other.eachUser(function(u, v) {
-		result[u] = result.get(u) + v;
-	});
-	
-	return result;
+	return Vector.combine(this, other, function(a, b) { return a + b; });
 };
 
 /** Returns a copy of this vector. */
@@ -108,12 +227,37 @@ Vector.prototype.copy = function() {
  *  @param {Number} user Index of the component to be returned
  */
 Vector.prototype.get = function(user) {
-	if(this[user] != undefined)
-		return this[user];
+	var index = this.find(user);
+	if(this.ids[index] == user)
+		return this.components[index];
 	else
 		return 0;
 };
 
+/** Sets a specific component of this vector. Vectors are shared by requests,
+ *  so only vectors that have just been created should be changed.
+ *  @param {Number} user Index of the component to be set
+ *  @param {Number} value
+ */
+Vector.prototype.set = function(user, value) {
+	var index = this.find(user);
+	if(this.ids[index] == user) {
+		if(value != 0) {
+			this.components[index] = value;
+		} else {
+			this.ids = this.ids.slice(0);
+			this.ids.splice(index, 1);
+			this.components.splice(index, 1);
+		}
+	} else if(value != 0) {
+		this.ids = this.ids.slice(0);
+		this.ids.splice(index, 0, user);
+		this.components.splice(index, 0, value);
+	}
+	
+	this.string = null;
+};
+
 /** Calculates whether this vector is smaller than or equal to another vector.
  *  This means that all components of this vector are less than or equal to
  *  their corresponding components in the other vector.
@@ -121,9 +265,36 @@ Vector.prototype.get = function(user) {
  *  @type Boolean
  */
 Vector.prototype.causallyBefore = function(other) {
-	return this.eachUser(function(u, v) {
-		return v <= other.get(u);
-	});
+	var ids = this.ids;
+	var components = this.components;
+	if(ids === other.ids) {
+		for(var index = 0; index < ids.length; index++) {
+			if(components[index] > other.components[index])
+				return false;
+		}
+		
+		return true;
+	}
+	
+	// Components are never 0, so each user of this vector has to be in the
+	// other one.
+	var otherIds = other.ids;
+	var otherComponents = other.components;
+	if(ids.length > otherIds.length)
+		return false;
+	
+	var j = 0;
+	for(var i = 0; i < ids.length; i++) {
+		var user = ids[i];
+		while(j < otherIds.length && otherIds[j] < user)
+			j++;
+		
+		if(j == otherIds.length || otherIds[j] != user ||
+			components[i] > otherComponents[j])
+			return false;
+	}
+	
+	return true;
 };
 
 /** Determines whether this vector is equal to another vector. This is true if
@@ -133,16 +304,18 @@ Vector.prototype.causallyBefore = function(other) {
  *  @type Boolean
  */
 Vector.prototype.equals = function(other) {
-	var eq1 = this.eachUser(function(u, v) {
-		return other.get(u) == v;
-	});
+	if(this.ids.length != other.ids.length)
+		return false;
 	
-	var self = this;
-	var eq2 = other.eachUser(function(u, v) {
-		return self.get(u) == v;
-	});
+	var sameUsers = this.ids === other.ids;
+	for(var index = 0; index < this.ids.length; index++) {
+		if(!sameUsers && this.ids[index] != other.ids[index])
+			return false;
+		if(this.components[index] != other.components[index])
+			return false;
+	}
 	
-	return eq1 && eq2;
+	return true;
 };
 
 /** Returns a new vector with a specific component increased by a given
@@ -157,7 +330,9 @@ Vector.prototype.incr = function(user, by) {
 	if(by == undefined)
 		by = 1;
 	
-	result[user] = result.get(user) + by;
+	result.set(user, result.get(user) + by);
+	if(result.ids !== this.ids)
+		result.ids = Vector.share(result.ids);
 	
 	return result;
 }
@@ -168,19 +343,113 @@ Vector.prototype.incr = function(user, by) {
  *  @type Vector
  */
 Vector.leastCommonSuccessor = function(v1, v2) {
-	var result = v1.copy();
+	return Vector.combine(v1, v2, Math.max);
+};
+
+/** Instantiates a new translation cache.
+ *  @class Keeps the most recently used translations of requests, up to a
+ *  given number of them. The least recently used translation is evicted when
+ *  another one is added to a full cache.
+ *  @param {Number} size The number of translations to keep
+ */
+function TranslationCache(size) {
+	this.size = size;
+	this.length = 0;
+	this.hits = 0;
+	this.misses = 0;
 	
-	v2.eachUser(function(u, v) {
-		var val1 = v1.get(u);
-		var val2 = v2.get(u);
-		
-		if(val1 < val2)
-			result[u] = val2;
-		//else
-		//	result[u] = val1; // This is already the case since we copied v1
-	});
+	// Entries by key, and a list of them from the most to the least recently
+	// used one, starting at a sentinel entry.
+	this.entries = {};
+	this.head = {};
+	this.head.next = this.head.previous = this.head;
+}
+
+/** Returns the key under which the translation of a request to the given
+ *  state vector is stored. Requests are told apart by their user and vector,
+ *  as each user issues one request per state, except for Delete requests
+ *  which are logged in a reversible form after being executed.
+ *  @param {Request} request
+ *  @param {Vector} targetVector
+ *  @type String
+ */
+TranslationCache.key = function(request, targetVector) {
+	var kind;
+	if(request instanceof UndoRequest)
+		kind = "u";
+	else if(request instanceof RedoRequest)
+		kind = "r";
+	else if(request.operation instanceof Operations.Delete &&
+		!request.operation.isReversible())
+		kind = "n";
+	else
+		kind = "d";
 	
-	return result;
+	return kind + request.user + "@" + request.vector + ">" + targetVector;
+};
+
+/** Returns the translation stored under the given key, or undefined if there
+ *  is none.
+ *  @param {String} key
+ */
+TranslationCache.prototype.get = function(key) {
+	var entry = this.entries.hasOwnProperty(key) ? this.entries[key] : undefined;
+	if(entry == undefined) {
+		this.misses += 1;
+		return undefined;
+	}
+	
+	this.hits += 1;
+	this.unlink(entry);
+	this.link(entry);
+	return entry.value;
+};
+
+/** Stores a translation under the given key.
+ *  @param {String} key
+ *  @param {Request} value
+ */
+TranslationCache.prototype.set = function(key, value) {
+	if(this.entries.hasOwnProperty(key))
+		this.remove(key);
+	
+	if(this.length >= this.size)
+		this.remove(this.head.previous.key);
+	
+	var entry = {key: key, value: value};
+	this.entries[key] = entry;
+	this.link(entry);
+	this.length += 1;
+};
+
+/** Removes the translation stored under the given key.
+ *  @param {String} key
+ */
+TranslationCache.prototype.remove = function(key) {
+	this.unlink(this.entries[key]);
+	delete this.entries[key];
+	this.length -= 1;
+};
+
+/** Removes all translations. */
+TranslationCache.prototype.clear = function() {
+	this.entries = {};
+	this.head.next = this.head.previous = this.head;
+	this.length = 0;
+};
+
+/** @ignore */
+TranslationCache.prototype.link = function(entry) {
+	entry.previous = this.head;
+	entry.next = this.head.next;
+	this.head.next.previous = entry;
+	this.head.next = entry;
+};
+
+/** @ignore */
+TranslationCache.prototype.unlink = function(entry) {
+	entry.previous.next = entry.next;
+	entry.next.previous = entry.previous;
 };
 
 /** Instantiates a new state object.
@@ -198,9 +467,20 @@ function State(buffer, vector) {
 	this.vector = new Vector(vector);
 	this.request_queue = new Array();
 	this.log = new Array();
-	this.cache = {};
+	this.cache = new TranslationCache(State.cacheSize);
+	
+	// Requests in the log by user and number, and the first request of each
+	// user, for the first indexedLength requests in the log.
+	this.requests = {};
+	this.firstRequests = {};
+	this.indexedLog = this.log;
+	this.indexedLength = 0;
 }
 
+/** The number of translated requests kept by a state's cache.
+ *  @static */
+State.cacheSize = 10000;
+
 /** Translates a request to the given state vector.
  *  @param {Request} request The request to translate
  *  @param {Vector} targetVector The target state vector
@@ -216,14 +496,15 @@ State.prototype.translate = function(request, targetVector, noCache) {
 	
 	// Before we attempt to translate the request, we check whether it is
 	// cached already.
-	var cache_key = [request, targetVector].toString();
 	if(this.cache != undefined && !noCache) {
-		if(!this.cache[cache_key])
-			this.cache[cache_key] = this.translate(request, targetVector, true);
+		var cache_key = TranslationCache.key(request, targetVector);
+		var cached = this.cache.get(cache_key);
+		if(cached == undefined) {
+			cached = this.translate(request, targetVector, true);
+			this.cache.set(cache_key, cached);
+		}
 		
-		// FIXME: translated requests are not cleared from the cache, so this
-		// might fill up considerably.
-		return this.cache[cache_key];
+		return cached;
 	}
 	
 	if(request instanceof UndoRequest || request instanceof RedoRequest)
@@ -238,7 +519,7 @@ State.prototype.translate = function(request, targetVector, noCache) {
 		// vector, except the component of the issuing user is changed to
 		// match the one from the associated request.
 		var mirrorAt = targetVector.copy();
-		mirrorAt[request.user] = assocReq.vector.get(request.user);
+		mirrorAt.set(request.user, assocReq.vector.get(request.user));
 		
 		if(this.reachable(mirrorAt))
 		{			
@@ -254,15 +535,13 @@ State.prototype.translate = function(request, targetVector, noCache) {
 		// perform a translation afterwards, which is attempted next.
 	}
 	
-	for(var _user in this.vector)
+	var users = this.vector.users();
+	for(var userIndex = 0; userIndex < users.length; userIndex++)
 	{
 		// We now iterate through all users to see how we can translate
 		// the request to the desired state.
 		
-		if(!_user.match(Vector.user_regex))
-			continue;
-		
-		var user = parseInt(_user);
+		var user = users[userIndex];
 		
 		// The request's issuing user is left out since it is not possible
 		// to transform or fold a request along its own user.
@@ -447,7 +726,7 @@ State.prototype.execute = function(request) {
 		// untouched.
 		var assocReq = request.associatedRequest(this.log);
 		var newVector = new Vector(assocReq.vector);
-		newVector[request.user] = request.vector.get(request.user);
+		newVector.set(request.user, request.vector.get(request.user));
 		request.vector = newVector;
 	}
 	
@@ -521,30 +800,190 @@ State.prototype.reachableUser = function(vector, user) {
  *  @param {Number} index The number of the request to be returned
  */
 State.prototype.requestByUser = function(user, getIndex) {
-	for(var reqIndex in this.log)
-	{
-		var request = this.log[reqIndex];
-
-		if(request.user == user && request.vector.get(user) == getIndex)
-		{
-			return request;
-		}
-	}
+	this.updateIndex();
+	var requests = this.requests[user];
+	if(requests != undefined && requests.hasOwnProperty(getIndex))
+		return requests[getIndex];
 }
 
 /** Retrieve the first request in the log that was issued by the given user.
  *  @param {Number} user
  */
 State.prototype.firstRequestByUser = function(user) {
-	var firstRequest;
-	for(var reqIndex in this.log) {
-		var request = this.log[reqIndex];
+	this.updateIndex();
+	return this.firstRequests[user];
+}
 
-		if(request.user == user && (!firstRequest || firstRequest.vector.get(user) > request.vector.get(user) ))
-		{
-			firstRequest = request;
+/** Removes requests from the log that are no longer needed, given a vector
+ *  that every participant has reached, so that all requests still to be
+ *  executed are issued at or after it. Such requests are translated only
+ *  along requests that the vector does not include, so the requests it
+ *  includes can be dropped unless a remaining request still refers to them.
+ *  The remaining requests need not be rebased: requests are looked up by
+ *  their users' numbers, starting from the first one left in the log.
+ *  @param {Vector} stableVector The vector every participant has reached
+ *  @param {Vector} [undoVector] For each user, the number of its oldest
+ *  request that may still be undone; defaults to the stable vector.
+ *  @returns The number of requests removed.
+ *  @type Number
+ */
+State.prototype.prune = function(stableVector, undoVector) {
+	if(undoVector == undefined)
+		undoVector = stableVector;
+
+	// For each user, the number of its first request that has to be kept.
+	var keep = {};
+	this.vector.eachUser(function(u, v) {
+		keep[u] = Math.min(stableVector.get(u), undoVector.get(u));
+	});
+
+	// Each user's requests from the last to the first, along with the number
+	// of the request undos and redos refer to.
+	var associated = this.associatedRequests();
+	var requests = {};
+	for(var index = 0; index < this.log.length; index++) {
+		var request = this.log[index];
+		if(requests[request.user] == undefined)
+			requests[request.user] = new Array();
+		requests[request.user].push({
+			number: request.vector.get(request.user),
+			request: request,
+			associated: associated[index] == undefined ? undefined :
+				associated[index].vector.get(request.user)
+		});
+	}
+	for(var user in requests)
+		requests[user].sort(function(a, b) { return b.number - a.number; });
+
+	// Lowering the number of a user's first request to keep keeps more of its
+	// requests, which are gone through once each.
+	var position = {};
+	var pending = new Array();
+	for(var user in keep) {
+		position[user] = 0;
+		pending.push(user);
+	}
+
+	while(pending.length > 0) {
+		var user = pending.pop();
+		var userRequests = requests[user] || [];
+		while(position[user] < userRequests.length) {
+			var item = userRequests[position[user]];
+			if(item.number < keep[user])
+				break;
+			position[user]++;
+
+			// A remaining request needs all requests its vector does not
+			// include, since it might be translated along them, even those of
+			// users that are not part of its vector at all...
+			for(var other in keep) {
+				var count = item.request.vector.get(other);
+				if(count < keep[other]) {
+					keep[other] = count;
+					pending.push(other);
+				}
+			}
+
+			// ...and undo and redo requests need the requests they refer to,
+			// along with everything in between.
+			if(item.associated != undefined && item.associated < keep[user])
+				keep[user] = item.associated;
 		}
 	}
 
-	return firstRequest;
-}
+	var log = new Array();
+	for(var index = 0; index < this.log.length; index++) {
+		var request = this.log[index];
+		if(request.vector.get(request.user) >= keep[request.user])
+			log.push(request);
+	}
+	var removed = this.log.length - log.length;
+
+	if(removed > 0) {
+		// Replacing the log makes the index be built anew.
+		this.log = log;
+		this.cache.clear();
+	}
+
+	return removed;
+};
+
+/** Finds the request each undo and redo request in the log refers to, in a
+ *  single pass over the log. An undo refers to the latest of its user's do
+ *  and redo requests not yet undone, a redo to the latest undo not yet redone
+ *  (or do request), which are kept on a stack for each user and kind.
+ *  Requests logged again after their user issued later ones are looked up as
+ *  usual.
+ *  @returns An array holding the associated request, if any, of each request
+ *  in the log at its index.
+ *  @type Array
+ */
+State.prototype.associatedRequests = function() {
+	var undoable = {};
+	var redoable = {};
+	var latest = {};
+	var associated = new Array();
+	for(var index = 0; index < this.log.length; index++) {
+		var request = this.log[index];
+		var user = request.user;
+		var number = request.vector.get(user);
+		var inOrder = latest[user] == undefined || number >= latest[user];
+		if(inOrder)
+			latest[user] = number;
+
+		if(undoable[user] == undefined) {
+			undoable[user] = new Array();
+			redoable[user] = new Array();
+		}
+
+		var assocReq = undefined;
+		if(request instanceof UndoRequest) {
+			assocReq = undoable[user].pop();
+			redoable[user].push(request);
+		} else if(request instanceof RedoRequest) {
+			assocReq = redoable[user].pop();
+			undoable[user].push(request);
+		} else {
+			undoable[user].push(request);
+			redoable[user].push(request);
+		}
+
+		if(!inOrder && !(request instanceof DoRequest))
+			assocReq = request.associatedRequest(this.log);
+
+		associated.push(assocReq);
+	}
+
+	return associated;
+};
+
+/** Adds the requests appended to the log since the last call to the index
+ *  of requests by user. The index is built anew if the log has been replaced
+ *  or shortened in the meantime.
+ */
+State.prototype.updateIndex = function() {
+	if(this.indexedLog !== this.log || this.indexedLength > this.log.length) {
+		this.requests = {};
+		this.firstRequests = {};
+		this.indexedLog = this.log;
+		this.indexedLength = 0;
+	}
+	
+	for(; this.indexedLength < this.log.length; this.indexedLength++) {
+		var request = this.log[this.indexedLength];
+		var number = request.vector.get(request.user);
+		
+		if(this.requests[request.user] == undefined)
+			this.requests[request.user] = {};
+		
+		// Like a search through the log, prefer the earlier of two requests
+		// with the same number.
+		var requests = this.requests[request.user];
+		if(!requests.hasOwnProperty(number))
+			requests[number] = request;
+		
+		var first = this.firstRequests[request.user];
+		if(first == undefined || first.vector.get(request.user) > number)
+			this.firstRequests[request.user] = request;
+	}
+};
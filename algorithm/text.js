@@ -57,19 +57,78 @@ Segment.prototype.copy = function() {
  * @param {Array} [segments] The segments that this buffer should be
  * pre-filled with.
  * @class Holds multiple Segments and provides methods for modifying them at
- * a character level.
+ * a character level. The text is kept in a balanced tree of chunks of up to
+ * {@link Buffer.CHUNK_SIZE} characters by one user each, which stores the
+ * length of the text below each node, so positions are found in logarithmic
+ * time. Nodes are never changed once created, so copies of a buffer share
+ * its tree, and changes only create the nodes on the path to the change.
+ * Adjacent chunks by the same user are merged into one segment when the
+ * segments are read.
  */
 function Buffer(segments) {
-	this.segments = new Array();
+	this.root = null;
+	this._segments = null;
 	
 	if(segments && segments.length)
 	{
-		for(var index in segments)
-			this.segments.push(segments[index].copy());
+		var chunks = new Array();
+		for(var index = 0; index < segments.length; index++)
+		{
+			var segment = segments[index];
+			for(var offset = 0; offset < segment.text.length;
+				offset += Buffer.CHUNK_SIZE)
+			{
+				chunks.push(new BufferNode(segment.user,
+					segment.text.slice(offset, offset + Buffer.CHUNK_SIZE)));
+			}
+		}
+		
+		this.root = BufferNode.build(chunks);
 	}
 }
 
-Buffer.prototype.toString = function() { return this.segments.join(""); };
+/** The number of characters up to which text is kept in one node. Longer
+ *  texts are split up, so changing a node does not copy more than that.
+ *  @static */
+Buffer.CHUNK_SIZE = 512;
+
+/** The segments of this buffer, with empty segments left out and adjacent
+ *  segments by the same user combined. Changing them does not change the
+ *  buffer.
+ *  @type Array
+ */
+Object.defineProperty(Buffer.prototype, "segments", {
+	get: function() {
+		if(this._segments == null)
+		{
+			var segments = new Array();
+			var user, texts = new Array();
+			BufferNode.each(this.root, function(node) {
+				if(texts.length > 0 && node.user != user)
+				{
+					segments.push(new Segment(user, texts.join("")));
+					texts = new Array();
+				}
+				user = node.user;
+				texts.push(node.text);
+			});
+			if(texts.length > 0)
+				segments.push(new Segment(user, texts.join("")));
+			
+			this._segments = segments;
+		}
+		
+		return this._segments;
+	}
+});
+
+Buffer.prototype.toString = function() {
+	var texts = new Array();
+	BufferNode.each(this.root, function(node) {
+		texts.push(node.text);
+	});
+	return texts.join("");
+};
 
 Buffer.prototype.toHTML = function() {
 	var result = '<span class="buffer">';
@@ -79,56 +138,32 @@ Buffer.prototype.toHTML = function() {
 	return result;
 };
 
-/** Creates a deep copy of this buffer.
+/** Creates a copy of this buffer, which shares its contents until either of
+ *  them is changed.
  * @type Buffer
  */
 Buffer.prototype.copy = function() {
-	return this.slice(0);
+	var result = new Buffer();
+	result.root = this.root;
+	return result;
 };
 
 /** Cleans up the buffer by removing empty segments and combining adjacent
- *  segments by the same user.
+ *  segments by the same user. Buffers never hold empty segments, and their
+ *  segments are combined when they are read, so there is nothing left to do.
  */
-Buffer.prototype.compact = function() {
-	var segmentIndex = 0;
-	while(segmentIndex < this.segments.length)
-	{
-		if(this.segments[segmentIndex].text.length == 0)
-		{
-			// This segment is empty, remove it.
-			this.segments.splice(segmentIndex, 1);
-			continue;
-		} else if(segmentIndex < this.segments.length - 1 && 
-			this.segments[segmentIndex].user == 
-			this.segments[segmentIndex+1].user) {
-			
-			// Two consecutive segments are from the same user; merge them
-			// into one.
-			this.segments[segmentIndex].text +=
-				this.segments[segmentIndex+1].text;
-			
-			this.segments.splice(segmentIndex+1, 1);
-			continue;
-		}
-		
-		segmentIndex += 1;
-	}
-};
+Buffer.prototype.compact = function() {};
 
 /** Calculates the total number of characters contained in this buffer.
  * @returns Total character count in this buffer
  * @type Number
  */
 Buffer.prototype.getLength = function() {
-	var length = 0;
-	for(var index = 0; index < this.segments.length; index++)
-		length += this.segments[index].text.length;
-	
-	return length;
+	return BufferNode.getLength(this.root);
 }
 
-/** Extracts a deep copy of a range of characters in this buffer and returns
- *  it as a new Buffer object.
+/** Extracts a copy of a range of characters in this buffer and returns it as
+ *  a new Buffer object.
  *  @param {Number} begin Index of first character to return
  *  @param {Number} [end] Index of last character (exclusive). If not
  *  provided, defaults to the total length of the buffer.
@@ -136,34 +171,18 @@ Buffer.prototype.getLength = function() {
  *  @type Buffer
  */
 Buffer.prototype.slice = function(begin, end) {
-	var result = new Buffer();
-	
-	var segmentIndex = 0, segmentOffset = 0, sliceBegin = begin,
-		sliceEnd = end;
-	
-	if(sliceEnd == undefined)
-		sliceEnd = Number.MAX_VALUE;
+	var length = this.getLength();
+	if(end == undefined || end > length)
+		end = length;
+	begin = Math.min(Math.max(begin, 0), length);
 	
-	while(segmentIndex < this.segments.length && sliceEnd >= segmentOffset)
+	var result = new Buffer();
+	if(end > begin)
 	{
-		var segment = this.segments[segmentIndex];
-		if(sliceBegin - segmentOffset < segment.text.length &&
-			sliceEnd - segmentOffset > 0)
-		{
-			var newText = segment.text.slice(sliceBegin - segmentOffset,
-				sliceEnd - segmentOffset);
-			var newSegment = new Segment(segment.user, newText);
-			result.segments.push(newSegment);
-			
-			sliceBegin += newText.length;
-		}
-		
-		segmentOffset += segment.text.length;
-		segmentIndex += 1;
+		var rest = BufferNode.split(this.root, begin)[1];
+		result.root = BufferNode.split(rest, end - begin)[0];
 	}
 	
-	result.compact();
-	
 	return result;
 }
 
@@ -178,109 +197,176 @@ Buffer.prototype.splice = function(index, remove, insert) {
 	if(index > this.getLength())
 		throw "Buffer splice operation out of bounds";
 	
-	var segmentIndex = 0, segmentOffset = 0, spliceIndex = index,
-		spliceCount = remove, spliceInsertOffset = undefined;
-	while(segmentIndex < this.segments.length)
+	var parts = BufferNode.split(this.root, index);
+	var result = parts[0];
+	
+	if(insert instanceof Buffer)
+		result = BufferNode.join(result, insert.root);
+	
+	if(remove > 0)
+		parts = BufferNode.split(parts[1], remove);
+	
+	this.root = BufferNode.join(result, parts[1]);
+	this._segments = null;
+}
+
+/** Creates a new node of a buffer's tree.
+ *  @class A node of the tree holding the text of a buffer, which is ordered
+ *  like the text and forms a heap by its random priorities (a treap).
+ *  @param {Number} user User ID
+ *  @param {String} text The chunk of text stored in this node
+ *  @param {BufferNode} [left] The nodes of the text before it
+ *  @param {BufferNode} [right] The nodes of the text after it
+ *  @param {Number} [priority] Defaults to a random number.
+ *  @ignore
+ */
+function BufferNode(user, text, left, right, priority) {
+	this.user = user;
+	this.text = text;
+	this.left = (left == undefined) ? null : left;
+	this.right = (right == undefined) ? null : right;
+	this.priority = (priority == undefined) ? Math.random() : priority;
+	this.length = text.length + BufferNode.getLength(this.left) +
+		BufferNode.getLength(this.right);
+}
+
+/** Returns the length of the text in the given tree, which may be null.
+ *  @static */
+BufferNode.getLength = function(node) {
+	return (node == null) ? 0 : node.length;
+};
+
+/** Calls the given function with each node of a tree in order.
+ *  @static */
+BufferNode.each = function(node, callback) {
+	while(node != null)
 	{
-		var segment = this.segments[segmentIndex];
-		
-		if(spliceIndex >= 0 && spliceIndex < segment.text.length)
-		{
-			// This segment is part of the region to splice.
-			
-			// Store the text that this splice operation removes to adjust the
-			// splice offset correctly later on.
-			var removedText = segment.text.slice(spliceIndex, spliceIndex +
-				spliceCount);
-			
-			if(spliceIndex == 0) {
-				// abcdefg
-				// ^        We're splicing at the beginning of a segment
-				
-				if(spliceIndex + spliceCount < segment.text.length)
-				{
-					// abcdefg
-					// ^---^    Remove a part at the beginning
-					
-					if(spliceInsertOffset == undefined)
-						spliceInsertOffset = segmentIndex;
-					
-					segment.text = segment.text.slice(spliceIndex +
-						spliceCount);
-				} else {
-					// abcdefg
-					// ^-----^  Remove the entire segment
-					
-					if(spliceInsertOffset == undefined)
-						spliceInsertOffset = segmentIndex;
-					
-					segment.text = "";
-					this.segments.splice(segmentIndex, 1);
-					segmentIndex -= 1;
-				}
-			} else {
-				// abcdefg
-				//   ^	    We're splicing inside a segment
-			
-				if(spliceInsertOffset == undefined)
-					spliceInsertOffset = segmentIndex + 1;
-				
-				if(spliceIndex + spliceCount < segment.text.length)
-				{
-					// abcdefg
-					//   ^--^   Remove a part in between
-					
-					// Note that if spliceCount == 0, this function only
-					// splits the segment in two. This is necessary in case we
-					// want to insert new segments later.
-					
-					var splicePost = new Segment(segment.user,
-						segment.text.slice(spliceIndex + spliceCount));
-					segment.text = segment.text.slice(0, spliceIndex);
-					this.segments.splice(segmentIndex + 1, 0, splicePost);
-				} else {
-					// abcdefg
-					//   ^---^  Remove a part at the end	
-					
-					segment.text = segment.text.slice(0, spliceIndex);
-				}
-			}
-			
-			spliceCount -= removedText.length;
-		}
-		
-		if(spliceIndex < segment.text.length && spliceCount == 0)
-		{
-			// We have removed the specified amount of characters. No need to
-			// continue this loop since nothing remains to be done.
-			
-			if(spliceInsertOffset == undefined)
-				spliceInsertOffset = spliceIndex;
-			
-			break;
-		}
-		
-		spliceIndex -= segment.text.length;
+		BufferNode.each(node.left, callback);
+		callback(node);
+		node = node.right;
+	}
+};
+
+/** Builds a tree of the given nodes, which have no children yet, in linear
+ *  time.
+ *  @static */
+BufferNode.build = function(nodes) {
+	// Each node becomes the right child of the last node on the right spine
+	// with a higher priority, taking the nodes with lower priorities as its
+	// left child.
+	var spine = new Array();
+	for(var index = 0; index < nodes.length; index++)
+	{
+		var node = nodes[index], last = null;
+		while(spine.length > 0 && spine[spine.length - 1].priority < node.priority)
+			last = spine.pop();
 		
-		segmentIndex += 1;
+		node.left = last;
+		if(spine.length > 0)
+			spine[spine.length - 1].right = node;
+		spine.push(node);
 	}
 	
-	if(insert instanceof Buffer)
+	if(spine.length == 0)
+		return null;
+	
+	BufferNode.updateLengths(spine[0]);
+	return spine[0];
+};
+
+/** @static */
+BufferNode.updateLengths = function(node) {
+	if(node == null)
+		return 0;
+	
+	node.length = node.text.length + BufferNode.updateLengths(node.left) +
+		BufferNode.updateLengths(node.right);
+	return node.length;
+};
+
+/** Splits a tree into the trees of the text before and after the given
+ *  index, returned as an array of two trees.
+ *  @static */
+BufferNode.split = function(node, index) {
+	if(node == null)
+		return [null, null];
+	
+	var leftLength = BufferNode.getLength(node.left);
+	if(index <= leftLength)
 	{
-		// If a buffer has been given, we insert copies of its segments at the
-		// specified position.
-		
-		if(spliceInsertOffset == undefined)
-			spliceInsertOffset = this.segments.length;
-		
-		for(var insertIndex = 0; insertIndex < insert.segments.length;
-			insertIndex ++)
-		{
-			this.segments.splice(spliceInsertOffset + insertIndex, 0,
-				insert.segments[insertIndex].copy());
-		}
+		var parts = BufferNode.split(node.left, index);
+		return [parts[0], new BufferNode(node.user, node.text, parts[1],
+			node.right, node.priority)];
 	}
 	
-	// Clean up since the splice operation might have fragmented some segments.
-	this.compact();
-}
+	var offset = index - leftLength;
+	if(offset >= node.text.length)
+	{
+		var parts = BufferNode.split(node.right, offset - node.text.length);
+		return [new BufferNode(node.user, node.text, node.left, parts[0],
+			node.priority), parts[1]];
+	}
+	
+	// The index lies within this node's text, which is split in two.
+	return [
+		new BufferNode(node.user, node.text.slice(0, offset), node.left, null,
+			node.priority),
+		new BufferNode(node.user, node.text.slice(offset), null, node.right,
+			node.priority)
+	];
+};
+
+/** Joins two trees, the text of the first one preceding that of the second.
+ *  The chunks where they meet are merged if they are by the same user and
+ *  fit into one node.
+ *  @static */
+BufferNode.join = function(left, right) {
+	if(left == null)
+		return right;
+	if(right == null)
+		return left;
+	
+	var last = left;
+	while(last.right != null)
+		last = last.right;
+	var first = right;
+	while(first.left != null)
+		first = first.left;
+	
+	if(last.user == first.user &&
+		last.text.length + first.text.length <= Buffer.CHUNK_SIZE)
+	{
+		left = BufferNode.append(left, first.text);
+		right = BufferNode.split(right, first.text.length)[1];
+	}
+	
+	return BufferNode.merge(left, right);
+};
+
+/** Returns a tree with the given text appended to its last node.
+ *  @static */
+BufferNode.append = function(node, text) {
+	if(node.right != null)
+		return new BufferNode(node.user, node.text, node.left,
+			BufferNode.append(node.right, text), node.priority);
+	
+	return new BufferNode(node.user, node.text + text, node.left, null,
+		node.priority);
+};
+
+/** Merges two trees, the text of the first one preceding that of the second,
+ *  keeping the nodes with higher priorities above the others.
+ *  @static */
+BufferNode.merge = function(left, right) {
+	if(left == null)
+		return right;
+	if(right == null)
+		return left;
+	
+	if(left.priority > right.priority)
+		return new BufferNode(left.user, left.text, left.left,
+			BufferNode.merge(left.right, right), left.priority);
+	else
+		return new BufferNode(right.user, right.text,
+			BufferNode.merge(left, right.left), right.right, right.priority);
+};
@@ -0,0 +1,492 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+The demo server on asyncio, for Python 3.7 and above.
+
+It serves the session pages and static files and speaks the same protocol on
+/transport as server.py, so editor.js works with either server. WebSocket
+frames are parsed straight from the connection's stream, and broadcasts are
+encoded and framed once for all peers of a session. Only the final WebSocket
+protocol (RFC 6455) is supported, without extensions, and commands are always
+sent as JSON. Sessions are kept in memory only: there is no journal, no
+eviction and no sharding or replication.
+
+If uvloop is installed, its event loop is used. Start the server with
+"python3 aioserver.py [port]".
+"""
+
+PORT = 8080
+
+# Commands received and other events are logged like in server.py (see
+# eventlog.py).
+LOG_LEVEL = "info"
+LOG_SAMPLE_RATE = 1.0
+LOG_MAX_LENGTH = 200
+
+import asyncio
+import hashlib
+import json
+import os
+import struct
+import sys
+
+from base64 import b64encode
+from urllib.parse import quote, unquote, parse_qs
+
+from algorithm import State, Vector
+import assets
+from eventlog import EventLog, LEVELS, INFO, WARNING
+from serialize import commandToRequest, bufferToSegments, encodeJSON, encodeCommands, \
+	addressFrame, splitAddressed, EncodedLog
+
+_RFC6455_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+CLOSE_NORMAL = 1000
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_UNSUPPORTED = 1003
+CLOSE_TOO_BIG = 1009
+
+# Seconds responses to URLs carrying a static file's version may be cached for.
+MAX_AGE = 365 * 24 * 60 * 60
+
+def frameHeader(opcode, length):
+	"""Returns the header of an unmasked frame with the FIN bit set."""
+	if length < 126:
+		return struct.pack("!BB", 0x80 | opcode, length)
+	elif length < 0x10000:
+		return struct.pack("!BBH", 0x80 | opcode, 126, length)
+	return struct.pack("!BBQ", 0x80 | opcode, 127, length)
+
+def textFrame(text):
+	data = text.encode("utf-8")
+	return frameHeader(OPCODE_TEXT, len(data)) + data
+
+def unmask(data, mask):
+	"""XORs a payload with the masking key repeated to its length, converting
+	both to integers so this does not run byte by byte."""
+	length = len(data)
+	if not length:
+		return data
+	key = (mask * (length // 4 + 1))[:length]
+	return (int.from_bytes(data, "big") ^ int.from_bytes(key, "big")).to_bytes(length, "big")
+
+class ProtocolError(Exception):
+	def __init__(self, message, code=CLOSE_PROTOCOL_ERROR):
+		Exception.__init__(self, message)
+		self.code = code
+
+class WebSocket(object):
+	"""A WebSocket connection whose handshake has been completed."""
+
+	# Longest message accepted from clients, as in websocket.py.
+	MAX_LENGTH = 16384
+
+	def __init__(self, reader, writer):
+		self.reader = reader
+		self.writer = writer
+		self.closed = False
+
+	async def receive(self):
+		"""Returns the next text message, or None once the connection has been
+		closed. Control frames are handled along the way."""
+		reader = self.reader
+		fragments = []
+		length = 0
+		while True:
+			first, second = await reader.readexactly(2)
+			opcode = first & 0x0F
+			size = second & 0x7F
+			if first & 0x70:
+				raise ProtocolError("reserved bits set")
+			if not second & 0x80:
+				raise ProtocolError("unmasked frame")
+			if size == 126:
+				size, = struct.unpack("!H", await reader.readexactly(2))
+			elif size == 127:
+				size, = struct.unpack("!Q", await reader.readexactly(8))
+
+			if opcode >= OPCODE_CLOSE:
+				if size > 125 or not first & 0x80:
+					raise ProtocolError("invalid control frame")
+				mask = await reader.readexactly(4)
+				payload = unmask(await reader.readexactly(size), mask)
+				if opcode == OPCODE_CLOSE:
+					self.close(CLOSE_NORMAL)
+					return None
+				if opcode == OPCODE_PING:
+					self.writer.write(frameHeader(OPCODE_PONG, len(payload)) + payload)
+				continue
+
+			if opcode == OPCODE_BINARY:
+				# The binary codec is never negotiated here.
+				raise ProtocolError("unexpected binary frame", CLOSE_UNSUPPORTED)
+			if (opcode == OPCODE_CONTINUATION) != bool(fragments):
+				raise ProtocolError("unexpected frame opcode %d" % opcode)
+			length += size
+			if length > self.MAX_LENGTH:
+				raise ProtocolError("message too long", CLOSE_TOO_BIG)
+
+			mask = await reader.readexactly(4)
+			fragments.append(unmask(await reader.readexactly(size), mask))
+			if first & 0x80:
+				return b"".join(fragments).decode("utf-8")
+
+	def write(self, frame):
+		if not self.closed:
+			self.writer.write(frame)
+
+	def writeSequence(self, frames):
+		if not self.closed:
+			self.writer.writelines(frames)
+
+	def close(self, code=CLOSE_NORMAL):
+		if not self.closed:
+			self.writer.write(frameHeader(OPCODE_CLOSE, 2) + struct.pack("!H", code))
+			self.closed = True
+			self.writer.close()
+
+class Connection(object):
+	"""A client connected through /transport, the counterpart of
+	TransportHandler in server.py. It may join any number of sessions by
+	addressing commands to them."""
+
+	def __init__(self, websocket):
+		self.websocket = websocket
+
+		peer = websocket.writer.get_extra_info("peername")
+		self.address = peer[0] if peer else None
+
+		# The sessions joined, as Peers by the name their commands are addressed
+		# by, None for the session joined without.
+		self.peers = {}
+
+	async def run(self):
+		try:
+			while True:
+				message = await self.websocket.receive()
+				if message is None:
+					break
+				self.commandsReceived(json.loads(message))
+		except ProtocolError as e:
+			eventLog.log(WARNING, "protocol_error", address=self.address, error=str(e))
+			self.websocket.close(e.code)
+		except (ValueError, TypeError, IndexError) as e:
+			eventLog.log(WARNING, "invalid_message", address=self.address, error=str(e))
+			self.websocket.close(CLOSE_PROTOCOL_ERROR)
+		except (asyncio.IncompleteReadError, ConnectionError):
+			pass
+		finally:
+			for peer in self.peers.values():
+				peer.session.userDisconnected(peer)
+
+	def commandsReceived(self, commands):
+		for channel, addressed in splitAddressed(commands):
+			for command, args in addressed:
+				if command == "join_session":
+					self.leaveSession(channel)
+					session = sessions.get(args[0])
+					if session is not None and channel in (None, args[0]):
+						self.peers[channel] = Peer(self.websocket, channel)
+						session.userJoined(self.peers[channel])
+					else:
+						eventLog.log(WARNING, "unknown_session", session=args[0])
+				elif command == "leave_session":
+					self.leaveSession(channel)
+					continue
+
+				peer = self.peers.get(channel)
+				if peer is not None:
+					peer.session.commandReceived(peer, command, args)
+
+	def leaveSession(self, channel):
+		peer = self.peers.pop(channel, None)
+		if peer is not None:
+			peer.session.userDisconnected(peer)
+
+class Peer(object):
+	"""A connection's membership in a session, the counterpart of Peer in
+	server.py."""
+
+	def __init__(self, websocket, channel):
+		self.websocket = websocket
+		self.channel = channel
+		self.uid = None
+		self.session = None
+
+		# The state vector this peer has acknowledged to have reached. It is None
+		# until the peer has been synchronized.
+		self.acked = None
+
+	def addressed(self, frame):
+		if self.channel is None:
+			return frame
+		return addressFrame(self.channel, frame)
+
+	def postCommand(self, command, args=[]):
+		self.websocket.write(textFrame(self.addressed(encodeCommands([[command, args]]))))
+
+	def postFrames(self, frames):
+		self.websocket.writeSequence([textFrame(self.addressed(frame)) for frame in frames])
+
+class Session(object):
+	"""A session's document and peers, the counterpart of SessionResource in
+	server.py."""
+
+	UNDO_DEPTH = 500
+
+	def __init__(self, path):
+		self.path = path
+		self.current_uid = 1
+		self.peers = {}
+
+		self.state = State()
+		self.encodedLog = EncodedLog()
+		self.discarded = 0
+		self.collected = None
+
+		# Encoded commands waiting to be broadcast once the current batch of
+		# incoming data has been handled.
+		self.pendingCommands = []
+		self.flushScheduled = False
+
+	def userJoined(self, peer):
+		peer.session = self
+		peer.uid = self.current_uid
+		self.current_uid += 1
+		self.peers[peer.uid] = peer
+		peer.postCommand("assign_uid", [peer.uid, self.UNDO_DEPTH, None])
+
+	def userDisconnected(self, peer):
+		if peer.uid in self.peers:
+			del self.peers[peer.uid]
+			self.collectLog()
+
+	def collectLog(self):
+		"""Discards requests from the log that no peer can still need for
+		transforming or undoing requests."""
+		acked = [peer.acked for peer in self.peers.values() if peer.acked is not None]
+		if acked:
+			stable = Vector.minimum(acked)
+		else:
+			stable = self.state.vector
+
+		undoable = {}
+		for user in self.state.vector.users():
+			undoable[user] = self.state.vector.get(user)
+			if user in self.peers:
+				undoable[user] = max(0, undoable[user] - self.UNDO_DEPTH)
+		undoable = Vector(undoable)
+
+		if (stable.toString(), undoable.toString()) == self.collected:
+			return
+		self.collected = (stable.toString(), undoable.toString())
+
+		discarded = self.state.prune(stable, undoable)
+		if discarded:
+			self.encodedLog.retain(self.state.log)
+			self.discarded += discarded
+
+			# Peers discard the same requests once they have executed the ones
+			# broadcast so far.
+			self.flushCommands()
+			for peer in list(self.peers.values()):
+				if peer.acked is not None:
+					peer.postCommand("prune", [stable.toString(), undoable.toString()])
+
+	def commandReceived(self, peer, command, args):
+		eventLog.log(INFO, "command", session=self.path, user=peer.uid, command=command, args=args)
+
+		if command == "sync":
+			self.flushCommands()
+			frames = [encodeCommands([
+				["sync_begin", []],
+				["sync_snapshot", [bufferToSegments(self.state.buffer), self.state.vector.toString()]],
+			])]
+			frames.extend(self.encodedLog.frames())
+			frames.append(encodeCommands([["sync_end", []]]))
+			peer.postFrames(frames)
+			peer.acked = self.state.vector
+		elif command == "ack":
+			vector = Vector(args[0])
+			if peer.acked is None or not vector.causallyBefore(self.state.vector):
+				return
+			peer.acked = Vector.leastCommonSuccessor(peer.acked, vector)
+			self.collectLog()
+		elif command in ("insert", "delete", "undo"):
+			request = commandToRequest(command, args)
+			if request.user != peer.uid or not self.state.canExecute(request) or \
+				request.vector.get(request.user) != self.state.vector.get(request.user):
+				eventLog.log(WARNING, "invalid_request", session=self.path, user=peer.uid)
+				return
+
+			self.state.execute(request)
+			self.encodedLog.append(self.state.log[-1])
+			self.broadcastCommand(command, args)
+
+			if peer.acked is not None:
+				peer.acked = Vector.leastCommonSuccessor(peer.acked, request.vector)
+
+	def broadcastCommand(self, command, args=[]):
+		self.pendingCommands.append(encodeJSON([command, args]))
+		if not self.flushScheduled:
+			self.flushScheduled = True
+			asyncio.get_event_loop().call_soon(self.flushCommands)
+
+	def flushCommands(self):
+		"""Sends all pending commands to all peers in one frame, built once for
+		each addressing."""
+		self.flushScheduled = False
+		if not self.pendingCommands:
+			return
+		frame = "[%s]" % ",".join(self.pendingCommands)
+		self.pendingCommands = []
+		frames = {}
+		for peer in list(self.peers.values()):
+			if peer.channel not in frames:
+				frames[peer.channel] = textFrame(peer.addressed(frame))
+			peer.websocket.write(frames[peer.channel])
+
+sessions = {}
+
+# Where this process logs to, written by a thread started along with the server.
+eventLog = EventLog(sys.stdout, LEVELS[LOG_LEVEL], LOG_SAMPLE_RATE, LOG_MAX_LENGTH)
+
+# Static files are read once and kept in memory (see assets.py), and the
+# session page references them by their version.
+staticAssets = assets.load()
+template = assets.versionURLs(open("template.html", "rt").read(), staticAssets)
+
+def respondStatic(writer, asset, query, headers):
+	"""Sends a static file like server.py's StaticResource does."""
+	body, etag = asset.data, asset.etag
+	extra = []
+	if asset.gzipped is not None:
+		extra.append(("Vary", "Accept-Encoding"))
+		if "gzip" in headers.get("accept-encoding", ""):
+			body, etag = asset.gzipped, asset.gzippedEtag
+			extra.append(("Content-Encoding", "gzip"))
+	extra.append(("ETag", etag))
+	if parse_qs(query).get("v") == [asset.version]:
+		extra.append(("Cache-Control", "public, max-age=%d, immutable" % MAX_AGE))
+	else:
+		extra.append(("Cache-Control", "no-cache"))
+
+	if etag in [tag.strip() for tag in headers.get("if-none-match", "").split(",")]:
+		respond(writer, "304 Not Modified", b"", asset.contentType, extra)
+	else:
+		respond(writer, "200 OK", body, asset.contentType, extra)
+
+def respond(writer, status, body=b"", contentType="text/html; charset=utf-8", headers=()):
+	lines = ["HTTP/1.1 %s" % status, "Content-Type: %s" % contentType,
+		"Content-Length: %d" % len(body)]
+	lines.extend("%s: %s" % header for header in headers)
+	writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+
+async def readRequest(reader):
+	"""Returns the method, path and headers of the next HTTP request, or None
+	if the connection has been closed."""
+	line = await reader.readline()
+	if not line:
+		return None
+	parts = line.decode("latin-1").split()
+	if len(parts) != 3:
+		raise ValueError("invalid request line")
+
+	headers = {}
+	while True:
+		line = await reader.readline()
+		if line in (b"\r\n", b"\n", b""):
+			break
+		name, _, value = line.decode("latin-1").partition(":")
+		headers[name.strip().lower()] = value.strip()
+	return parts[0], parts[1], headers
+
+async def handleConnection(reader, writer):
+	try:
+		while True:
+			request = await readRequest(reader)
+			if request is None:
+				break
+			method, path, headers = request
+			path, _, query = path.partition("?")
+			path = unquote(path)
+
+			if path == "/transport":
+				websocket = acceptWebSocket(reader, writer, headers)
+				if websocket is not None:
+					await Connection(websocket).run()
+				break
+
+			if method != "GET":
+				respond(writer, "405 Method Not Allowed")
+			elif path == "/":
+				# Redirect to a new session with a random name.
+				name = os.urandom(6).hex()
+				respond(writer, "302 Found", headers=[("Location", "/session/" + name)])
+			elif path.startswith("/session/") and path[9:].isalnum():
+				name = path[9:]
+				if name not in sessions:
+					sessions[name] = Session(name)
+				respond(writer, "200 OK", (template % {"path": quote(name)}).encode("utf-8"))
+			elif path.startswith("/static/") and path[8:] in staticAssets:
+				respondStatic(writer, staticAssets[path[8:]], query, headers)
+			else:
+				respond(writer, "404 Not Found", b"Not found")
+			await writer.drain()
+
+			if headers.get("connection", "").lower() == "close":
+				break
+	except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+		pass
+	finally:
+		writer.close()
+
+def acceptWebSocket(reader, writer, headers):
+	"""Completes the handshake of a WebSocket connection. Returns the
+	WebSocket, or None if the request was not a valid handshake."""
+	key = headers.get("sec-websocket-key")
+	if headers.get("upgrade", "").lower() != "websocket" or key is None or \
+		headers.get("sec-websocket-version") != "13":
+		respond(writer, "400 Bad Request", headers=[("Sec-WebSocket-Version", "13")])
+		return None
+
+	accept = b64encode(hashlib.sha1(key.encode("latin-1") + _RFC6455_GUID).digest())
+	writer.write(b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n"
+		b"Connection: Upgrade\r\nSec-WebSocket-Accept: " + accept + b"\r\n\r\n")
+	return WebSocket(reader, writer)
+
+async def main(port):
+	server = await asyncio.start_server(handleConnection, port=port, backlog=1024)
+
+	print("EXPERIMENTAL SERVER - Do not use in production environments!")
+	print("Read the README file before using this.")
+	print()
+	for sock in server.sockets:
+		print("Listening for HTTP connections on %s:%s" % sock.getsockname()[:2])
+	print()
+
+	async with server:
+		await server.serve_forever()
+
+if __name__ == "__main__":
+	try:
+		import uvloop
+	except ImportError:
+		uvloop = None
+	if uvloop is not None:
+		asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+	# Write logged records from a thread of their own until exiting
+	eventLog.start()
+	try:
+		asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else PORT))
+	finally:
+		eventLog.stop()
@@ -0,0 +1,1217 @@
+# -*- coding: utf-8 -*-
+
+"""
+Python port of jinfinote's algorithm (algorithm/*.js), allowing the server to
+keep a materialized copy of each document.
+
+Class and method names follow their JavaScript counterparts so that both
+implementations can be compared side by side; behaviour has to stay identical
+since clients and server need to arrive at the same buffer contents.
+"""
+
+import re
+import sys
+
+class Segment(object):
+	"""Stores a chunk of text together with the user it was written by."""
+
+	def __init__(self, user, text):
+		self.user = user
+		self.text = text
+
+	def __repr__(self):
+		return "Segment(%r, %r)" % (self.user, self.text)
+
+	def copy(self):
+		return Segment(self.user, self.text)
+
+class Buffer(object):
+	"""Holds multiple Segments and provides methods for modifying them at a
+	character level."""
+
+	def __init__(self, segments=None):
+		self.segments = []
+
+		if segments:
+			for segment in segments:
+				self.segments.append(segment.copy())
+
+	def __repr__(self):
+		return "Buffer(%r)" % self.segments
+
+	def toString(self):
+		return u"".join([segment.text for segment in self.segments])
+
+	def copy(self):
+		"""Creates a deep copy of this buffer."""
+		return self.slice(0)
+
+	def compact(self):
+		"""Cleans up the buffer by removing empty segments and combining
+		adjacent segments by the same user."""
+		segments = self.segments
+		segmentIndex = 0
+		while segmentIndex < len(segments):
+			if len(segments[segmentIndex].text) == 0:
+				# This segment is empty, remove it.
+				del segments[segmentIndex]
+				continue
+			elif segmentIndex < len(segments) - 1 and \
+				segments[segmentIndex].user == segments[segmentIndex + 1].user:
+
+				# Two consecutive segments are from the same user; merge them
+				# into one.
+				segments[segmentIndex].text += segments[segmentIndex + 1].text
+				del segments[segmentIndex + 1]
+				continue
+
+			segmentIndex += 1
+
+	def getLength(self):
+		"""Calculates the total number of characters contained in this
+		buffer."""
+		length = 0
+		for segment in self.segments:
+			length += len(segment.text)
+		return length
+
+	def slice(self, begin, end=None):
+		"""Extracts a deep copy of a range of characters in this buffer and
+		returns it as a new Buffer object."""
+		result = Buffer()
+
+		segmentOffset = 0
+		sliceBegin = begin
+		sliceEnd = end
+
+		if sliceEnd is None:
+			sliceEnd = sys.maxsize
+
+		for segment in self.segments:
+			if sliceEnd < segmentOffset:
+				break
+
+			if sliceBegin - segmentOffset < len(segment.text) and \
+				sliceEnd - segmentOffset > 0:
+				newText = segment.text[sliceBegin - segmentOffset:
+					sliceEnd - segmentOffset]
+				result.segments.append(Segment(segment.user, newText))
+
+				sliceBegin += len(newText)
+
+			segmentOffset += len(segment.text)
+
+		result.compact()
+
+		return result
+
+	def splice(self, index, remove=0, insert=None):
+		"""Like the Array "splice" method, this method allows for removing and
+		inserting text in a buffer at a character level."""
+		if index > self.getLength():
+			raise ValueError("Buffer splice operation out of bounds")
+
+		segments = self.segments
+		segmentIndex = 0
+		spliceIndex = index
+		spliceCount = remove
+		spliceInsertOffset = None
+
+		while segmentIndex < len(segments):
+			segment = segments[segmentIndex]
+
+			if spliceIndex >= 0 and spliceIndex < len(segment.text):
+				# This segment is part of the region to splice.
+
+				# Store the text that this splice operation removes to adjust
+				# the splice offset correctly later on.
+				removedText = segment.text[spliceIndex:spliceIndex + spliceCount]
+
+				if spliceIndex == 0:
+					# We're splicing at the beginning of a segment
+					if spliceInsertOffset is None:
+						spliceInsertOffset = segmentIndex
+
+					if spliceIndex + spliceCount < len(segment.text):
+						# Remove a part at the beginning
+						segment.text = segment.text[spliceIndex + spliceCount:]
+					else:
+						# Remove the entire segment
+						segment.text = u""
+						del segments[segmentIndex]
+						segmentIndex -= 1
+				else:
+					# We're splicing inside a segment
+					if spliceInsertOffset is None:
+						spliceInsertOffset = segmentIndex + 1
+
+					if spliceIndex + spliceCount < len(segment.text):
+						# Remove a part in between. If spliceCount == 0, this
+						# only splits the segment in two, which is necessary
+						# in case we want to insert new segments later.
+						splicePost = Segment(segment.user,
+							segment.text[spliceIndex + spliceCount:])
+						segment.text = segment.text[:spliceIndex]
+						segments.insert(segmentIndex + 1, splicePost)
+					else:
+						# Remove a part at the end
+						segment.text = segment.text[:spliceIndex]
+
+				spliceCount -= len(removedText)
+
+			if spliceIndex < len(segment.text) and spliceCount == 0:
+				# We have removed the specified amount of characters. No need
+				# to continue this loop since nothing remains to be done.
+				if spliceInsertOffset is None:
+					spliceInsertOffset = spliceIndex
+
+				break
+
+			spliceIndex -= len(segment.text)
+
+			segmentIndex += 1
+
+		if isinstance(insert, Buffer):
+			# If a buffer has been given, we insert copies of its segments at
+			# the specified position.
+			if spliceInsertOffset is None:
+				spliceInsertOffset = len(segments)
+
+			for insertIndex, insertSegment in enumerate(insert.segments):
+				segments.insert(spliceInsertOffset + insertIndex,
+					insertSegment.copy())
+
+		# Clean up since the splice operation might have fragmented some
+		# segments.
+		self.compact()
+
+if sys.maxunicode > 0xFFFF:
+	_astral_regex = re.compile(u"[\U00010000-\U0010FFFF]")
+else:
+	# Narrow builds already store strings as UTF-16 code units.
+	_astral_regex = None
+
+try:
+	unichr
+except NameError:
+	unichr = chr
+
+def _surrogatePair(match):
+	code = ord(match.group(0)) - 0x10000
+	return unichr(0xD800 + (code >> 10)) + unichr(0xDC00 + (code & 0x3FF))
+
+def toCodeUnits(text):
+	"""Returns the given text with characters outside the Basic Multilingual
+	Plane split into surrogate pairs. JavaScript measures offsets and lengths
+	in UTF-16 code units, so this is needed for positions sent by clients to
+	refer to the same characters here."""
+	if _astral_regex is None:
+		return text
+	return _astral_regex.sub(_surrogatePair, text)
+
+class NoOp(object):
+	"""An operation that does nothing."""
+
+	requiresCID = False
+
+	def __repr__(self):
+		return "NoOp()"
+
+	def apply(self, buffer):
+		pass
+
+	def transform(self, other, cid=None):
+		return NoOp()
+
+	def mirror(self):
+		return NoOp()
+
+class Insert(object):
+	"""An operation that inserts a Buffer at a certain offset."""
+
+	requiresCID = True
+
+	def __init__(self, position, text):
+		self.position = position
+		self.text = text.copy()
+
+	def __repr__(self):
+		return "Insert(%d, %r)" % (self.position, self.text.toString())
+
+	def apply(self, buffer):
+		buffer.splice(self.position, 0, self.text)
+
+	def cid(self, other):
+		"""Computes the concurrency ID against another Insert operation."""
+		if not hasattr(other, "position"):
+			# Like in JavaScript, there is no answer for operations without a
+			# position, such as Split operations.
+			return None
+		if self.position < other.position:
+			return other
+		if self.position > other.position:
+			return self
+
+	def getLength(self):
+		return self.text.getLength()
+
+	def transform(self, other, cid=None):
+		if isinstance(other, NoOp):
+			return Insert(self.position, self.text)
+
+		if isinstance(other, Split):
+			# We transform against the first component of the split operation
+			# first.
+			transformFirst = self.transform(other.first,
+				self if cid is self else other.first)
+
+			# The second part of the split operation is transformed against
+			# its first part.
+			newSecond = other.second.transform(other.first)
+
+			return transformFirst.transform(newSecond,
+				transformFirst if cid is self else newSecond)
+
+		pos1 = self.position
+		str1 = self.text
+		pos2 = other.position
+
+		if isinstance(other, Insert):
+			str2 = other.text
+
+			if pos1 < pos2 or (pos1 == pos2 and cid is other):
+				return Insert(pos1, str1)
+			if pos1 > pos2 or (pos1 == pos2 and cid is self):
+				return Insert(pos1 + str2.getLength(), str1)
+		elif isinstance(other, Delete):
+			len2 = other.getLength()
+
+			if pos1 >= pos2 + len2:
+				return Insert(pos1 - len2, str1)
+			if pos1 < pos2:
+				return Insert(pos1, str1)
+			if pos1 >= pos2 and pos1 < pos2 + len2:
+				return Insert(pos2, str1)
+
+	def mirror(self):
+		return Delete(self.position, self.text.copy())
+
+class Delete(object):
+	"""An operation that removes a range of characters in the target buffer.
+	Delete operations constructed with a Buffer know which text they are
+	removing and can therefore be mirrored, whereas those knowing only the
+	amount of characters to be removed are non-reversible."""
+
+	requiresCID = False
+
+	def __init__(self, position, what, recon=None):
+		self.position = position
+
+		if isinstance(what, Buffer):
+			self.what = what.copy()
+		else:
+			self.what = what
+
+		if recon:
+			self.recon = recon
+		else:
+			self.recon = Recon()
+
+	def __repr__(self):
+		if self.isReversible():
+			return "Delete(%d, %r)" % (self.position, self.what.toString())
+		return "Delete(%d, %d)" % (self.position, self.what)
+
+	def isReversible(self):
+		return isinstance(self.what, Buffer)
+
+	def apply(self, buffer):
+		buffer.splice(self.position, self.getLength())
+
+	def cid(self, other):
+		pass
+
+	def getLength(self):
+		if self.isReversible():
+			return self.what.getLength()
+		else:
+			return self.what
+
+	def split(self, at):
+		"""Splits this Delete operation into two Delete operations at the
+		given offset."""
+		if self.isReversible():
+			# This is a reversible Delete operation. No need to to any
+			# processing for recon data.
+			return Split(
+				Delete(self.position, self.what.slice(0, at)),
+				Delete(self.position + at, self.what.slice(at))
+			)
+		else:
+			# This is a non-reversible Delete operation that might carry recon
+			# data. We need to split that data accordingly between the two new
+			# components.
+			recon1 = Recon()
+			recon2 = Recon()
+
+			for segment in self.recon.segments:
+				if segment.offset < at:
+					recon1.segments.append(segment)
+				else:
+					recon2.segments.append(
+						ReconSegment(segment.offset - at, segment.buffer))
+
+			return Split(
+				Delete(self.position, at, recon1),
+				Delete(self.position + at, self.what - at, recon2)
+			)
+
+	@staticmethod
+	def getAffectedString(operation, buffer):
+		"""Returns the range of text in a buffer that this Delete or
+		Split-Delete operation removes."""
+		if isinstance(operation, Split):
+			# The other operation is a Split operation. We call this function
+			# again recursively for each component.
+			part1 = Delete.getAffectedString(operation.first, buffer)
+			part2 = Delete.getAffectedString(operation.second, buffer)
+
+			part2.splice(0, 0, part1)
+			return part2
+		elif isinstance(operation, Delete):
+			# In the process of determining the affected string, we also have
+			# to take into account the data that has been "transformed away"
+			# from the Delete operation and which is stored in the Recon
+			# object.
+			reconBuffer = buffer.slice(operation.position,
+				operation.position + operation.getLength())
+
+			operation.recon.restore(reconBuffer)
+
+			return reconBuffer
+
+	def makeReversible(self, transformed, state):
+		if isinstance(self.what, Buffer):
+			return Delete(self.position, self.what)
+		else:
+			return Delete(self.position,
+				Delete.getAffectedString(transformed, state.buffer))
+
+	def merge(self, other):
+		"""Merges a Delete operation with another one."""
+		if self.isReversible():
+			if not other.isReversible():
+				raise ValueError("Cannot merge reversible operations with non-reversible ones")
+
+			newBuffer = self.what.copy()
+			newBuffer.splice(newBuffer.getLength(), 0, other.what)
+			return Delete(self.position, newBuffer)
+		else:
+			return Delete(self.position, self.getLength() + other.getLength())
+
+	def transform(self, other, cid=None):
+		if isinstance(other, NoOp):
+			return Delete(self.position, self.what, self.recon)
+
+		if isinstance(other, Split):
+			# We transform against the first component of the split operation
+			# first.
+			transformFirst = self.transform(other.first,
+				self if cid is self else other.first)
+
+			# The second part of the split operation is transformed against
+			# its first part.
+			newSecond = other.second.transform(other.first)
+
+			return transformFirst.transform(newSecond,
+				transformFirst if cid is self else newSecond)
+
+		pos1 = self.position
+		len1 = self.getLength()
+
+		pos2 = other.position
+		len2 = other.getLength()
+
+		if isinstance(other, Insert):
+			if pos2 >= pos1 + len1:
+				return Delete(pos1, self.what, self.recon)
+			if pos2 <= pos1:
+				return Delete(pos1 + len2, self.what, self.recon)
+			if pos2 > pos1 and pos2 < pos1 + len1:
+				result = self.split(pos2 - pos1)
+				result.second.position += len2
+				return result
+		elif isinstance(other, Delete):
+			if pos1 + len1 <= pos2:
+				return Delete(pos1, self.what, self.recon)
+			if pos1 >= pos2 + len2:
+				return Delete(pos1 - len2, self.what, self.recon)
+			if pos2 <= pos1 and pos2 + len2 >= pos1 + len1:
+				# This operation falls completely within the range of
+				# another, i.e. all data has already been removed.
+				if self.isReversible():
+					newData = Buffer()
+				else:
+					newData = 0
+				newRecon = self.recon.update(0,
+					other.what.slice(pos1 - pos2, pos1 - pos2 + len1))
+				return Delete(pos2, newData, newRecon)
+			if pos2 <= pos1 and pos2 + len2 < pos1 + len1:
+				# The first part of this operation falls within the range of
+				# another.
+				result = self.split(pos2 + len2 - pos1)
+				result.second.position = pos2
+				result.second.recon = self.recon.update(0,
+					other.what.slice(pos1 - pos2))
+				return result.second
+			if pos2 > pos1 and pos2 + len2 >= pos1 + len1:
+				# The second part of this operation falls within the range of
+				# another.
+				result = self.split(pos2 - pos1)
+				result.first.recon = self.recon.update(
+					result.first.getLength(),
+					other.what.slice(0, pos1 + len1 - pos2))
+				return result.first
+			if pos2 > pos1 and pos2 + len2 < pos1 + len1:
+				# Another operation falls completely within the range of this
+				# operation. We remove that part by splitting this operation
+				# two times and merging the first and the last part.
+				r1 = self.split(pos2 - pos1)
+				r2 = r1.second.split(len2)
+
+				result = r1.first.merge(r2.second)
+				result.recon = self.recon.update(pos2 - pos1, other.what)
+				return result
+
+	def mirror(self):
+		if self.isReversible():
+			return Insert(self.position, self.what.copy())
+
+class Split(object):
+	"""An operation which wraps two different operations into a single
+	object."""
+
+	requiresCID = True
+
+	def __init__(self, first, second):
+		self.first = first
+		self.second = second
+
+	def __repr__(self):
+		return "Split(%r, %r)" % (self.first, self.second)
+
+	def apply(self, buffer):
+		self.first.apply(buffer)
+		transformedSecond = self.second.transform(self.first)
+		transformedSecond.apply(buffer)
+
+	def cid(self, other):
+		pass
+
+	def transform(self, other, cid=None):
+		if cid is self or cid is other:
+			return Split(
+				self.first.transform(other,
+					self.first if cid is self else other),
+				self.second.transform(other,
+					self.second if cid is self else other)
+			)
+		else:
+			return Split(
+				self.first.transform(other),
+				self.second.transform(other)
+			)
+
+	def mirror(self):
+		newSecond = self.second.transform(self.first)
+		return Split(self.first.mirror(), newSecond.mirror())
+
+class Recon(object):
+	"""Collects the parts of a Delete operation that are lost during
+	transformation, so that it can be made reversible later on."""
+
+	def __init__(self, recon=None):
+		if recon:
+			self.segments = recon.segments[:]
+		else:
+			self.segments = []
+
+	def update(self, offset, buffer):
+		newRecon = Recon(self)
+		if isinstance(buffer, Buffer):
+			newRecon.segments.append(ReconSegment(offset, buffer))
+		return newRecon
+
+	def restore(self, buffer):
+		for segment in self.segments:
+			buffer.splice(segment.offset, 0, segment.buffer)
+
+class ReconSegment(object):
+	def __init__(self, offset, buffer):
+		self.offset = offset
+		self.buffer = buffer.copy()
+
+class Vector(object):
+	"""Stores state vectors. Can be initialized from another Vector, a dict
+	mapping users to numbers or a string of the form "1:2;3:4;5:6"."""
+
+	timestring_regex = re.compile(r"(\d+):(\d+)")
+
+	def __init__(self, value=None):
+		self.components = {}
+
+		if isinstance(value, Vector):
+			value = value.components
+
+		if isinstance(value, dict):
+			for user, count in value.items():
+				if count > 0:
+					self.components[int(user)] = count
+		elif value:
+			for user, count in self.timestring_regex.findall(value):
+				self.components[int(user)] = int(count)
+
+	def __repr__(self):
+		return "Vector(%r)" % self.toString()
+
+	def eachUser(self, callback):
+		"""Calls the callback with each user and its component in ascending
+		user order, stopping and returning False as soon as the callback
+		returns False."""
+		components = self.components
+		for user in sorted(components):
+			if callback(user, components[user]) == False:
+				return False
+
+		return True
+
+	def users(self):
+		return sorted(self.components)
+
+	def toString(self):
+		"""Returns this vector as a string of the form "1:2;3:4;5:6"."""
+		components = ["%d:%d" % (u, v) for u, v in self.components.items() if v > 0]
+		components.sort()
+		return ";".join(components)
+
+	__str__ = toString
+
+	def add(self, other):
+		result = Vector(self)
+		for u, v in other.components.items():
+			result.components[u] = result.get(u) + v
+		return result
+
+	def copy(self):
+		return Vector(self)
+
+	def get(self, user):
+		return self.components.get(user, 0)
+
+	def set(self, user, value):
+		self.components[user] = value
+
+	def causallyBefore(self, other):
+		"""Calculates whether all components of this vector are less than or
+		equal to their corresponding components in the other vector."""
+		for u, v in self.components.items():
+			if v > other.get(u):
+				return False
+		return True
+
+	def equals(self, other):
+		for u, v in self.components.items():
+			if other.get(u) != v:
+				return False
+		for u, v in other.components.items():
+			if self.get(u) != v:
+				return False
+		return True
+
+	def incr(self, user, by=1):
+		"""Returns a new vector with a specific component increased by a given
+		amount."""
+		result = Vector(self)
+		result.components[user] = result.get(user) + by
+		return result
+
+	@staticmethod
+	def leastCommonSuccessor(v1, v2):
+		result = v1.copy()
+		for u, v in v2.components.items():
+			if v1.get(u) < v:
+				result.components[u] = v
+		return result
+
+	@staticmethod
+	def minimum(vectors):
+		"""Returns the componentwise minimum of the given vectors."""
+		vectors = list(vectors)
+		result = Vector()
+		if not vectors:
+			return result
+
+		for u, v in vectors[0].components.items():
+			for other in vectors[1:]:
+				v = min(v, other.get(u))
+			if v > 0:
+				result.components[u] = v
+		return result
+
+class DoRequest(object):
+	"""Represents a request made by a user at a certain time."""
+
+	def __init__(self, user, vector, operation):
+		self.user = user
+		self.vector = vector
+		self.operation = operation
+
+	def __repr__(self):
+		return "DoRequest(%s, %s, %r)" % (self.user, self.vector, self.operation)
+
+	def copy(self):
+		return DoRequest(self.user, self.vector, self.operation)
+
+	def execute(self, state):
+		self.operation.apply(state.buffer)
+		state.vector = state.vector.incr(self.user, 1)
+		return self
+
+	def transform(self, other, cid=None):
+		if isinstance(self.operation, NoOp):
+			newOperation = NoOp()
+		else:
+			op_cid = None
+			if cid is self:
+				op_cid = self.operation
+			if cid is other:
+				op_cid = other.operation
+
+			newOperation = self.operation.transform(other.operation, op_cid)
+
+		return DoRequest(self.user, self.vector.incr(other.user), newOperation)
+
+	def mirror(self, amount=1):
+		return DoRequest(self.user, self.vector.incr(self.user, amount),
+			self.operation.mirror())
+
+	def fold(self, user, amount):
+		if amount % 2 == 1:
+			raise ValueError("Fold amounts must be multiples of 2.")
+		return DoRequest(self.user, self.vector.incr(user, amount),
+			self.operation)
+
+	def makeReversible(self, translated, state):
+		result = self.copy()
+
+		if isinstance(self.operation, Delete):
+			result.operation = self.operation.makeReversible(
+				translated.operation, state)
+
+		return result
+
+class _ChainRequest(object):
+	"""Common base of undo and redo requests."""
+
+	def __init__(self, user, vector):
+		self.user = user
+		self.vector = vector
+
+	def __repr__(self):
+		return "%s(%s, %s)" % (self.__class__.__name__, self.user, self.vector)
+
+	def copy(self):
+		return self.__class__(self.user, self.vector)
+
+	def associatedRequest(self, log):
+		"""Finds the request that this undo or redo request refers to."""
+		sequence = 1
+		index = len(log) - 1
+		for position, request in enumerate(log):
+			if request is self:
+				index = position
+				break
+
+		while index >= 0:
+			request = log[index]
+			index -= 1
+
+			if request is self or request.user != self.user:
+				continue
+			if request.vector.get(self.user) > self.vector.get(self.user):
+				continue
+
+			if isinstance(request, self.__class__):
+				sequence += 1
+			else:
+				sequence -= 1
+
+			if sequence == 0:
+				return request
+
+class UndoRequest(_ChainRequest):
+	"""Represents an undo request made by a user at a certain time."""
+
+class RedoRequest(_ChainRequest):
+	"""Represents a redo request made by a user at a certain time."""
+
+class _CacheEntry(object):
+	__slots__ = ("key", "value", "previous", "next")
+
+class TranslationCache(object):
+	"""Keeps the most recently used translations of requests, up to the given
+	number of them. The least recently used translation is evicted when
+	another one is added to a full cache."""
+
+	def __init__(self, size):
+		self.size = size
+		self.hits = 0
+		self.misses = 0
+
+		# Entries by key, and a list of them from the most to the least
+		# recently used one, starting at a sentinel entry.
+		self.entries = {}
+		self.head = _CacheEntry()
+		self.head.next = self.head.previous = self.head
+
+	def __len__(self):
+		return len(self.entries)
+
+	@staticmethod
+	def key(request, targetVector):
+		"""Returns the key under which the translation of a request to the
+		given state vector is stored. Requests are told apart by their user
+		and vector, as each user issues one request per state, except for
+		Delete requests which are logged in a reversible form after being
+		executed."""
+		if isinstance(request, UndoRequest):
+			kind = "u"
+		elif isinstance(request, RedoRequest):
+			kind = "r"
+		elif isinstance(request.operation, Delete) and not request.operation.isReversible():
+			kind = "n"
+		else:
+			kind = "d"
+
+		return "%s%d@%s>%s" % (kind, request.user, request.vector.toString(), targetVector.toString())
+
+	def get(self, key):
+		"""Returns the translation stored under the given key, or None if
+		there is none."""
+		entry = self.entries.get(key)
+		if entry is None:
+			self.misses += 1
+			return None
+
+		self.hits += 1
+		self._unlink(entry)
+		self._link(entry)
+		return entry.value
+
+	def set(self, key, value):
+		"""Stores a translation under the given key."""
+		if key in self.entries:
+			self.remove(key)
+
+		if len(self.entries) >= self.size:
+			self.remove(self.head.previous.key)
+
+		entry = _CacheEntry()
+		entry.key = key
+		entry.value = value
+		self.entries[key] = entry
+		self._link(entry)
+
+	def remove(self, key):
+		"""Removes the translation stored under the given key."""
+		self._unlink(self.entries.pop(key))
+
+	def clear(self):
+		"""Removes all translations."""
+		self.entries = {}
+		self.head.next = self.head.previous = self.head
+
+	def _link(self, entry):
+		entry.previous = self.head
+		entry.next = self.head.next
+		self.head.next.previous = entry
+		self.head.next = entry
+
+	def _unlink(self, entry):
+		entry.previous.next = entry.next
+		entry.next.previous = entry.previous
+
+class State(object):
+	"""Stores and manipulates the state of a document by keeping track of its
+	state vector, content and history of executed requests."""
+
+	# The number of translated requests kept by a state's cache.
+	cacheSize = 10000
+
+	def __init__(self, buffer=None, vector=None):
+		if isinstance(buffer, Buffer):
+			self.buffer = buffer.copy()
+		else:
+			self.buffer = Buffer()
+
+		self.vector = Vector(vector)
+		self.request_queue = []
+		self.log = []
+		self.cache = TranslationCache(self.cacheSize)
+
+		# Requests in the log by user and number, and the first request of
+		# each user, for the first indexedLength requests in the log.
+		self.requests = {}
+		self.firstRequests = {}
+		self.indexedLog = self.log
+		self.indexedLength = 0
+
+	def translate(self, request, targetVector, noCache=False):
+		"""Translates a request to the given state vector."""
+		if isinstance(request, DoRequest) and request.vector.equals(targetVector):
+			# If the request is not an undo/redo request and is already at
+			# the desired state, there is nothing to do.
+			return request.copy()
+
+		if self.cache is not None and not noCache:
+			# Before we attempt to translate the request, we check whether it
+			# is cached already.
+			cache_key = TranslationCache.key(request, targetVector)
+			cached = self.cache.get(cache_key)
+			if cached is None:
+				cached = self.translate(request, targetVector, True)
+				self.cache.set(cache_key, cached)
+			return cached
+
+		if isinstance(request, (UndoRequest, RedoRequest)):
+			# If we're dealing with an undo or redo request, we first try to
+			# see whether a late mirror is possible.
+			assocReq = request.associatedRequest(self.log)
+
+			# The state we're trying to mirror at corresponds to the target
+			# vector, except the component of the issuing user is changed to
+			# match the one from the associated request.
+			mirrorAt = targetVector.copy()
+			mirrorAt.set(request.user, assocReq.vector.get(request.user))
+
+			if self.reachable(mirrorAt):
+				translated = self.translate(assocReq, mirrorAt)
+				mirrorBy = targetVector.get(request.user) - \
+					mirrorAt.get(request.user)
+
+				return translated.mirror(mirrorBy)
+
+			# If mirrorAt is not reachable, we need to mirror earlier and then
+			# perform a translation afterwards, which is attempted next.
+
+		for user in self.vector.users():
+			# The request's issuing user is left out since it is not possible
+			# to transform or fold a request along its own user.
+			if user == request.user:
+				continue
+
+			# We can only transform against requests that have been issued
+			# between the translated request's vector and the target vector.
+			if targetVector.get(user) <= request.vector.get(user):
+				continue
+
+			# Fetch the last request by this user that contributed to the
+			# current state vector.
+			lastRequest = self.requestByUser(user, targetVector.get(user) - 1)
+
+			if isinstance(lastRequest, (UndoRequest, RedoRequest)):
+				# When the last request was an undo/redo request, we can try
+				# to "fold" over it.
+				foldBy = targetVector.get(user) - \
+					lastRequest.associatedRequest(self.log).vector.get(user)
+
+				if targetVector.get(user) >= foldBy:
+					foldAt = targetVector.incr(user, -foldBy)
+
+					if self.reachable(foldAt) and request.vector.causallyBefore(foldAt):
+						translated = self.translate(request, foldAt)
+						return translated.fold(user, foldBy)
+
+			# If folding and mirroring is not possible, we can transform this
+			# request against other users' requests that have contributed to
+			# the current state vector.
+			transformAt = targetVector.incr(user, -1)
+			if transformAt.get(user) >= 0 and self.reachable(transformAt):
+				lastRequest = self.requestByUser(user, transformAt.get(user))
+
+				r1 = self.translate(request, transformAt)
+				r2 = self.translate(lastRequest, transformAt)
+
+				cid_req = None
+
+				if r1.operation.requiresCID:
+					# For the Insert operation, we need to check whether it is
+					# possible to determine which operation is to be
+					# transformed.
+					cid = r1.operation.cid(r2.operation)
+
+					if cid is None:
+						# The first try is to transform both requests to a
+						# common successor before the transformation vector.
+						lcs = Vector.leastCommonSuccessor(request.vector,
+							lastRequest.vector)
+
+						if self.reachable(lcs):
+							r1t = self.translate(request, lcs)
+							r2t = self.translate(lastRequest, lcs)
+
+							cidt = r1t.operation.cid(r2t.operation)
+
+							if cidt is r1t.operation:
+								cid = r1.operation
+							elif cidt is r2t.operation:
+								cid = r2.operation
+
+						if cid is None:
+							# As a last resort, the user IDs decide, as
+							# specified in the Infinote protocol.
+							if r1.user < r2.user:
+								cid = r1.operation
+							if r1.user > r2.user:
+								cid = r2.operation
+
+					if cid is r1.operation:
+						cid_req = r1
+					if cid is r2.operation:
+						cid_req = r2
+
+				return r1.transform(r2, cid_req)
+
+		raise ValueError("Could not find a translation path")
+
+	def queue(self, request):
+		self.request_queue.append(request)
+
+	def canExecute(self, request):
+		"""Checks whether a given request can be executed in the current
+		state."""
+		if request is None:
+			return False
+
+		if isinstance(request, (UndoRequest, RedoRequest)):
+			return request.associatedRequest(self.log) is not None
+		else:
+			return request.vector.causallyBefore(self.vector)
+
+	def execute(self, request=None):
+		"""Executes a request that is executable, returning the translated
+		request or None if nothing was executed."""
+		if request is None:
+			# Pick an executable request from the queue.
+			for index, queued in enumerate(self.request_queue):
+				if self.canExecute(queued):
+					request = queued
+					del self.request_queue[index]
+					break
+
+		if not self.canExecute(request):
+			# Not executable yet - put it (back) in the queue.
+			if request is not None:
+				self.queue(request)
+			return None
+
+		if request.vector.get(request.user) < self.vector.get(request.user):
+			# If the request has already been executed, skip it, but record
+			# it into the log.
+			self.log.append(request)
+			return None
+
+		request = request.copy()
+
+		if isinstance(request, (UndoRequest, RedoRequest)):
+			# For undo and redo requests, we change their vector to the vector
+			# of the original request, but leave the issuing user's component
+			# untouched.
+			assocReq = request.associatedRequest(self.log)
+			newVector = Vector(assocReq.vector)
+			newVector.set(request.user, request.vector.get(request.user))
+			request.vector = newVector
+
+		translated = self.translate(request, self.vector)
+
+		if isinstance(request, DoRequest) and isinstance(request.operation, Delete):
+			# Since each request might have to be mirrored at some point, it
+			# needs to be reversible.
+			self.log.append(request.makeReversible(translated, self))
+		else:
+			self.log.append(request)
+
+		translated.execute(self)
+
+		return translated
+
+	def executeAll(self):
+		while self.execute() is not None:
+			pass
+
+	def reachable(self, vector):
+		"""Determines whether a given state is reachable by translation."""
+		for user in self.vector.users():
+			if not self.reachableUser(vector, user):
+				return False
+		return True
+
+	def reachableUser(self, vector, user):
+		n = vector.get(user)
+		firstRequest = self.firstRequestByUser(user)
+		if firstRequest is not None:
+			firstRequestNumber = firstRequest.vector.get(user)
+		else:
+			firstRequestNumber = self.vector.get(user)
+
+		while True:
+			if n == firstRequestNumber:
+				return True
+
+			r = self.requestByUser(user, n - 1)
+
+			if r is None:
+				return False
+
+			if isinstance(r, DoRequest):
+				return r.vector.incr(r.user).causallyBefore(vector)
+			else:
+				n = r.associatedRequest(self.log).vector.get(user)
+
+	def requestByUser(self, user, getIndex):
+		"""Retrieve a user's request by its index."""
+		self.updateIndex()
+		return self.requests.get(user, {}).get(getIndex)
+
+	def firstRequestByUser(self, user):
+		"""Retrieve the first request in the log that was issued by the given
+		user."""
+		self.updateIndex()
+		return self.firstRequests.get(user)
+
+	def prune(self, stableVector, undoVector=None):
+		"""Removes requests from the log that are no longer needed, given a
+		vector that every participant has reached. Requests issued at or after
+		that vector are translated only along requests it does not include, so
+		the ones it includes can be dropped, unless a remaining request still
+		refers to them. The optional undo vector gives, for each user, the
+		number of its oldest request that may still be undone; it defaults to
+		the stable vector. Returns the number of requests removed."""
+		if undoVector is None:
+			undoVector = stableVector
+
+		# For each user, the number of its first request that has to be kept.
+		keep = {}
+		for user in self.vector.users():
+			keep[user] = min(stableVector.get(user), undoVector.get(user))
+
+		# Each user's requests from the last to the first, along with the
+		# number of the request undos and redos refer to.
+		requests = {}
+		for request, associated in self._associatedRequests():
+			number = request.vector.get(request.user)
+			if associated is not None:
+				associated = associated.vector.get(request.user)
+			requests.setdefault(request.user, []).append((number, request, associated))
+		for user in requests:
+			requests[user].sort(key=lambda item: item[0], reverse=True)
+
+		# Lowering the number of a user's first request to keep keeps more of
+		# its requests, which are gone through once each.
+		position = dict.fromkeys(keep, 0)
+		pending = list(keep)
+		while pending:
+			user = pending.pop()
+			userRequests = requests.get(user, [])
+			while position[user] < len(userRequests):
+				number, request, associated = userRequests[position[user]]
+				if number < keep[user]:
+					break
+				position[user] += 1
+
+				# A remaining request needs all requests its vector does not
+				# include, since it might be translated along them, even those
+				# of users that are not part of its vector at all...
+				for other in keep:
+					count = request.vector.get(other)
+					if count < keep[other]:
+						keep[other] = count
+						pending.append(other)
+
+				# ...and undo and redo requests need the requests they refer to,
+				# along with everything in between.
+				if associated is not None and associated < keep[user]:
+					keep[user] = associated
+
+		log = [request for request in self.log
+			if request.vector.get(request.user) >= keep[request.user]]
+		removed = len(self.log) - len(log)
+
+		if removed:
+			# Replacing the log makes the index be built anew.
+			self.log = log
+			self.cache.clear()
+
+		return removed
+
+	def _associatedRequests(self):
+		"""Yields the requests in the log along with the request each undo and
+		redo refers to, or None, in a single pass over the log. An undo refers
+		to the latest of its user's do and redo requests not yet undone, a redo
+		to the latest undo not yet redone (or do request), which are kept on a
+		stack for each user and kind. Requests logged again after their user
+		issued later ones are looked up as usual."""
+		undoable = {}
+		redoable = {}
+		latest = {}
+		for request in self.log:
+			user = request.user
+			number = request.vector.get(user)
+			inOrder = number >= latest.get(user, number)
+			latest[user] = max(number, latest.get(user, number))
+
+			associated = None
+			if isinstance(request, UndoRequest):
+				stack = undoable.setdefault(user, [])
+				if stack:
+					associated = stack.pop()
+				redoable.setdefault(user, []).append(request)
+			elif isinstance(request, RedoRequest):
+				stack = redoable.setdefault(user, [])
+				if stack:
+					associated = stack.pop()
+				undoable.setdefault(user, []).append(request)
+			else:
+				undoable.setdefault(user, []).append(request)
+				redoable.setdefault(user, []).append(request)
+
+			if not inOrder and not isinstance(request, DoRequest):
+				associated = request.associatedRequest(self.log)
+
+			yield request, associated
+
+	def updateIndex(self):
+		"""Adds the requests appended to the log since the last call to the
+		index of requests by user. The index is built anew if the log has been
+		replaced or shortened in the meantime."""
+		if self.indexedLog is not self.log or self.indexedLength > len(self.log):
+			self.requests = {}
+			self.firstRequests = {}
+			self.indexedLog = self.log
+			self.indexedLength = 0
+
+		for request in self.log[self.indexedLength:]:
+			user = request.user
+			number = request.vector.get(user)
+
+			# Like a search through the log, prefer the earlier of two
+			# requests with the same number.
+			requests = self.requests.setdefault(user, {})
+			if number not in requests:
+				requests[number] = request
+
+			first = self.firstRequests.get(user)
+			if first is None or first.vector.get(user) > number:
+				self.firstRequests[user] = request
+
+		self.indexedLength = len(self.log)
@@ -0,0 +1,168 @@
+"""
+The demo's static files, read once and kept in memory along with their gzipped
+form, shared by server.py and aioserver.py. The algorithm's scripts are merged
+into a single one like merge.sh does, and scripts are minified. This module
+runs on Python 2 and 3.
+"""
+
+import gzip
+import hashlib
+import io
+import mimetypes
+import os
+import re
+
+DEMO_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(DEMO_DIR, "static")
+ALGORITHM_DIR = os.path.join(DEMO_DIR, "..", "algorithm")
+
+# The algorithm's scripts, in the order merge.sh concatenates them, and the
+# path below /static/ their merged form is served at.
+ALGORITHM_SCRIPTS = ["operations.js", "request.js", "state.js", "text.js"]
+BUNDLE = "jinfinote.js"
+
+# Words after which a slash starts a regular expression rather than a division.
+_KEYWORDS = frozenset(["return", "typeof", "case", "do", "else", "in", "new",
+	"delete", "void", "throw", "instanceof"])
+
+_WORD = re.compile(r"[\w$]+$")
+_LICENSE = re.compile(r"copyright|license", re.IGNORECASE)
+_PLACEHOLDER = re.compile(r"\x00(\d+)\x00")
+_STATIC_URL = re.compile(r'((?:src|href)=")/static/([^"?]+)"')
+
+class Asset(object):
+	"""A file served from memory, along with its gzipped form (None if that is
+	not smaller) and strong entity tags identifying both."""
+
+	def __init__(self, data, contentType):
+		self.data = data
+		self.contentType = contentType
+
+		digest = hashlib.sha1(data).hexdigest()
+		self.version = digest[:12]
+		self.etag = '"%s"' % digest[:20]
+		self.gzipped = compress(data)
+		self.gzippedEtag = '"%s-gzip"' % digest[:20]
+		if len(self.gzipped) >= len(data):
+			self.gzipped = None
+
+def compress(data):
+	"""Gzips data at the highest level. The header does not contain a time, so
+	the result only depends on the data."""
+	output = io.BytesIO()
+	compressor = gzip.GzipFile(fileobj=output, mode="wb", compresslevel=9, mtime=0)
+	compressor.write(data)
+	compressor.close()
+	return output.getvalue()
+
+def minify(source):
+	"""Removes comments, indentation and empty lines from a script. Line breaks
+	are kept, so semicolons are inserted where they were before. Comments
+	starting with /*!, mentioning a copyright or license, or preceding all of
+	the code are kept as they are, so scripts carry their license."""
+	output = []
+	kept = []
+	index = 0
+	length = len(source)
+	previous = "\n"
+	while index < length:
+		char = source[index]
+		if char in "\"'":
+			end = index + 1
+			while source[end] != char:
+				end += 2 if source[end] == "\\" else 1
+			output.append(source[index:end + 1])
+			index = end + 1
+		elif source.startswith("//", index):
+			end = source.find("\n", index)
+			index = length if end == -1 else end
+			continue
+		elif source.startswith("/*", index):
+			end = source.find("*/", index + 2) + 2
+			comment = source[index:end]
+			# previous is a line break until the first code.
+			if comment.startswith("/*!") or _LICENSE.search(comment) or previous == "\n":
+				# Replaced by a placeholder until lines have been stripped,
+				# which would change the comment otherwise.
+				output.append("\0%d\0" % len(kept))
+				kept.append(comment)
+			else:
+				output.append("\n" if "\n" in source[index:end] else " ")
+			index = end
+			continue
+		elif char == "/" and _startsRegex(output, previous):
+			end = index + 1
+			inClass = False
+			while inClass or source[end] != "/":
+				if source[end] == "\\":
+					end += 1
+				elif source[end] == "[":
+					inClass = True
+				elif source[end] == "]":
+					inClass = False
+				end += 1
+			output.append(source[index:end + 1])
+			index = end + 1
+		else:
+			output.append(char)
+			index += 1
+		if not char.isspace():
+			previous = char
+
+	lines = (line.strip() for line in "".join(output).split("\n"))
+	result = "\n".join(line for line in lines if line) + "\n"
+	return _PLACEHOLDER.sub(lambda match: kept[int(match.group(1))], result)
+
+def _startsRegex(output, previous):
+	if previous in "(,=:[!&|?{};+-*%<>~^\n":
+		return True
+	if previous.isalnum() or previous in "_$":
+		word = _WORD.search("".join(output[-12:]).rstrip())
+		return word is not None and word.group() in _KEYWORDS
+	return False
+
+def contentType(path):
+	contentType = mimetypes.guess_type(path)[0] or "application/octet-stream"
+	if contentType.startswith("text/") or contentType.endswith("javascript"):
+		contentType += "; charset=utf-8"
+	return contentType
+
+def _read(path):
+	with open(path, "rb") as f:
+		return f.read()
+
+def _script(data):
+	return minify(data.decode("utf-8")).encode("utf-8")
+
+def load():
+	"""Reads the static files, returning a dict of assets by their path below
+	/static/. The algorithm's scripts are available individually below
+	algorithm/ as well as merged."""
+	assets = {}
+	for directory, names, files in os.walk(STATIC_DIR):
+		for name in files:
+			path = os.path.join(directory, name)
+			data = _read(path)
+			# Minified scripts are served as they are.
+			if name.endswith(".js") and not name.endswith(".min.js"):
+				data = _script(data)
+			assets[os.path.relpath(path, STATIC_DIR).replace(os.sep, "/")] = Asset(data, contentType(name))
+
+	scripts = []
+	for name in ALGORITHM_SCRIPTS:
+		data = _script(_read(os.path.join(ALGORITHM_DIR, name)))
+		assets["algorithm/" + name] = Asset(data, contentType(name))
+		scripts.append(data)
+	assets[BUNDLE] = Asset(b"".join(scripts), contentType(BUNDLE))
+	return assets
+
+def versionURLs(html, assets):
+	"""Appends the version of the static files referenced by src and href
+	attributes in the given page to their URLs, so their responses may be
+	cached for good."""
+	def versioned(match):
+		asset = assets.get(match.group(2))
+		if asset is None:
+			return match.group()
+		return '%s/static/%s?v=%s"' % (match.group(1), match.group(2), asset.version)
+	return _STATIC_URL.sub(versioned, html)
@@ -0,0 +1,220 @@
+#!/usr/bin/python
+"""
+Publish/subscribe brokers connecting several servers (nodes) which host peers
+of the same sessions.
+
+Each session is owned by one node, which orders its log: it executes all
+requests and publishes them to the session's channel, from which the other
+nodes hosting peers of the session replicate it (see server.py). Messages are
+strings, delivered to the subscribers of a channel in the order they were
+published, and never to the subscribers of a channel before they subscribed.
+
+InProcessBroker delivers messages within one process. SocketBroker connects to
+a hub relaying messages between the processes on one machine, which is
+started with "python broker.py <socket path>".
+"""
+
+import sys
+import time
+
+from twisted.internet import protocol, reactor
+from twisted.protocols import basic
+
+from eventlog import WARNING
+
+# Longest message passed through the hub; snapshots of sessions can be large.
+MAX_LENGTH = 64 * 1024 * 1024
+
+class Broker(object):
+	"""Base class of brokers. Messages are stamped with the time they were
+	published, which gives the latency of delivering them."""
+
+	def __init__(self):
+		self.subscribers = {}
+		self.resetStatistics()
+
+	def subscribe(self, channel, callback):
+		"""Calls callback with every message published to the given channel from
+		now on."""
+		self.subscribers.setdefault(channel, []).append(callback)
+
+	def unsubscribe(self, channel, callback):
+		callbacks = self.subscribers.get(channel, [])
+		if callback in callbacks:
+			callbacks.remove(callback)
+		if not callbacks:
+			self.subscribers.pop(channel, None)
+
+	def publish(self, channel, message):
+		raise NotImplementedError()
+
+	def envelope(self, message):
+		self.statistics["published"] += 1
+		return "%.6f %s" % (time.time(), message)
+
+	def deliver(self, channel, envelope):
+		"""Passes a published message to the subscribers of its channel."""
+		sent, message = envelope.split(" ", 1)
+		latency = time.time() - float(sent)
+
+		statistics = self.statistics
+		statistics["delivered"] += 1
+		statistics["latency"] += latency
+		statistics["maxLatency"] = max(statistics["maxLatency"], latency)
+
+		for callback in list(self.subscribers.get(channel, [])):
+			callback(message)
+
+	def resetStatistics(self):
+		"""Returns the number of messages published and delivered, along with the
+		total and maximum latency of delivering them in seconds, since the last
+		time they were reset."""
+		statistics = getattr(self, "statistics", None)
+		self.statistics = {"published": 0, "delivered": 0, "latency": 0.0, "maxLatency": 0.0}
+		return statistics
+
+class InProcessBroker(Broker):
+	"""Delivers messages to subscribers in the same process. Like messages
+	passed between processes, they are delivered in a later reactor
+	iteration."""
+
+	def publish(self, channel, message):
+		reactor.callLater(0, self.deliver, channel, self.envelope(message))
+
+# Messages between the hub and its clients are netstrings starting with a byte
+# giving their kind: "s" and "u" followed by a channel subscribe to and
+# unsubscribe from it, "p" publishes a message and "m" delivers it, followed by
+# the channel, a newline and the message.
+
+class SocketBroker(Broker):
+	"""Passes messages through a hub listening on the given UNIX socket.
+	Messages published while not connected to the hub are sent once the
+	connection is established. Losing the connection is logged to the given
+	EventLog."""
+
+	def __init__(self, path, eventLog=None):
+		Broker.__init__(self)
+		self.eventLog = eventLog
+		self.client = None
+		self.pending = []
+		reactor.connectUNIX(path, BrokerClientFactory(self))
+
+	def subscribe(self, channel, callback):
+		if channel not in self.subscribers:
+			self.send("s" + channel)
+		Broker.subscribe(self, channel, callback)
+
+	def unsubscribe(self, channel, callback):
+		Broker.unsubscribe(self, channel, callback)
+		if channel not in self.subscribers:
+			self.send("u" + channel)
+
+	def publish(self, channel, message):
+		self.send("p%s\n%s" % (channel, self.envelope(message)))
+
+	def send(self, message):
+		if isinstance(message, unicode):
+			message = message.encode("utf-8")
+		if self.client is not None:
+			self.client.sendString(message)
+		else:
+			self.pending.append(message)
+
+	def connected(self, client):
+		# The hub forgets about subscriptions when the connection is lost.
+		self.client = client
+		for channel in self.subscribers:
+			client.sendString("s" + channel)
+		for message in self.pending:
+			client.sendString(message)
+		self.pending = []
+
+	def disconnected(self):
+		self.client = None
+
+class BrokerClient(basic.NetstringReceiver):
+	MAX_LENGTH = MAX_LENGTH
+
+	def connectionMade(self):
+		self.factory.broker.connected(self)
+
+	def stringReceived(self, message):
+		if message[:1] == "m":
+			channel, envelope = message[1:].split("\n", 1)
+			self.factory.broker.deliver(channel, envelope)
+
+	def connectionLost(self, reason):
+		self.factory.broker.disconnected()
+
+class BrokerClientFactory(protocol.ReconnectingClientFactory):
+	protocol = BrokerClient
+	maxDelay = 10
+
+	def __init__(self, broker):
+		self.broker = broker
+
+	def buildProtocol(self, addr):
+		self.resetDelay()
+		return protocol.ReconnectingClientFactory.buildProtocol(self, addr)
+
+	def log(self, event, reason):
+		if self.broker.eventLog is not None:
+			self.broker.eventLog.log(WARNING, event, error=reason.getErrorMessage())
+
+	def clientConnectionLost(self, connector, reason):
+		self.log("broker_connection_lost", reason)
+		protocol.ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
+
+	def clientConnectionFailed(self, connector, reason):
+		self.log("broker_connection_failed", reason)
+		protocol.ReconnectingClientFactory.clientConnectionFailed(self, connector, reason)
+
+class Hub(basic.NetstringReceiver):
+	"""Relays messages published by one client to all clients subscribed to
+	their channel."""
+	MAX_LENGTH = MAX_LENGTH
+
+	def connectionMade(self):
+		self.channels = set()
+
+	def stringReceived(self, message):
+		kind, data = message[:1], message[1:]
+		subscribers = self.factory.subscribers
+		if kind == "s":
+			self.channels.add(data)
+			subscribers.setdefault(data, set()).add(self)
+		elif kind == "u":
+			self.unsubscribe(data)
+		elif kind == "p":
+			# The message is framed once for all subscribers.
+			channel = data.split("\n", 1)[0]
+			frame = "%d:m%s," % (len(data) + 1, data)
+			for subscriber in subscribers.get(channel, ()):
+				subscriber.transport.write(frame)
+
+	def unsubscribe(self, channel):
+		self.channels.discard(channel)
+		subscribers = self.factory.subscribers.get(channel)
+		if subscribers is not None:
+			subscribers.discard(self)
+			if not subscribers:
+				del self.factory.subscribers[channel]
+
+	def connectionLost(self, reason):
+		for channel in list(self.channels):
+			self.unsubscribe(channel)
+
+class HubFactory(protocol.ServerFactory):
+	protocol = Hub
+
+	def __init__(self):
+		self.subscribers = {}
+
+if __name__ == "__main__":
+	if len(sys.argv) != 2:
+		print "usage: %s <socket path>" % sys.argv[0]
+		sys.exit(1)
+
+	reactor.listenUNIX(sys.argv[1], HubFactory(), wantPID=True)
+	print "Relaying messages between nodes on", sys.argv[1]
+	reactor.run()
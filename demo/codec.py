@@ -0,0 +1,189 @@
+"""
+A compact binary encoding for insert, delete and undo commands, used instead
+of JSON on connections whose client supports it (see codec.js for the client
+side).
+
+A binary message is a sequence of commands. Each command starts with a byte
+giving its type, followed by the user, the request's state vector and, for
+insert and delete commands, the operation's arguments. Numbers are encoded as
+varints (7 bits per byte, least significant first, the high bit set on all
+but the last byte) and text as its varint length in bytes followed by its
+UTF-8 encoding.
+
+State vectors are encoded as the components that differ from the vector of
+the previous command encoded on the same stream: their number followed by
+pairs of user and difference, the latter zigzag encoded as it may be
+negative. Both sides of a stream start from the same base vector.
+
+On connections multiplexing several sessions, a message starts with a SESSION
+byte followed by the name of the session its commands are addressed to, as
+text. Each session is a stream of its own.
+"""
+
+from algorithm import Vector
+
+INSERT = 1
+DELETE = 2
+DELETE_SEGMENTS = 3
+UNDO = 4
+SESSION = 5
+
+_COMMAND_TYPES = {"insert": INSERT, "undo": UNDO}
+
+def _writeVarint(out, value):
+	while value > 0x7F:
+		out.append(value & 0x7F | 0x80)
+		value >>= 7
+	out.append(value)
+
+def _writeText(out, text):
+	if isinstance(text, unicode):
+		text = text.encode("utf-8")
+	_writeVarint(out, len(text))
+	out.extend(text)
+
+def addressMessage(name, data):
+	"""Addresses an encoded message to the named session."""
+	out = bytearray([SESSION])
+	_writeText(out, name)
+	return str(out) + data
+
+def splitAddress(data):
+	"""Returns the name of the session a message is addressed to, None if it
+	is not addressed, and the message without the address. Raises ValueError
+	if the address is malformed."""
+	if not data.startswith(chr(SESSION)):
+		return None, data
+	reader = CommandDecoder()
+	reader.data = bytearray(data)
+	reader.offset = 1
+	try:
+		name = reader.readText()
+	except IndexError:
+		raise ValueError("truncated address")
+	return name, data[reader.offset:]
+
+class CommandEncoder(object):
+	"""Encodes commands into binary messages. The encoder remembers the
+	vector of the last command it encoded, so all messages it produces have to
+	be decoded by a single CommandDecoder, in order."""
+
+	def __init__(self, base=None):
+		self.base = Vector(base)
+
+	def encode(self, commands):
+		"""Encodes a list of (command, args) tuples, which have the same
+		arguments as their JSON counterparts. The vector may also be given as
+		a Vector."""
+		out = bytearray()
+		for command, args in commands:
+			vector = args[1]
+			if not isinstance(vector, Vector):
+				vector = Vector(vector)
+
+			if command == "delete":
+				if isinstance(args[3], list):
+					out.append(DELETE_SEGMENTS)
+				else:
+					out.append(DELETE)
+			else:
+				out.append(_COMMAND_TYPES[command])
+			_writeVarint(out, int(args[0]))
+			self.encodeVector(out, vector)
+
+			if command == "insert":
+				_writeVarint(out, int(args[2]))
+				_writeText(out, args[3])
+			elif command == "delete":
+				_writeVarint(out, int(args[2]))
+				if isinstance(args[3], list):
+					_writeVarint(out, len(args[3]))
+					for user, text in args[3]:
+						_writeVarint(out, int(user))
+						_writeText(out, text)
+				else:
+					_writeVarint(out, int(args[3]))
+		return str(out)
+
+	def encodeVector(self, out, vector):
+		base = self.base.components
+		components = vector.components
+		changed = [(user, value - base.get(user, 0))
+			for user, value in components.items() if base.get(user, 0) != value]
+		changed.extend((user, -value)
+			for user, value in base.items() if value and user not in components)
+
+		_writeVarint(out, len(changed))
+		for user, delta in changed:
+			_writeVarint(out, user)
+			_writeVarint(out, delta << 1 if delta >= 0 else (-delta << 1) - 1)
+		self.base = Vector(vector)
+
+class CommandDecoder(object):
+	"""Decodes binary messages produced by a CommandEncoder."""
+
+	def __init__(self, base=None):
+		self.base = Vector(base)
+
+	def decode(self, data):
+		"""Returns the list of [command, args] pairs encoded in the given
+		message. Vectors are returned as Vector instances, text as unicode.
+		Raises ValueError if the message is malformed."""
+		self.data = bytearray(data)
+		self.offset = 0
+		commands = []
+		try:
+			while self.offset < len(self.data):
+				commandType = self.data[self.offset]
+				self.offset += 1
+				args = [self.readVarint(), self.decodeVector()]
+
+				if commandType == INSERT:
+					commands.append(["insert", args + [self.readVarint(), self.readText()]])
+				elif commandType == DELETE:
+					commands.append(["delete", args + [self.readVarint(), self.readVarint()]])
+				elif commandType == DELETE_SEGMENTS:
+					position = self.readVarint()
+					segments = [[self.readVarint(), self.readText()]
+						for i in xrange(self.readVarint())]
+					commands.append(["delete", args + [position, segments]])
+				elif commandType == UNDO:
+					commands.append(["undo", args])
+				else:
+					raise ValueError("unknown command type %d" % commandType)
+		except IndexError:
+			raise ValueError("truncated message")
+		finally:
+			self.data = None
+		return commands
+
+	def decodeVector(self):
+		components = dict(self.base.components)
+		for i in xrange(self.readVarint()):
+			user = self.readVarint()
+			delta = self.readVarint()
+			components[user] = components.get(user, 0) + (
+				delta >> 1 if not delta & 1 else -((delta + 1) >> 1))
+		self.base = Vector(components)
+		return self.base
+
+	def readVarint(self):
+		data = self.data
+		value = 0
+		shift = 0
+		while True:
+			byte = data[self.offset]
+			self.offset += 1
+			value |= (byte & 0x7F) << shift
+			if byte < 0x80:
+				return value
+			shift += 7
+
+	def readText(self):
+		length = self.readVarint()
+		end = self.offset + length
+		if end > len(self.data):
+			raise IndexError()
+		text = str(self.data[self.offset:end]).decode("utf-8")
+		self.offset = end
+		return text
@@ -0,0 +1,117 @@
+"""
+Structured logging of what the server does, like the commands it receives.
+Logging a record only appends it to a queue. A background thread formats the
+queued records as lines of JSON and writes them in batches, so a slow output
+never blocks the reactor.
+"""
+
+try:
+	import json
+except ImportError:
+	import simplejson as json
+
+import sys
+import threading
+import time
+
+from collections import deque
+from zlib import crc32
+
+try:
+	basestring
+except NameError:
+	basestring = str
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+LEVEL_NAMES = dict((level, name) for name, level in LEVELS.items())
+
+class EventLog(object):
+	"""Queues records and writes them from a thread of its own, started with
+	start. Records below the given level are skipped, and records about a
+	session below WARNING are only logged for the given share of sessions,
+	chosen by their name so all of a sampled session's records are logged.
+	Strings in records are truncated to maxLength characters, and records are
+	dropped while maxQueued of them are waiting to be written."""
+
+	# Seconds between writing the queued records.
+	FLUSH_INTERVAL = 0.1
+
+	def __init__(self, output=sys.stdout, level=INFO, sampleRate=1.0, maxLength=200, maxQueued=100000):
+		self.output = output
+		self.level = level
+		self.sampleRate = sampleRate
+		self.maxLength = maxLength
+		self.maxQueued = maxQueued
+
+		# Records logged and dropped so far.
+		self.logged = 0
+		self.dropped = 0
+
+		self.queue = deque()
+		self.thread = None
+		self.stopping = False
+
+	def sampled(self, session):
+		"""Returns whether records about the named session are logged."""
+		if self.sampleRate >= 1:
+			return True
+		return (crc32(session.encode("utf8")) & 0xffffffff) < self.sampleRate * 0x100000000
+
+	def log(self, level, event, **fields):
+		"""Logs a record of the given event, with the given fields."""
+		if level < self.level:
+			return
+		session = fields.get("session")
+		if session is not None and level < WARNING and not self.sampled(session):
+			return
+		if len(self.queue) >= self.maxQueued:
+			self.dropped += 1
+			return
+		self.logged += 1
+		self.queue.append((time.time(), level, event, fields))
+
+	def start(self):
+		self.thread = threading.Thread(target=self.run, name="EventLog")
+		self.thread.daemon = True
+		self.thread.start()
+
+	def stop(self):
+		"""Writes the records still queued and stops the thread."""
+		if self.thread is not None:
+			self.stopping = True
+			self.thread.join()
+			self.thread = None
+
+	def run(self):
+		while not self.stopping:
+			time.sleep(self.FLUSH_INTERVAL)
+			self.flush()
+		self.flush()
+
+	def flush(self):
+		lines = []
+		while self.queue:
+			lines.append(self.format(self.queue.popleft()))
+		if lines:
+			self.output.write("".join(lines))
+			self.output.flush()
+
+	def format(self, record):
+		created, level, event, fields = record
+		line = '{"time": %.3f, "level": "%s", "event": %s' % (created, LEVEL_NAMES[level], json.dumps(event))
+		if fields:
+			line += ", " + json.dumps(self.truncate(fields), sort_keys=True, default=repr)[1:-1]
+		return line + "}\n"
+
+	def truncate(self, value):
+		"""Returns the given value with long strings cut short."""
+		if isinstance(value, basestring):
+			if len(value) > self.maxLength:
+				return "%s... (%d characters)" % (value[:self.maxLength], len(value))
+			return value
+		elif isinstance(value, (list, tuple)):
+			return [self.truncate(item) for item in value]
+		elif isinstance(value, dict):
+			return dict((key, self.truncate(item)) for key, item in value.items())
+		return value
@@ -0,0 +1,85 @@
+"""
+Micro-benchmark for WebSocketFrameDecoder and RFC6455FrameDecoder.
+
+Feeds the decoders reads containing an increasing number of small frames and
+prints the throughput for each read size. The decoders handle every byte
+once, so the throughput should stay roughly the same as the number of frames
+per read grows.
+
+Usage: python framebench.py [frame size] [total frames]
+"""
+
+import struct
+import sys
+import time
+
+from websocket import WebSocketFrameDecoder, RFC6455FrameDecoder
+
+FRAMES_PER_READ = [1, 10, 100, 1000, 10000]
+
+class _Transport(object):
+	def loseConnection(self):
+		raise RuntimeError("decoder closed the connection")
+
+class _Request(object):
+	transport = _Transport()
+
+class _Handler(object):
+	def __init__(self):
+		self.frames = 0
+
+	def frameReceived(self, frame):
+		self.frames += 1
+
+	def frameLengthExceeded(self):
+		raise RuntimeError("frame length exceeded")
+
+def hixieFrame(frameSize):
+	return "\x00" + "x" * frameSize + "\xff"
+
+def rfc6455Frame(frameSize):
+	# A masked text frame, as sent by clients. The zero masking key keeps the
+	# payload readable.
+	if frameSize < 126:
+		header = struct.pack("!BB", 0x81, 0x80 | frameSize)
+	else:
+		header = struct.pack("!BBH", 0x81, 0x80 | 126, frameSize)
+	return header + "\x00" * 4 + "x" * frameSize
+
+DECODERS = [
+	("hixie", WebSocketFrameDecoder, hixieFrame, 2),
+	("rfc6455", RFC6455FrameDecoder, rfc6455Frame, 6),
+]
+
+def run(decoderClass, frame, totalFrames, framesPerRead):
+	"""Decodes totalFrames copies of frame, received in reads of framesPerRead
+	frames each. Returns the number of seconds taken and the number of frames
+	decoded."""
+	read = frame * framesPerRead
+	reads = max(1, totalFrames // framesPerRead)
+
+	handler = _Handler()
+	decoder = decoderClass(_Request(), handler)
+
+	start = time.time()
+	for i in xrange(reads):
+		decoder.dataReceived(read)
+	elapsed = time.time() - start
+
+	assert handler.frames == reads * framesPerRead
+	return elapsed, reads * framesPerRead
+
+def main(frameSize=32, totalFrames=200000):
+	for name, decoderClass, makeFrame, overhead in DECODERS:
+		print "%s: %d byte frames, %d frames per run" % (name, frameSize, totalFrames)
+		print "%15s %15s %15s" % ("frames/read", "frames/s", "MB/s")
+		for framesPerRead in FRAMES_PER_READ:
+			elapsed, frames = run(decoderClass, makeFrame(frameSize),
+				totalFrames, framesPerRead)
+			elapsed = max(elapsed, 1e-9)
+			print "%15d %15.0f %15.2f" % (framesPerRead, frames / elapsed,
+				frames * (frameSize + overhead) / elapsed / (1 << 20))
+		print
+
+if __name__ == "__main__":
+	main(*[int(arg) for arg in sys.argv[1:3]])
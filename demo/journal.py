@@ -0,0 +1,261 @@
+"""
+An append-only journal of records with checkpoints, stored in a directory.
+
+Records are numbered consecutively. A checkpoint captures everything up to a
+certain record, after which those records are removed from the journal, so
+reading a journal back only requires loading the latest checkpoint and the
+records following it.
+
+All disk writes happen in a thread, in the order they were issued. Records
+appended within FLUSH_DELAY seconds are written and synced to disk together.
+Writes that fail are tried again, before any issued later.
+"""
+
+import mmap
+import os
+
+from twisted.internet import defer, reactor, threads
+
+from eventlog import ERROR
+
+CHECKPOINT_FILE = "checkpoint"
+JOURNAL_FILE = "journal"
+
+class Journal(object):
+	# Records appended within this many seconds are written and synced with a
+	# single fsync call.
+	FLUSH_DELAY = 0.05
+
+	# Seconds after which writing is tried again when it failed.
+	RETRY_DELAY = 5
+
+	def __init__(self, path, sequence=0, eventLog=None):
+		"""Opens the journal in the given directory for appending. sequence is
+		the number of the last record already contained in it. Failed writes
+		are logged to the given EventLog."""
+		self.path = path
+		self.sequence = sequence
+		self.eventLog = eventLog
+
+		_trimPartialRecord(os.path.join(path, JOURNAL_FILE))
+
+		# Write operations waiting to be run, Deferreds waiting for them to be
+		# written and the pending call which will start writing them.
+		self.operations = []
+		self.waiting = []
+		self.flushCall = None
+
+		# Deferreds waiting for the write currently running in a thread, or
+		# None if there is none.
+		self.writing = None
+
+		# Whether the last write failed, so it may have left a partial record.
+		self.failed = False
+
+	def append(self, record):
+		"""Appends a record, which must not contain newlines. Returns its
+		number."""
+		self.sequence += 1
+		self._schedule(("append", "%d %s\n" % (self.sequence, record)))
+		return self.sequence
+
+	def checkpoint(self, data):
+		"""Stores data representing the state after the latest record. Records
+		up to and including it are discarded afterwards."""
+		self._schedule(("checkpoint", "%d\n%s" % (self.sequence, data)))
+
+	def _schedule(self, operation):
+		self.operations.append(operation)
+
+		if self.flushCall is None and self.writing is None:
+			self.flushCall = reactor.callLater(self.FLUSH_DELAY, self.flush)
+
+	def flush(self):
+		"""Writes all pending operations in a thread. Returns a Deferred firing
+		once they have been synced to disk, or failing if writing them failed;
+		they are written again later on."""
+		if self.flushCall is not None:
+			if self.flushCall.active():
+				self.flushCall.cancel()
+			self.flushCall = None
+
+		if not self.operations and self.writing is None:
+			return defer.succeed(None)
+
+		d = defer.Deferred()
+		self.waiting.append(d)
+
+		if self.writing is None:
+			# Otherwise, the operations are picked up once the current write
+			# is done.
+			self._startWrite()
+
+		return d
+
+	def _startWrite(self):
+		operations, self.operations = self.operations, []
+		self.writing, self.waiting = self.waiting, []
+
+		d = threads.deferToThread(self._write, operations, self.failed)
+		d.addCallbacks(self._written, self._writeFailed, errbackArgs=(operations,))
+
+	def _writeFailed(self, failure, operations):
+		"""Puts the operations back in front of those issued since, so they
+		are written again in order, and fails the Deferreds waiting for them."""
+		if self.eventLog is not None:
+			self.eventLog.log(ERROR, "journal_write_failed", path=self.path,
+				error=failure.getErrorMessage())
+
+		self.operations[:0] = operations
+		self.failed = True
+
+		waiting, self.writing = self.writing, None
+		for d in waiting:
+			d.errback(failure)
+
+		if self.flushCall is None:
+			self.flushCall = reactor.callLater(self.RETRY_DELAY, self._retry)
+
+	def _retry(self):
+		self.flushCall = None
+		if self.writing is None:
+			self._startWrite()
+
+	def _written(self, result):
+		self.failed = False
+
+		waiting, self.writing = self.writing, None
+		for d in waiting:
+			d.callback(None)
+
+		if self.operations or self.waiting:
+			self._startWrite()
+
+	def _write(self, operations, retry=False):
+		"""Runs the given operations in order. Called in a thread."""
+		# The directory is only created once there is something to write, so
+		# sessions that are never edited leave no traces.
+		if not operations:
+			return
+
+		journalPath = os.path.join(self.path, JOURNAL_FILE)
+		if not os.path.isdir(self.path):
+			os.makedirs(self.path)
+
+		# A failed write may have left part of a record, which the records
+		# written again must not be appended to. Records it did write
+		# completely are skipped as duplicates when reading.
+		if retry:
+			_trimPartialRecord(journalPath)
+
+		journal = open(journalPath, "ab")
+		try:
+			for kind, data in operations:
+				if kind == "append":
+					journal.write(data)
+				elif kind == "checkpoint":
+					# Records written so far have to be on disk before the
+					# checkpoint replaces them.
+					journal.flush()
+					os.fsync(journal.fileno())
+
+					self._writeCheckpoint(data)
+
+					# Records contained in the checkpoint are skipped when
+					# reading, so a crash at this point does no harm.
+					journal.truncate(0)
+
+			journal.flush()
+			os.fsync(journal.fileno())
+		finally:
+			journal.close()
+
+	def _writeCheckpoint(self, data):
+		checkpointPath = os.path.join(self.path, CHECKPOINT_FILE)
+
+		checkpoint = open(checkpointPath + ".tmp", "wb")
+		try:
+			checkpoint.write(data)
+			checkpoint.flush()
+			os.fsync(checkpoint.fileno())
+		finally:
+			checkpoint.close()
+
+		os.rename(checkpointPath + ".tmp", checkpointPath)
+
+def exists(path):
+	"""Returns whether there is a journal in the given directory."""
+	return os.path.exists(os.path.join(path, CHECKPOINT_FILE)) or \
+		os.path.exists(os.path.join(path, JOURNAL_FILE))
+
+def read(path):
+	"""Reads the journal in the given directory. Returns the data of the latest
+	checkpoint (or None), the number of the last record and a list of records
+	written after the checkpoint."""
+	checkpoint = None
+	sequence = 0
+
+	checkpointPath = os.path.join(path, CHECKPOINT_FILE)
+	if os.path.exists(checkpointPath):
+		f = open(checkpointPath, "rb")
+		try:
+			header = f.readline()
+			sequence = int(header)
+			checkpoint = f.read()
+		finally:
+			f.close()
+
+	records = []
+	for number, record in _readRecords(os.path.join(path, JOURNAL_FILE)):
+		# Records up to the checkpoint may remain if writing it was
+		# interrupted.
+		if number > sequence:
+			records.append(record)
+			sequence = number
+
+	return checkpoint, sequence, records
+
+def _readRecords(path):
+	"""Yields the number and contents of each record in a journal file. The file
+	is mapped into memory instead of being read at once, and a truncated last
+	record is ignored."""
+	if not os.path.exists(path) or os.path.getsize(path) == 0:
+		return
+
+	f = open(path, "rb")
+	try:
+		data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			offset = 0
+			while True:
+				end = data.find(b"\n", offset)
+				if end == -1:
+					break
+
+				separator = data.find(b" ", offset, end)
+				yield int(data[offset:separator]), data[separator + 1:end]
+				offset = end + 1
+		finally:
+			data.close()
+	finally:
+		f.close()
+
+def _trimPartialRecord(path):
+	"""Removes a record whose writing has been interrupted from the end of a
+	journal file, so following records are not appended to it."""
+	if not os.path.exists(path) or os.path.getsize(path) == 0:
+		return
+
+	f = open(path, "r+b")
+	try:
+		data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			end = data.rfind(b"\n") + 1
+			size = len(data)
+		finally:
+			data.close()
+
+		if end < size:
+			f.truncate(end)
+	finally:
+		f.close()
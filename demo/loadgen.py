@@ -0,0 +1,541 @@
+#!/usr/bin/env python3
+
+"""
+Load generator for the demo server (server.py or aioserver.py), for Python
+3.7 and above.
+
+It opens many simulated editors, which join sessions, synchronize and edit
+like editor.js does: each keeps a copy of the document, executes its own
+requests right away and the other users' requests as the server broadcasts
+them, and acknowledges the state it has reached every ACK_INTERVAL seconds.
+Two kinds of load are generated:
+
+* The scenarios in tests/sources are replayed, each in a session of its own
+  with one client per user, which also checks that the server arrives at the
+  expected document. Scenarios using redo are skipped, as the protocol has no
+  redo command.
+* Editors type into sessions at a given rate: mostly inserting text at their
+  cursor, sometimes deleting it again or undoing.
+
+Measured are the latency of each command from its sender to the other peers
+(by command), the time synchronizing takes against the length of the log, as
+well as the server's CPU time per edit and memory per session if its process
+ID is given. Results are written as JSON, and compared against the results of
+an earlier run if requested, failing if they got worse by more than the given
+tolerance:
+
+	python3 loadgen.py --pid 1234 --output results.json localhost:8080
+	python3 loadgen.py --pid 1234 --baseline results.json localhost:8080
+
+Run the load generator on another core than the server, and redirect the
+server's output to /dev/null, as it prints every command.
+"""
+
+import argparse
+import asyncio
+import glob
+import json
+import os
+import random
+import sys
+import time
+
+from xml.etree import ElementTree
+
+from algorithm import State, Buffer, Segment, Vector, DoRequest, UndoRequest, Insert, Delete
+from serialize import commandToRequest, segmentsToBuffer
+from wsclient import WebSocketClient
+
+# Seconds between acknowledgements, as in editor.js.
+ACK_INTERVAL = 1.0
+
+# Seconds after which a scenario the server does not finish counts as failed.
+SCENARIO_TIMEOUT = 10
+
+SOURCES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tests", "sources")
+
+WORDS = ("the quick brown fox jumps over a lazy dog while some collaborative "
+	"editors keep typing text into their shared document").split()
+
+class Metrics(object):
+	"""Collects the measurements of a run."""
+
+	def __init__(self):
+		# Times requests were sent at, by session, user and sequence number.
+		self.sent = {}
+		self.latencies = {}
+		self.syncs = []
+		self.edits = 0
+		self.resyncs = 0
+		self.throttles = 0
+
+	def requestSent(self, session, command, args):
+		user = int(args[0])
+		self.sent[session, user, Vector(args[1]).get(user)] = time.time()
+		self.edits += 1
+
+	def requestReceived(self, session, command, args):
+		user = int(args[0])
+		sent = self.sent.get((session, user, Vector(args[1]).get(user)))
+		if sent is not None:
+			self.latencies.setdefault(command, []).append(time.time() - sent)
+
+class Connection(WebSocketClient):
+	"""A client connected to a server's /transport, which dispatches the
+	commands it receives to commandReceived."""
+
+	def __init__(self, address, session, metrics):
+		host, port = address.rsplit(":", 1)
+		WebSocketClient.__init__(self, host, int(port))
+		self.session = session
+		self.metrics = metrics
+		self.uid = None
+		self.synchronizing = False
+		self.waiting = {}
+
+	async def connect(self):
+		"""Connects and joins the session."""
+		await WebSocketClient.connect(self)
+		joined = self.expect("assign_uid")
+		self.send([["join_session", [self.session]]])
+		self.uid = (await joined)[0]
+
+	def expect(self, command):
+		"""Returns a future resolving to the arguments of the next command of
+		the given kind."""
+		self.waiting[command] = asyncio.get_event_loop().create_future()
+		return self.waiting[command]
+
+	def send(self, commands):
+		for command, args in commands:
+			if command in ("insert", "delete", "undo"):
+				self.metrics.requestSent(self.session, command, args)
+
+		self.sendText(json.dumps(commands))
+
+	def messageReceived(self, data):
+		self.frameReceived(data)
+		for command, args in json.loads(data.decode("utf-8")):
+			if command in ("insert", "delete", "undo") and args[0] != self.uid and \
+				not self.synchronizing:
+				self.metrics.requestReceived(self.session, command, args)
+			self.commandReceived(command, args)
+			if command in self.waiting:
+				self.waiting.pop(command).set_result(args)
+
+	def frameReceived(self, data):
+		pass
+
+	def commandReceived(self, command, args):
+		pass
+
+class Editor(Connection):
+	"""A simulated editor keeping a copy of the document, like editor.js."""
+
+	def __init__(self, address, session, metrics):
+		Connection.__init__(self, address, session, metrics)
+		self.state = None
+		self.undoDepth = None
+		self.cursor = 0
+		self.ackCall = None
+		self.acked = None
+
+		# Whether the server told the editor to synchronize again, during which
+		# it does not type.
+		self.resyncing = False
+
+		# Requests and bytes received during the last synchronization.
+		self.syncEntries = 0
+		self.syncBytes = 0
+
+	async def synchronize(self):
+		"""Synchronizes the document, returning the time it took."""
+		started = time.time()
+		synchronized = self.expect("sync_end")
+		self.send([["sync", []]])
+		await synchronized
+		return time.time() - started
+
+	def frameReceived(self, data):
+		if self.synchronizing:
+			self.syncBytes += len(data)
+
+	def commandReceived(self, command, args):
+		if command == "assign_uid":
+			self.undoDepth = args[1]
+		elif command == "sync_begin":
+			self.synchronizing = True
+			self.syncEntries = 0
+			self.syncBytes = 0
+		elif command == "sync_snapshot":
+			self.state = State(segmentsToBuffer(args[0]), Vector(args[1]))
+		elif command == "sync_end":
+			self.synchronizing = False
+			self.resyncing = False
+			self.acked = self.state.vector.toString()
+		elif command == "resync":
+			self.metrics.resyncs += 1
+			self.resyncing = True
+			self.send([["sync", []]])
+		elif command == "throttle":
+			# The server defers what we sent, which shows in the latencies.
+			self.metrics.throttles += 1
+		elif command in ("insert", "delete", "undo") and self.state is not None:
+			# Requests broadcast before synchronizing are part of the snapshot.
+			request = commandToRequest(command, args)
+			if self.synchronizing:
+				self.state.log.append(request)
+				self.syncEntries += 1
+			elif request.user != self.uid:
+				self.state.execute(request)
+				self.scheduleAck()
+
+	def scheduleAck(self):
+		if self.ackCall is None:
+			self.ackCall = asyncio.get_event_loop().call_later(ACK_INTERVAL, self.ack)
+
+	def ack(self):
+		self.ackCall = None
+		vector = self.state.vector.toString()
+		if vector != self.acked:
+			self.acked = vector
+			self.send([["ack", [vector]]])
+
+	def close(self):
+		if self.ackCall is not None:
+			self.ackCall.cancel()
+		Connection.close(self)
+
+	def insert(self, position, text):
+		request = DoRequest(self.uid, Vector(self.state.vector), Insert(position, Buffer([Segment(self.uid, text)])))
+		self.send([["insert", [self.uid, request.vector.toString(), position, text]]])
+		self.state.execute(request)
+
+	def delete(self, position, length):
+		request = DoRequest(self.uid, Vector(self.state.vector), Delete(position, length))
+		self.send([["delete", [self.uid, request.vector.toString(), position, length]]])
+		self.state.execute(request)
+
+	def undo(self):
+		"""Undoes the editor's last request, if the server still keeps it."""
+		request = UndoRequest(self.uid, Vector(self.state.vector))
+		if not self.state.canExecute(request):
+			return False
+		associated = request.associatedRequest(self.state.log)
+		if self.undoDepth is not None and associated.vector.get(self.uid) < \
+			self.state.vector.get(self.uid) - self.undoDepth:
+			return False
+		self.send([["undo", [self.uid, request.vector.toString()]]])
+		self.state.execute(request)
+		return True
+
+	async def type(self, keystrokes, interval):
+		"""Types the given number of keystrokes, waiting for an exponentially
+		distributed time with the given mean between them. Most keystrokes
+		insert a character at the cursor, some delete the one before it."""
+		self.cursor = random.randint(0, self.state.buffer.getLength())
+		characters = typedText()
+		for index in range(keystrokes):
+			await asyncio.sleep(random.expovariate(1.0 / interval))
+			if self.resyncing:
+				continue
+
+			self.cursor = min(self.cursor, self.state.buffer.getLength())
+			choice = random.random()
+			if choice < 0.02 and self.undo():
+				continue
+			if choice < 0.12 and self.cursor > 0:
+				self.cursor -= 1
+				self.delete(self.cursor, 1)
+			else:
+				self.insert(self.cursor, next(characters))
+				self.cursor += 1
+
+def typedText():
+	"""Yields the characters of random words, with spaces and line breaks
+	between them."""
+	while True:
+		for character in random.choice(WORDS) + random.choice("     \n"):
+			yield character
+
+async def createSession(address, name):
+	host, port = address.rsplit(":", 1)
+	reader, writer = await asyncio.open_connection(host, int(port))
+	writer.write(("GET /session/%s HTTP/1.1\r\nHost: %s\r\nConnection: close\r\n\r\n"
+		% (name, address)).encode("ascii"))
+	await reader.read()
+	writer.close()
+
+def newSessionName(prefix):
+	return prefix + os.urandom(4).hex()
+
+async def probeSync(address, session, metrics):
+	"""Synchronizes a new editor with the session and records how long it
+	took along with the length of the log. Returns the editor's document."""
+	editor = Editor(address, session, metrics)
+	await editor.connect()
+	seconds = await editor.synchronize()
+	metrics.syncs.append({"entries": editor.syncEntries, "bytes": editor.syncBytes, "seconds": seconds})
+	editor.close()
+	return editor.state.buffer.toString()
+
+def loadScenario(path):
+	"""Reads a scenario from tests/sources. Returns the initial and final text
+	and the requests as (user, time, command, args) tuples, or None if it
+	cannot be replayed."""
+	root = ElementTree.parse(path).getroot()
+	if root.find("request/redo") is not None:
+		return None
+
+	def text(element):
+		return "".join(segment.text or "" for segment in element.findall("segment"))
+
+	requests = []
+	for element in root.findall("request"):
+		operation = element[0]
+		if operation.tag == "insert":
+			args = [int(operation.get("pos")), operation.text or ""]
+		elif operation.tag == "delete":
+			length = operation.get("len")
+			args = [int(operation.get("pos")), int(length) if length is not None else len(text(operation))]
+		else:
+			args = []
+		requests.append((int(element.get("user")), element.get("time"), operation.tag, args))
+	return text(root.find("initial-buffer")), text(root.find("final-buffer")), requests
+
+async def replayScenario(address, scenario, metrics):
+	"""Replays a scenario with one client per user, sending each request once
+	the previous one has been broadcast. The initial text is inserted by a
+	client of its own. Returns the text the server arrived at."""
+	initial, final, requests = scenario
+	session = newSessionName("scenario")
+	await createSession(address, session)
+
+	users = sorted(set(user for user, vector, command, args in requests))
+	clients = dict((user, Connection(address, session, metrics)) for user in [0] + users)
+	uids = {}
+
+	async def issue(user, vector, command, args):
+		echoed = clients[user].expect(command)
+		clients[user].send([[command, [uids[user], vector.toString()] + args]])
+		await echoed
+
+	try:
+		for user, client in clients.items():
+			await client.connect()
+			uids[user] = client.uid
+
+		# As in tests/test-helper.js, the time of a request is added to the
+		# vector of its user, which counts the user's own requests as well.
+		# The initial text is known to everyone.
+		vectors = dict((user, {}) for user in users)
+		if initial:
+			await issue(0, Vector(), "insert", [0, initial])
+			for user in users:
+				vectors[user][uids[0]] = 1
+		for user, time, command, args in requests:
+			components = vectors[user]
+			for component, count in Vector(time).components.items():
+				components[uids[component]] = components.get(uids[component], 0) + count
+			await issue(user, Vector(components), command, args)
+			components[uids[user]] = components.get(uids[user], 0) + 1
+
+		return await probeSync(address, session, metrics)
+	finally:
+		for user in uids:
+			clients[user].close()
+
+async def typeIntoSessions(address, options, metrics):
+	"""Lets editors type into new sessions, probing synchronization regularly.
+	Returns whether all editors ended up with the server's document."""
+	sessions = [newSessionName("load") for index in range(options.sessions)]
+	for session in sessions:
+		await createSession(address, session)
+
+	editors = []
+	for session in sessions:
+		for index in range(options.peers):
+			editor = Editor(address, session, metrics)
+			await editor.connect()
+			await editor.synchronize()
+			editors.append(editor)
+
+	typing = [asyncio.ensure_future(editor.type(options.keystrokes, options.interval))
+		for editor in editors]
+	try:
+		pending = typing
+		while pending:
+			done, pending = await asyncio.wait(pending, timeout=options.probe_interval)
+			await asyncio.gather(*[probeSync(address, session, metrics) for session in sessions])
+	finally:
+		for task in typing:
+			task.cancel()
+	for task in typing:
+		task.result()
+
+	# Wait for the last broadcasts before comparing documents.
+	await asyncio.sleep(1)
+	converged = True
+	for session in sessions:
+		text = await probeSync(address, session, metrics)
+		converged &= all(editor.state.buffer.toString() == text
+			for editor in editors if editor.session == session)
+	for editor in editors:
+		editor.close()
+	return converged
+
+def processStatistics(pid):
+	"""Returns the CPU time used by the given process in seconds and its
+	resident memory in bytes, read from /proc."""
+	with open("/proc/%d/stat" % pid) as f:
+		fields = f.read().rsplit(")", 1)[1].split()
+	cpu = (int(fields[11]) + int(fields[12])) / float(os.sysconf("SC_CLK_TCK"))
+	with open("/proc/%d/status" % pid) as f:
+		for line in f:
+			if line.startswith("VmRSS:"):
+				return cpu, int(line.split()[1]) * 1024
+	return cpu, None
+
+def percentiles(values):
+	values = sorted(values)
+	if not values:
+		return None
+	def at(fraction):
+		return 1000 * values[min(len(values) - 1, int(len(values) * fraction))]
+	return {"count": len(values), "p50": at(0.5), "p90": at(0.9), "p99": at(0.99), "max": at(1)}
+
+def slope(points):
+	"""Returns the slope of the least squares line through the given points,
+	or None if there are not enough distinct points."""
+	if len(set(x for x, y in points)) < 2:
+		return None
+	meanX = sum(x for x, y in points) / float(len(points))
+	meanY = sum(y for x, y in points) / float(len(points))
+	return sum((x - meanX) * (y - meanY) for x, y in points) / \
+		sum((x - meanX) ** 2 for x, y in points)
+
+# Metrics compared against a baseline, all of which get worse as they grow.
+COMPARED = [
+	("fanout", "all", "p99"),
+	("sync", "secondsPer1000Entries"),
+	("server", "cpuPerEditMs"),
+	("server", "memoryPerSession"),
+]
+
+def lookup(results, path):
+	for key in path:
+		if not isinstance(results, dict):
+			return None
+		results = results.get(key)
+	return results
+
+def compare(results, baseline, tolerance):
+	"""Returns the regressions of the results against the baseline."""
+	regressions = []
+	for path in COMPARED:
+		old = lookup(baseline, path)
+		new = lookup(results, path)
+		if old and new is not None and new > old * (1 + tolerance):
+			regressions.append("%s: %.3f -> %.3f" % (".".join(path), old, new))
+	return regressions
+
+async def run(options):
+	address = options.address
+	metrics = Metrics()
+	results = {"options": vars(options)}
+
+	scenarios = {"passed": [], "failed": [], "skipped": []}
+	for path in sorted(glob.glob(os.path.join(SOURCES, "*.xml")))[:options.scenarios]:
+		name = os.path.basename(path)
+		scenario = loadScenario(path)
+		if scenario is None:
+			scenarios["skipped"].append(name)
+			continue
+		try:
+			text = await asyncio.wait_for(replayScenario(address, scenario, metrics), SCENARIO_TIMEOUT)
+		except asyncio.TimeoutError:
+			text = None
+		if text == scenario[1]:
+			scenarios["passed"].append(name)
+		else:
+			scenarios["failed"].append(name)
+	results["scenarios"] = scenarios
+
+	before = processStatistics(options.pid) if options.pid else None
+	metrics.edits = 0
+	started = time.time()
+	results["converged"] = await typeIntoSessions(address, options, metrics)
+	results["duration"] = time.time() - started
+	results["edits"] = metrics.edits
+	results["resyncs"] = metrics.resyncs
+	results["throttles"] = metrics.throttles
+
+	results["server"] = {"cpuPerEditMs": None, "memoryPerSession": None, "rss": None}
+	if options.pid:
+		after = processStatistics(options.pid)
+		results["server"] = {
+			"cpuPerEditMs": 1000 * (after[0] - before[0]) / max(1, metrics.edits),
+			"memoryPerSession": (after[1] - before[1]) / float(max(1, options.sessions)),
+			"rss": after[1],
+		}
+
+	fanout = dict((command, percentiles(latencies)) for command, latencies in metrics.latencies.items())
+	fanout["all"] = percentiles([latency for latencies in metrics.latencies.values() for latency in latencies])
+	results["fanout"] = fanout
+
+	perEntry = slope([(sync["entries"], sync["seconds"]) for sync in metrics.syncs])
+	results["sync"] = {
+		"probes": metrics.syncs,
+		"secondsPer1000Entries": perEntry * 1000 if perEntry is not None else None,
+	}
+	return results
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n")[0])
+	parser.add_argument("address", metavar="host:port")
+	parser.add_argument("-s", "--sessions", type=int, default=5, help="sessions to type into")
+	parser.add_argument("-p", "--peers", type=int, default=3, help="editors per session")
+	parser.add_argument("-k", "--keystrokes", type=int, default=200, help="keystrokes per editor")
+	parser.add_argument("-i", "--interval", type=float, default=0.3,
+		help="mean seconds between keystrokes")
+	parser.add_argument("--probe-interval", type=float, default=5,
+		help="seconds between synchronization probes")
+	parser.add_argument("--scenarios", type=int, default=None,
+		help="number of scenarios from tests/sources to replay (default: all)")
+	parser.add_argument("--pid", type=int, help="process ID of the server")
+	parser.add_argument("-o", "--output", help="file to write the results to")
+	parser.add_argument("--baseline", help="results of an earlier run to compare with")
+	parser.add_argument("--tolerance", type=float, default=0.25,
+		help="fraction by which results may be worse than the baseline")
+	parser.add_argument("--timeout", type=float, default=600,
+		help="seconds after which to give up on a server that does not keep up")
+	options = parser.parse_args()
+
+	try:
+		results = asyncio.run(asyncio.wait_for(run(options), options.timeout))
+	except asyncio.TimeoutError:
+		print("the run did not finish within %g seconds" % options.timeout, file=sys.stderr)
+		sys.exit(1)
+
+	output = json.dumps(results, indent=1, sort_keys=True)
+	if options.output:
+		with open(options.output, "w") as f:
+			f.write(output + "\n")
+	else:
+		print(output)
+
+	failed = bool(results["scenarios"]["failed"]) or not results["converged"]
+	if results["scenarios"]["failed"]:
+		print("scenarios failed:", " ".join(results["scenarios"]["failed"]), file=sys.stderr)
+	if not results["converged"]:
+		print("editors did not converge", file=sys.stderr)
+	if options.baseline:
+		with open(options.baseline) as f:
+			regressions = compare(results, json.load(f), options.tolerance)
+		for regression in regressions:
+			print("regression:", regression, file=sys.stderr)
+		failed |= bool(regressions)
+	sys.exit(failed and 1 or 0)
+
+if __name__ == "__main__":
+	main()
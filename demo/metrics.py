@@ -0,0 +1,98 @@
+"""
+Counters and histograms the server exposes at /metrics, in the text format
+read by Prometheus <http://prometheus.io/docs/instrumenting/exposition_formats/>
+and easily by anything else.
+"""
+
+import math
+
+from bisect import bisect_left
+
+class Histogram(object):
+	"""Counts observed values in buckets by their upper bounds, along with the
+	number and sum of all values."""
+
+	# Upper bounds of the buckets in seconds, for durations from well below a
+	# millisecond up to stalls of the reactor.
+	BOUNDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+		0.1, 0.25, 0.5, 1.0, 2.5)
+
+	def __init__(self, bounds=BOUNDS):
+		self.bounds = bounds
+		self.buckets = [0] * len(bounds)
+		self.count = 0
+		self.sum = 0.0
+
+	def observe(self, value):
+		self.count += 1
+		self.sum += value
+		index = bisect_left(self.bounds, value)
+		if index < len(self.buckets):
+			self.buckets[index] += 1
+
+class Meter(object):
+	"""Counts events and their rate per second, averaged exponentially over
+	about a minute like the load average. tick has to be called every
+	TICK_INTERVAL seconds."""
+
+	TICK_INTERVAL = 5
+	ALPHA = 1 - math.exp(-TICK_INTERVAL / 60.0)
+
+	def __init__(self):
+		self.count = 0
+		self.rate = 0.0
+		self.uncounted = 0
+
+	def mark(self, count=1):
+		self.count += count
+		self.uncounted += count
+
+	def tick(self):
+		self.rate += self.ALPHA * (float(self.uncounted) / self.TICK_INTERVAL - self.rate)
+		self.uncounted = 0
+
+def _labels(labels):
+	if not labels:
+		return ""
+	return "{%s}" % ",".join('%s="%s"' % (name, unicode(value).replace("\\", "\\\\")
+		.replace('"', '\\"').replace("\n", "\\n").encode("utf8"))
+		for name, value in sorted(labels.items()))
+
+def _value(value):
+	return repr(value) if isinstance(value, float) else str(value)
+
+class Exposition(object):
+	"""Collects metrics and formats them as text."""
+
+	def __init__(self):
+		self.lines = []
+
+	def add(self, name, kind, help, samples):
+		"""Adds a counter or gauge with the given samples, (labels, value)
+		tuples or a single value."""
+		if not isinstance(samples, list):
+			samples = [({}, samples)]
+		self.lines.append("# HELP %s %s" % (name, help))
+		self.lines.append("# TYPE %s %s" % (name, kind))
+		for labels, value in samples:
+			self.lines.append("%s%s %s" % (name, _labels(labels), _value(value)))
+
+	def addHistogram(self, name, help, histograms):
+		"""Adds a histogram, or several ones given as (labels, histogram)
+		tuples."""
+		if not isinstance(histograms, list):
+			histograms = [({}, histograms)]
+		self.lines.append("# HELP %s %s" % (name, help))
+		self.lines.append("# TYPE %s histogram" % name)
+		for labels, histogram in histograms:
+			cumulative = 0
+			for bound, count in zip(histogram.bounds, histogram.buckets):
+				cumulative += count
+				bucketLabels = dict(labels, le=_value(float(bound)))
+				self.lines.append("%s_bucket%s %d" % (name, _labels(bucketLabels), cumulative))
+			self.lines.append("%s_bucket%s %d" % (name, _labels(dict(labels, le="+Inf")), histogram.count))
+			self.lines.append("%s_sum%s %s" % (name, _labels(labels), _value(histogram.sum)))
+			self.lines.append("%s_count%s %d" % (name, _labels(labels), histogram.count))
+
+	def text(self):
+		return "\n".join(self.lines) + "\n"
@@ -0,0 +1,34 @@
+"""
+Token buckets limiting the rate at which peers and sessions may send commands
+and bytes to the server.
+"""
+
+import time
+
+class TokenBucket(object):
+	"""Allows rate units per second on average and bursts of up to burst
+	units. Taking more units than the bucket holds is allowed once it is full,
+	so amounts larger than a burst are not refused for good; the bucket then
+	takes correspondingly longer to fill up again."""
+
+	def __init__(self, rate, burst):
+		self.rate = float(rate)
+		self.burst = burst
+		self.tokens = float(burst)
+		self.updated = time.time()
+
+	def refill(self, now):
+		self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+
+	def wait(self, amount, now):
+		"""Returns the number of seconds until the given amount may be taken,
+		0 if it may be taken now."""
+		self.refill(now)
+		missing = min(amount, self.burst) - self.tokens
+		if missing <= 0:
+			return 0
+		return missing / self.rate
+
+	def take(self, amount):
+		self.tokens -= amount
@@ -0,0 +1,153 @@
+"""
+Conversion between requests and the commands exchanged with clients, shared
+by server.py and aioserver.py. This module runs on Python 2 and 3.
+"""
+
+try:
+	import json
+except ImportError:
+	import simplejson as json
+
+from algorithm import Buffer, Segment, Vector, DoRequest, UndoRequest, Insert, Delete, toCodeUnits
+
+def commandToRequest(command, args):
+	"""Creates a request object out of an insert, delete or undo command as it
+	is sent by the clients or stored in the log."""
+	user = int(args[0])
+	vector = Vector(args[1])
+
+	if command == "insert":
+		text = Buffer([Segment(user, toCodeUnits(args[3]))])
+		return DoRequest(user, vector, Insert(int(args[2]), text))
+	elif command == "delete":
+		if isinstance(args[3], list):
+			what = segmentsToBuffer(args[3])
+		else:
+			what = int(args[3])
+		return DoRequest(user, vector, Delete(int(args[2]), what))
+	elif command == "undo":
+		return UndoRequest(user, vector)
+
+def requestToCommand(request):
+	"""Serializes a request from a State's log into a command. Delete requests
+	in the log are reversible, so instead of a length they carry the removed
+	segments, which clients need for undoing them later on."""
+	args = [request.user, request.vector.toString()]
+
+	if isinstance(request, UndoRequest):
+		return "undo", args
+
+	operation = request.operation
+	if isinstance(operation, Insert):
+		return "insert", args + [operation.position, operation.text.toString()]
+	else:
+		return "delete", args + [operation.position, bufferToSegments(operation.what)]
+
+def bufferToSegments(buffer):
+	return [[segment.user, segment.text] for segment in buffer.segments]
+
+def segmentsToBuffer(segments):
+	return Buffer([Segment(int(user), toCodeUnits(text)) for user, text in segments])
+
+def encodeJSON(value):
+	"""Encodes a value as JSON. Commands decoded from binary frames carry
+	Vector instances, which are encoded as strings."""
+	return json.dumps(value, default=_encodeVector)
+
+def _encodeVector(value):
+	if isinstance(value, Vector):
+		return value.toString()
+	raise TypeError("%r is not JSON serializable" % (value,))
+
+def encodeCommands(commands):
+	"""Encodes a list of (command, args) tuples into the payload of a frame."""
+	return encodeJSON(commands)
+
+def addressFrame(name, frame):
+	"""Addresses the commands in the payload of a frame to the named session,
+	for connections multiplexing several sessions."""
+	address = encodeJSON(["session", [name]])
+	if frame == "[]":
+		return "[%s]" % address
+	return "[%s,%s" % (address, frame[1:])
+
+def splitAddressed(commands):
+	"""Splits the commands received in a frame into (name, commands) tuples
+	by the session they are addressed to. A ["session", [name]] command
+	addresses the commands after it; those before any are addressed to None,
+	the session joined without an address."""
+	groups = []
+	name = None
+	addressed = []
+	for command in commands:
+		if command[0] == "session":
+			if addressed:
+				groups.append((name, addressed))
+			name = command[1][0]
+			addressed = []
+		else:
+			addressed.append(command)
+	if addressed:
+		groups.append((name, addressed))
+	return groups
+
+class LogChunk(object):
+	"""A consecutive part of a session's log along with its encoded commands."""
+	def __init__(self):
+		self.requests = []
+		self.commands = []
+		self.frame = None
+
+	def append(self, request, command):
+		self.requests.append(request)
+		self.commands.append(command)
+		self.frame = None
+
+	def encode(self):
+		"""Returns a frame containing all commands of this chunk. It is cached
+		until the chunk changes."""
+		if self.frame is None:
+			self.frame = "[%s]" % ",".join(self.commands)
+		return self.frame
+
+class EncodedLog(object):
+	"""Mirrors a State's log as encoded commands, split into chunks of a fixed
+	size. Joining clients receive the log as one frame per chunk, so it neither
+	has to be encoded again nor written request by request."""
+	CHUNK_SIZE = 512
+
+	def __init__(self):
+		self.chunks = []
+
+		# Total length of all encoded commands.
+		self.size = 0
+
+	def append(self, request):
+		if not self.chunks or len(self.chunks[-1].requests) >= self.CHUNK_SIZE:
+			self.chunks.append(LogChunk())
+
+		command = json.dumps(requestToCommand(request))
+		self.chunks[-1].append(request, command)
+		self.size += len(command)
+
+	def retain(self, log):
+		"""Drops all requests that are not contained in the given log anymore.
+		Only chunks that actually lose requests are rebuilt."""
+		retained = set(id(request) for request in log)
+
+		chunks = []
+		for chunk in self.chunks:
+			if len([r for r in chunk.requests if id(r) in retained]) < len(chunk.requests):
+				rebuilt = LogChunk()
+				for request, command in zip(chunk.requests, chunk.commands):
+					if id(request) in retained:
+						rebuilt.append(request, command)
+				chunk = rebuilt
+
+			if chunk.requests:
+				chunks.append(chunk)
+		self.chunks = chunks
+		self.size = sum(len(command) for chunk in chunks for command in chunk.commands)
+
+	def frames(self):
+		return [chunk.encode() for chunk in self.chunks]
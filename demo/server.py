@@ -3,126 +3,1355 @@
 
 PORT = 8080
 
+# Number of worker processes sessions are spread over. With more than one, a
+# supervisor process starts the workers and each session is owned by one of
+# them (see shard.py).
+WORKERS = 1
+
+# Several servers (nodes) can host peers of the same session. Each session is
+# owned by one of the nodes listed in NODES, which orders its log, while the
+# others replicate it through a broker (see broker.py): None for a single
+# server, "local" for one within this process or the path of the socket of a
+# hub started with "python broker.py <path>". NODE names this server, and all
+# nodes have to be configured with the same NODES and WORKERS.
+BROKER = None
+NODE = "a"
+NODES = ["a"]
+
+# Sessions are journaled to disk in this directory, so they survive restarts.
+# Set to None to keep sessions in memory only.
+JOURNAL_DIR = "sessions"
+
+# Commands received and other events are logged to the console as lines of
+# JSON (see eventlog.py). Records below LOG_LEVEL ("debug", "info", "warning"
+# or "error") are skipped, commands are logged for a LOG_SAMPLE_RATE share of
+# sessions only, and longer strings are cut to LOG_MAX_LENGTH characters.
+LOG_LEVEL = "info"
+LOG_SAMPLE_RATE = 1.0
+LOG_MAX_LENGTH = 200
+
 try:
 	import json
 except ImportError:
 	import simplejson as json
 
+import os
+import socket
+import sys
+import time
 import urllib
 
 from binascii import hexlify
+from collections import OrderedDict, deque
 from random import getrandbits
 from struct import pack
 
-from twisted.web import server, resource, static, error
-from twisted.internet import reactor
+from twisted.web import server, resource
+from twisted.internet import reactor, defer, task
 from websocket import WebSocketSite, WebSocketHandler
+from journal import Journal
+from codec import CommandEncoder, CommandDecoder, addressMessage, splitAddress
+from metrics import Histogram, Meter, Exposition
+from eventlog import EventLog, LEVELS, INFO, WARNING
+from ratelimit import TokenBucket
+import assets
+import journal
+import shard as sharding
+from broker import InProcessBroker, SocketBroker
+from serialize import commandToRequest, bufferToSegments, segmentsToBuffer, \
+	encodeJSON, encodeCommands, addressFrame, splitAddressed, EncodedLog
+from algorithm import State, Vector
+
+# The sessions owned by this process when running as one of several workers, or
+# None if this process handles all sessions.
+shard = None
+
+# The broker connecting this node to the others, or None, and the ring
+# assigning sessions to nodes.
+broker = None
+nodeRing = sharding.HashRing(NODES)
+
+# The static files, read once and served from memory (see StaticResource).
+staticAssets = assets.load()
+
+# Where this process logs to, written by a thread started along with the server.
+eventLog = EventLog(sys.stdout, LEVELS[LOG_LEVEL], LOG_SAMPLE_RATE, LOG_MAX_LENGTH)
+
+def localNode():
+	"""Returns the name other nodes send messages for this process to."""
+	if shard is None:
+		return NODE
+	return "%s/%d" % (NODE, shard.index)
+
+def sessionOwner(name):
+	"""Returns the name of the node owning the named session."""
+	node = nodeRing.owner(name)
+	if shard is None:
+		return node
+	return "%s/%d" % (node, shard.ring.owner(name))
+
+def sendToNode(node, kind, name, *args):
+	"""Sends a message about the named session to the given node."""
+	broker.publish("node/" + node, encodeJSON([kind, name, localNode()] + list(args)))
+
+class Peer(object):
+	"""A connection's membership in a session, with a user ID of its own.
+	Connections may join any number of sessions by addressing their commands
+	to them (see splitAddressed in serialize.py), and one without addressing
+	it, as clients not multiplexing sessions do."""
+
+	def __init__(self, handler, channel):
+		self.handler = handler
+		self.transport = handler.transport
+
+		# The name of the session commands from and to the peer are addressed
+		# to, or None if they are not addressed.
+		self.channel = channel
+
+		self.uid = None
+		self.session = None
+
+		# The state vector this peer has acknowledged to have reached. It is None
+		# until the peer has been synchronized.
+		self.acked = None
+
+		# Whether the peer fell behind reading broadcasts and has been told to
+		# synchronize again. Broadcasts are not sent to it until it does.
+		self.resyncing = False
+
+		# The codec used for insert, delete and undo commands, "binary" or None
+		# for JSON, and the decoder for binary commands from this peer.
+		self.codec = None
+		self.decoder = None
+
+	def postCommand(self, command, args=[]):
+		frame = encodeCommands([[command, args]])
+		if self.channel is not None:
+			frame = addressFrame(self.channel, frame)
+		self.transport.write(frame)
+
+	def postFrames(self, frames):
+		if self.channel is not None:
+			frames = [addressFrame(self.channel, frame) for frame in frames]
+		self.transport.writeSequence(frames)
+
+	def isSynchronized(self):
+		return self.acked is not None
 
 class TransportHandler(WebSocketHandler):
+	# Commands and bytes a peer may send per second on average, and in a burst.
+	# Frames beyond that are deferred, without reading from the connection
+	# meanwhile, until the peer and its session are within their limits again
+	# (see SessionResource for the latter). Peers with more than MAX_DEFERRED
+	# commands waiting are disconnected.
+	COMMAND_RATE = 100
+	COMMAND_BURST = 500
+	BYTE_RATE = 64 * 1024
+	BYTE_BURST = 256 * 1024
+	MAX_DEFERRED = 1000
+
+	# How many sessions may be joined from one address at the same time.
+	MAX_SESSIONS_PER_ADDRESS = 50
+
+	# Sessions joined from each address, by all handlers of this process.
+	addresses = {}
+
 	def __init__(self, transport):
 		WebSocketHandler.__init__(self, transport)
 
-		self.uid = None
-		self.session = None
+		# The sessions joined through this connection, as Peers by the name
+		# their commands are addressed by, None for the session joined without.
+		self.peers = {}
+
+		# The client's address, or None for clients relayed from another worker,
+		# which counts their sessions itself, and the number of sessions joined
+		# through this connection counted for the address.
+		self.address = None
+		if hasattr(transport, "getPeer"):
+			self.address = transport.getPeer().host
+		self.counted = 0
+
+		# The buckets limiting the commands and bytes received from the peer,
+		# the frames deferred for exceeding them as (channel, commands, size)
+		# tuples with the number of commands they hold, and the pending call
+		# processing them.
+		self.commandBucket = TokenBucket(self.COMMAND_RATE, self.COMMAND_BURST)
+		self.byteBucket = TokenBucket(self.BYTE_RATE, self.BYTE_BURST)
+		self.deferred = deque()
+		self.deferredCommands = 0
+		self.admitCall = None
+
+		# Whether the peer is being disconnected for exceeding its limits.
+		self.rejected = False
+
+		# When joining a session owned by another worker without addressing it,
+		# all frames are relayed to the owner through this RelayClientFactory.
+		# Addressed sessions owned by other workers are relayed through one of
+		# their own each, by their name.
+		self.relay = None
+		self.relays = {}
+
+		MetricsResource.transports.add(transport)
 	
 	def frameReceived(self, frame):
+		if self.relay is not None:
+			self.relay.forward("t", frame)
+			return
+
 		# Decode JSON data contained in the frame, which is an array of commands.
-		commands = json.loads(unicode(frame, "utf8"))		
-		
+		commands = json.loads(unicode(frame, "utf8"))
+
+		if shard is not None and commands and commands[0][0] == "join_session" and \
+			not self.peers and not shard.owns(commands[0][1][0]):
+			# Another worker owns the session, so hand the connection over to it.
+			if not self.countAddress():
+				return
+			self.relay = shard.relay(self, commands[0][1][0],
+				hasattr(self.transport, "writeBinary"), frame)
+			return
+
+		# Commands addressed to different sessions are admitted separately,
+		# taking their share of the frame's size.
+		groups = splitAddressed(commands)
+		total = sum(len(addressed) for channel, addressed in groups)
+		for channel, addressed in groups:
+			if channel is not None and shard is not None and not shard.owns(channel):
+				if len(groups) > 1:
+					self.relayCommands(channel, addressed,
+						encodeCommands([["session", [channel]]] + addressed))
+				else:
+					self.relayCommands(channel, addressed, frame)
+			else:
+				self.admit(channel, addressed, len(frame) * len(addressed) // total)
+
+	def binaryFrameReceived(self, data):
+		if self.relay is not None:
+			self.relay.forward("b", data)
+			return
+
+		# Binary frames contain insert, delete and undo commands encoded with the
+		# codec negotiated when joining, addressed to a session if the client
+		# joined it that way.
+		try:
+			channel, message = splitAddress(data)
+		except ValueError, e:
+			eventLog.log(WARNING, "invalid_binary_frame", address=self.address, error=str(e))
+			self.transport.loseConnection()
+			return
+		if channel in self.relays:
+			self.relays[channel].forward("b", data)
+			return
+
+		peer = self.peers.get(channel)
+		if peer is None or peer.decoder is None:
+			eventLog.log(WARNING, "binary_not_negotiated", address=self.address)
+			return
+		try:
+			commands = peer.decoder.decode(message)
+		except ValueError, e:
+			eventLog.log(WARNING, "invalid_binary_frame", address=self.address, error=str(e))
+			self.transport.loseConnection()
+			return
+		self.admit(channel, commands, len(data))
+
+	def relayCommands(self, name, commands, frame):
+		"""Relays commands addressed to a session owned by another worker to
+		it. Joining the session connects a relay of its own, which is closed
+		again when leaving."""
+		relay = self.relays.get(name)
+		if relay is None:
+			if commands[0][0] != "join_session" or not self.countAddress():
+				return
+			self.relays[name] = shard.relay(self, name, hasattr(self.transport, "writeBinary"), frame)
+		else:
+			relay.forward("t", frame)
+
+		if "leave_session" in [command for command, args in commands]:
+			self.relays.pop(name).close()
+			self.uncountAddress()
+
+	def admit(self, channel, commands, size):
+		"""Processes the commands received in a frame of the given size if the
+		peer and its session are within their limits, or defers them, along with
+		everything received after them, until they are. Commands are never
+		dropped, as the peers' documents would diverge otherwise."""
+		if self.rejected:
+			return
+		wait = 0
+		if not self.deferred:
+			wait = self.consume(channel, len(commands), size)
+			if wait == 0:
+				self.commandsReceived(channel, commands)
+				return
+
+		self.deferred.append((channel, commands, size))
+		self.deferredCommands += len(commands)
+		if self.deferredCommands > self.MAX_DEFERRED:
+			self.reject("rate_limited", "Too many commands sent too fast")
+			return
+
+		# Commands deferred behind others are admitted along with them, also
+		# when received while admitDeferred is going through the others.
+		if wait > 0 and self.admitCall is None:
+			# Stop reading until caught up, and tell the client how long that
+			# takes at least.
+			eventLog.log(INFO, "throttled", address=self.address, sessions=self.sessionNames(), wait=wait)
+			MetricsResource.throttled += 1
+			self.transport.pauseReading()
+			self.postCommand("throttle", [wait])
+			self.admitCall = reactor.callLater(wait, self.admitDeferred)
+
+	def admitDeferred(self):
+		self.admitCall = None
+		while self.deferred:
+			channel, commands, size = self.deferred[0]
+			wait = self.consume(channel, len(commands), size)
+			if wait > 0:
+				# Unless admitting commands got some deferred anew already.
+				if self.admitCall is None:
+					self.admitCall = reactor.callLater(wait, self.admitDeferred)
+				return
+			self.deferred.popleft()
+			self.deferredCommands -= len(commands)
+			self.commandsReceived(channel, commands)
+		self.transport.resumeReading()
+
+	def consume(self, channel, count, size):
+		"""Takes the given number of commands and bytes from the buckets of the
+		peer and of the session they are addressed to if all of them hold
+		enough. Returns 0 then, or the number of seconds until they do
+		otherwise."""
+		buckets = [(self.commandBucket, count), (self.byteBucket, size)]
+		peer = self.peers.get(channel)
+		if peer is not None and peer.session is not None:
+			buckets.append((peer.session.commandBucket, count))
+			buckets.append((peer.session.byteBucket, size))
+
+		now = time.time()
+		wait = max([bucket.wait(amount, now) for bucket, amount in buckets])
+		if wait == 0:
+			for bucket, amount in buckets:
+				bucket.take(amount)
+		return wait
+
+	def countAddress(self):
+		"""Counts a session joined through this connection for the client's
+		address. Returns False after disconnecting the client if too many
+		sessions have been joined from that address already."""
+		if self.address is None:
+			return True
+		joined = self.addresses.get(self.address, 0)
+		if joined >= self.MAX_SESSIONS_PER_ADDRESS:
+			self.reject("too_many_sessions", "Too many sessions joined from this address")
+			return False
+		self.addresses[self.address] = joined + 1
+		self.counted += 1
+		return True
+
+	def uncountAddress(self, count=1):
+		if self.address is None or not count:
+			return
+		self.counted -= count
+		self.addresses[self.address] -= count
+		if not self.addresses[self.address]:
+			del self.addresses[self.address]
+
+	def reject(self, reason, message):
+		"""Tells the client why it is disconnected and disconnects it."""
+		eventLog.log(WARNING, "rejected", address=self.address, sessions=self.sessionNames(), reason=reason)
+		MetricsResource.rejected[reason] = MetricsResource.rejected.get(reason, 0) + 1
+		self.rejected = True
+		self.deferred.clear()
+		self.postCommand("error", [reason, message])
+		self.transport.loseConnection()
+
+	def sessionNames(self):
+		return sorted(peer.session.path for peer in self.peers.values() if peer.session is not None) + \
+			sorted(self.relays)
+
+	def commandsReceived(self, channel, commands):
 		# Each command is a tuple of a command name and an array containing its arguments.
 		for command, args in commands:
+			MetricsResource.commandReceived(command)
+
 			if command == "join_session":
 				# The client has to issue this command before any further commands will be
-				# processed. It associates this connection with the given session.
-
-				session_name = args[0]
-
-				if session_name in SessionDispatcherResource.sessions:
-					SessionDispatcherResource.sessions[session_name].userJoined(self)
-				else:
-					print self, "trying to join unknown session", session_name
+				# processed. It associates this connection with the given session, by the
+				# name the commands are addressed to.
+				if not self.joinSession(channel, args):
+					return
+			elif command == "leave_session":
+				self.leaveSession(channel)
+				continue
 			
 			# Pass the command on for further processing in the session itself.
-			if self.session is not None:
-				self.session.commandReceived(self, command, args)
+			peer = self.peers.get(channel)
+			if peer is not None and peer.session is not None:
+				peer.session.commandReceived(peer, command, args)
+
+	def joinSession(self, channel, args):
+		"""Joins the session named in the arguments of a join_session command,
+		as a new user. Clients list the codecs they support after the session
+		name. Returns False if the client is disconnected instead."""
+		session_name = args[0]
+		if channel is not None and session_name != channel:
+			eventLog.log(WARNING, "invalid_request", session=session_name, channel=channel)
+			return True
+
+		session = SessionDispatcherResource.getSession(session_name)
+		if session is None:
+			eventLog.log(WARNING, "unknown_session", session=session_name)
+			return True
+
+		self.leaveSession(channel)
+		if not self.countAddress():
+			return False
+
+		peer = self.peers[channel] = Peer(self, channel)
+		codecs = args[1] if len(args) > 1 else []
+		if "binary" in codecs and hasattr(self.transport, "writeBinary"):
+			peer.codec = "binary"
+			peer.decoder = CommandDecoder()
+		session.userJoined(peer)
+		return True
+
+	def leaveSession(self, channel):
+		peer = self.peers.pop(channel, None)
+		if peer is not None:
+			self.uncountAddress()
+			if peer.session is not None:
+				peer.session.userDisconnected(peer)
 	
 	def postCommand(self, command, args=[]):
-		self.transport.write(json.dumps([[command, args]]))
+		self.transport.write(encodeCommands([[command, args]]))
+
+	def sendQueueExceeded(self):
+		# Requests cannot be merged, so instead of queuing more broadcasts for a
+		# client not reading them fast enough, discard what is queued and have
+		# all its peers synchronize again once it catches up. Their acknowledged
+		# states are kept, as requests issued meanwhile are based on them. This
+		# is only possible if none of them is being synchronized.
+		peers = self.peers.values()
+		if self.relay is not None or self.relays or not peers or \
+			[peer for peer in peers if peer.session is None or not peer.isSynchronized() or peer.resyncing]:
+			WebSocketHandler.sendQueueExceeded(self)
+			return
+
+		self.transport.discardQueued()
+		for peer in peers:
+			eventLog.log(INFO, "resync", session=peer.session.path, user=peer.uid)
+			MetricsResource.resyncs += 1
+			peer.resyncing = True
+			peer.postCommand("resync")
 	
 	def connectionLost(self, reason):
-		if self.session is not None:
-			self.session.userDisconnected(self)
+		MetricsResource.transportClosed(self.transport)
+		if self.admitCall is not None:
+			self.admitCall.cancel()
+			self.admitCall = None
+		self.deferred.clear()
+		if self.relay is not None:
+			self.relay.close()
+		for relay in self.relays.values():
+			relay.close()
+		for peer in self.peers.values():
+			if peer.session is not None:
+				peer.session.userDisconnected(peer)
+		self.uncountAddress(self.counted)
 
 class SessionDispatcherResource(resource.Resource):
-	"""Creates and returns sessions as needed."""
-	sessions = {}
+	"""Creates and returns sessions as needed. Sessions nobody is connected to
+	are evicted from memory when they have been idle for too long or the
+	sessions in memory exceed their budget, least recently used first."""
+
+	# Sessions in memory, ordered from the least to the most recently used.
+	sessions = OrderedDict()
+
+	# Evicted sessions whose journal is still being written, so they can be
+	# taken over as they are when accessed in the meantime.
+	closing = {}
+
+	# Maximum number of sessions and estimated bytes of memory used by them.
+	MAX_SESSIONS = 1000
+	MAX_MEMORY = 256 * 1024 * 1024
+
+	# Seconds after which unused sessions are evicted, and the interval in which
+	# this is checked.
+	IDLE_TIMEOUT = 15 * 60
+	EVICTION_INTERVAL = 30
+
+	statistics = {"evictions": 0, "reloads": 0}
 	
 	def getChild(self, path, request):
+		if path and shard is not None and not shard.owns(path):
+			return shard.proxyResource(path, "/session/" + urllib.quote(path))
+
 		if path:
-			if not path in self.sessions and path.isalnum():
-				# The given session does not exist yet, but has a valid name
-				self.sessions[path] = SessionResource(path)
-			
-			if path in self.sessions:
-				# The requested session exists
-				return self.sessions[path]
+			session = self.getSession(path, create=True)
+			if session is not None:
+				return session
 		
 		# The path is invalid
 		return resource.NoResource()
 
+	@classmethod
+	def getSession(cls, name, create=False):
+		"""Returns the session with the given name. Sessions which are not in
+		memory are loaded from their journal. If there is none, a new session is
+		created if requested, otherwise None is returned."""
+		if isinstance(name, unicode):
+			# Names sent by clients and other nodes are decoded from JSON.
+			name = name.encode("utf-8")
+
+		if name in cls.sessions:
+			session = cls.sessions.pop(name)
+		elif name in cls.closing:
+			session, closed = cls.closing.pop(name)
+			cls.statistics["reloads"] += 1
+		elif not name.isalnum():
+			return None
+		elif broker is not None and sessionOwner(name) != localNode():
+			# Sessions owned by other nodes are replicated from their owner,
+			# which creates them if they do not exist yet.
+			session = ReplicaSessionResource(name)
+		elif JOURNAL_DIR is not None and journal.exists(os.path.join(JOURNAL_DIR, name)):
+			session = SessionResource(name)
+			cls.statistics["reloads"] += 1
+		elif create:
+			session = SessionResource(name)
+		else:
+			return None
+
+		# Keep the sessions ordered by their last use.
+		session.lastUsed = time.time()
+		cls.sessions[name] = session
+
+		if len(cls.sessions) > cls.MAX_SESSIONS:
+			cls.evictSessions(keep=name)
+
+		return session
+
+	@classmethod
+	def evictSessions(cls, keep=None):
+		"""Evicts sessions nobody is connected to which are idle or exceed the
+		budget for sessions in memory, except for the session named keep."""
+		now = time.time()
+		count = len(cls.sessions)
+		size = sum(session.estimatedSize() for session in cls.sessions.values())
+
+		for name, session in cls.sessions.items():
+			if session.inUse() or name == keep:
+				continue
+
+			if count <= cls.MAX_SESSIONS and size <= cls.MAX_MEMORY and \
+				now - session.lastUsed < cls.IDLE_TIMEOUT:
+				continue
+
+			# Without a journal, documents would get lost. Replicas can always be
+			# evicted, as their owner keeps the document.
+			if session.journal is None and session.state.vector.users() and \
+				not isinstance(session, ReplicaSessionResource):
+				continue
+
+			count -= 1
+			size -= session.estimatedSize()
+			cls.evictSession(name)
+
+	@classmethod
+	def evictSession(cls, name):
+		session = cls.sessions.pop(name)
+		cls.statistics["evictions"] += 1
+		eventLog.log(INFO, "evicted", session=name)
+
+		d = session.close()
+		if d is None:
+			return
+		cls.closing[name] = session, d
+
+		def closed(result):
+			# The session might have been taken over and evicted again.
+			if name in cls.closing and cls.closing[name][1] is d:
+				del cls.closing[name]
+
+		def failed(failure):
+			# Its journal could not be written, so the session is kept in
+			# memory unless it has been taken over since. Writing it is tried
+			# again, and evicting it later on.
+			if name in cls.closing and cls.closing[name][1] is d:
+				del cls.closing[name]
+				cls.sessions[name] = session
+			eventLog.log(WARNING, "eviction_failed", session=name, error=failure.getErrorMessage())
+		d.addCallbacks(closed, failed)
+
+	@classmethod
+	def nodeMessageReceived(cls, message):
+		"""Handles a message about a session sent to this node by another one
+		(see sendToNode)."""
+		message = json.loads(message)
+		kind, name, node, args = message[0], message[1], message[2], message[3:]
+
+		if kind in ("snapshot", "detached"):
+			# Replies of an owner, which are of no use to sessions evicted since.
+			session = cls.sessions.get(name)
+			if isinstance(session, ReplicaSessionResource):
+				session.ownerMessageReceived(kind, args)
+			return
+
+		if sessionOwner(name) != localNode():
+			eventLog.log(WARNING, "not_owner", session=name, node=node, kind=kind, owner=sessionOwner(name))
+			return
+		if kind == "detach" and name not in cls.sessions:
+			return
+		session = cls.getSession(name, create=True)
+		if session is not None:
+			session.replicaMessageReceived(kind, node, args)
+
+	@classmethod
+	def flushJournals(cls):
+		"""Writes all sessions' journals to disk. Returns a Deferred firing once
+		this is done."""
+		sessions = cls.sessions.values() + [session for session, d in cls.closing.values()]
+		return defer.DeferredList([session.journal.flush() for session in sessions
+			if session.journal is not None], consumeErrors=True)
+
 class SessionResource(resource.Resource):
 	"""Functionality for an individual session"""
-	template = open("template.html", "rt").read()
+
+	# The page before and after the placeholder for the session's name, with
+	# the URLs of static files carrying their version.
+	template = assets.versionURLs(open("template.html", "rt").read(), staticAssets).split("%(path)s")
+
+	# How many requests back users may undo. Older requests are discarded from
+	# the log once all peers have acknowledged them. Set to None to allow undoing
+	# everything, which keeps each connected user's requests around forever.
+	UNDO_DEPTH = 500
+
+	# Commands broadcast within this many seconds are sent to peers in a single
+	# frame. With 0, all commands received in one reactor iteration are grouped.
+	BATCH_DELAY = 0
+
+	# A checkpoint of the session is written to its journal after this many
+	# requests, so loading it only needs to replay the requests since then.
+	CHECKPOINT_INTERVAL = 1000
+
+	# Commands and bytes all peers of the session on this node may send per
+	# second on average, and in a burst (see TransportHandler).
+	COMMAND_RATE = 500
+	COMMAND_BURST = 2000
+	BYTE_RATE = 1024 * 1024
+	BYTE_BURST = 4 * 1024 * 1024
 	
 	def __init__(self, path):
 		self.path = path
+		self.lastUsed = time.time()
 
 		self.current_uid = 1
-		self.log = []
 		self.peers = {}
+
+		self.commandBucket = TokenBucket(self.COMMAND_RATE, self.COMMAND_BURST)
+		self.byteBucket = TokenBucket(self.BYTE_RATE, self.BYTE_BURST)
+
+		# The materialized document, updated with every request as it arrives,
+		# and its log in the encoded form sent to joining clients.
+		self.state = State()
+		self.encodedLog = EncodedLog()
+
+		# Number of requests discarded from the log so far, and the vectors the
+		# log was last collected at.
+		self.discarded = 0
+		self.collected = None
+
+		# Encoded commands waiting to be broadcast, the same commands as (command,
+		# args) tuples for encoding them in binary, and the pending call which
+		# will send them.
+		self.pendingCommands = []
+		self.pendingArgs = []
+		self.flushCall = None
+
+		# Encodes broadcasts for all peers using the binary codec at once. Each
+		# peer starts decoding from the encoder's vector at the time it was
+		# synchronized.
+		self.binaryEncoder = CommandEncoder()
+
+		# Nodes replicating this session, mapped to the vector all their peers
+		# have reached and the users connected to them, and the number of
+		# messages published to them so far.
+		self.replicas = {}
+		self.published = 0
+
+		self.journal = None
+		if JOURNAL_DIR is not None:
+			self.load(os.path.join(JOURNAL_DIR, path))
+	
+	def load(self, path):
+		"""Loads the session from the journal in the given directory, if there is
+		one, and starts journaling to it."""
+		checkpoint, sequence, records = journal.read(path)
+
+		if checkpoint is not None:
+			self.restoreCheckpoint(checkpoint)
+
+		for record in records:
+			command, args = json.loads(record)
+			self.executeRequest(commandToRequest(command, args))
+
+		if records:
+			eventLog.log(INFO, "loaded", session=self.path, requests=len(records))
+
+		self.journal = Journal(path, sequence, eventLog)
+		self.uncheckpointed = len(records)
+
+		# Nobody is connected yet, so nothing in the log is needed anymore.
+		self.collectLog()
+
+	def close(self):
+		"""Writes a checkpoint so the session loads quickly again. Returns a
+		Deferred firing once it has been written to disk, or None if the session
+		is not journaled."""
+		if self.journal is None:
+			return None
+		if self.uncheckpointed:
+			self.writeCheckpoint()
+		return self.journal.flush()
+
+	def estimatedSize(self):
+		"""Returns a rough estimate of the memory used by this session in bytes,
+		based on the size of its encoded log and document."""
+		return self.encodedLog.size + 4 * self.state.buffer.getLength()
+
+	def inUse(self):
+		"""Returns whether peers on this or other nodes are connected to the
+		session, which keeps it from being evicted."""
+		return bool(self.peers or self.replicas)
+
+	def restoreCheckpoint(self, checkpoint):
+		# The first line holds the session's state, the following ones the log
+		# as it is sent to joining clients.
+		lines = checkpoint.split("\n")
+		header = json.loads(lines[0])
+
+		self.current_uid = header["uid"]
+		self.discarded = header["discarded"]
+		self.state = State(segmentsToBuffer(header["buffer"]), Vector(header["vector"]))
+
+		for line in lines[1:]:
+			for command, args in json.loads(line):
+				request = commandToRequest(command, args)
+				self.state.log.append(request)
+				self.encodedLog.append(request)
+
+	def checkpoint(self):
+		"""Returns the session's state in the form restoreCheckpoint takes."""
+		header = json.dumps({
+			"uid": self.current_uid,
+			"discarded": self.discarded,
+			"buffer": bufferToSegments(self.state.buffer),
+			"vector": self.state.vector.toString(),
+		})
+		return "\n".join([header] + self.encodedLog.frames())
+
+	def writeCheckpoint(self):
+		self.journal.checkpoint(self.checkpoint())
+		self.uncheckpointed = 0
 	
 	def render(self, request):
 		# The template has a placeholder for this session's name, which we fill in
 		# before rendering it to the browser.
-		return self.template % {"path": urllib.quote(self.path)}
+		return self.template[0] + urllib.quote(self.path) + self.template[1]
 
 	def userJoined(self, transport):
 		# A new user has joined this session, so we assign it the next free user ID.
 		transport.session = self
-		transport.uid = self.current_uid
-		self.current_uid += 1
+		transport.uid = self.allocateUid()
 
 		self.peers[transport.uid] = transport
 
-		# Tell the client what its new user ID is.
-		transport.postCommand("assign_uid", [transport.uid,])
+		# Tell the client what its new user ID is, how far back it may undo and
+		# which codec to use.
+		transport.postCommand("assign_uid", [transport.uid, self.UNDO_DEPTH, transport.codec])
 	
+	def allocateUid(self):
+		uid = self.current_uid
+		if broker is not None:
+			# Each node hands out the user IDs in its own residue class, so they
+			# never collide.
+			while (uid - 1) % len(NODES) != NODES.index(NODE):
+				uid += 1
+		self.current_uid = uid + 1
+		return uid
+
 	def userDisconnected(self, transport):
 		if transport.uid in self.peers:
 			# The client has disconnected - remove it from our list of peers.
+			# Its requests cannot be undone anymore, so they may be discarded.
 			del self.peers[transport.uid]
+			self.collectLog()
+
+			self.lastUsed = time.time()
+
+	def collectLog(self):
+		"""Discards requests from the log that no peer can still need for
+		transforming or undoing requests."""
+		acked = [peer.acked for peer in self.peers.values() if peer.acked is not None]
+		acked.extend(stable for stable, users in self.replicas.values())
+		if acked:
+			stable = Vector.minimum(acked)
+		else:
+			# Nobody is synchronized, so the next peers start at the current state.
+			stable = self.state.vector
+
+		# Connected users may undo their last UNDO_DEPTH requests.
+		connected = set(self.peers)
+		for replicaStable, users in self.replicas.values():
+			connected.update(users)
+		undoable = {}
+		for user in self.state.vector.users():
+			undoable[user] = self.state.vector.get(user)
+			if user in connected:
+				if self.UNDO_DEPTH is None:
+					undoable[user] = 0
+				else:
+					undoable[user] = max(0, undoable[user] - self.UNDO_DEPTH)
+		undoable = Vector(undoable)
+
+		if (stable.toString(), undoable.toString()) == self.collected:
+			return
+		self.collected = (stable.toString(), undoable.toString())
+
+		discarded = self.state.prune(stable, undoable)
+		if discarded:
+			self.encodedLog.retain(self.state.log)
+			self.discarded += discarded
+			self.publish("prune", stable.toString(), undoable.toString())
+			self.prunePeers(stable, undoable)
+			eventLog.log(INFO, "log_pruned", session=self.path, **self.logStatistics())
+
+	def prunePeers(self, stable, undoable):
+		"""Tells the synchronized peers to discard the same requests from their
+		logs. The command follows the requests broadcast so far, so the peers
+		have executed all requests the stable vector includes by then."""
+		self.flushCommands()
+		for peer in self.peers.values():
+			if peer.isSynchronized() and not peer.resyncing:
+				peer.postCommand("prune", [stable.toString(), undoable.toString()])
+
+	def logStatistics(self):
+		"""Returns the number of requests retained in and discarded from the
+		log."""
+		return {"retained": len(self.state.log), "discarded": self.discarded}
 	
 	def commandReceived(self, transport, command, args):
-		print "%s\tUser %s\t%s\t%s" % (self.path, transport.uid, command.ljust(12), "\t".join(unicode(arg) for arg in (args or [])))
+		eventLog.log(INFO, "command", session=self.path, user=transport.uid, command=command, args=args)
 
 		if command == "sync":
+			# Broadcasts not sent yet are already contained in the snapshot, so
+			# send them before it to keep the client from executing them again.
+			self.flushCommands()
+			started = time.time()
+
 			# The client wants to obtain the current state of the document.
-			transport.postCommand("sync_begin")
-			
-			# Replay the log.
-			for lcommand, largs in self.log:
-				transport.postCommand(lcommand, largs)
-			
-			transport.postCommand("sync_end")
+			# Send the document as it is now. The client loads it directly, so
+			# the log that follows is only recorded for transforming concurrent
+			# requests and undoing, but not executed again.
+			frames = [encodeCommands([
+				["sync_begin", []],
+				["sync_snapshot", [bufferToSegments(self.state.buffer), self.state.vector.toString()]],
+			])]
+			frames.extend(self.encodedLog.frames())
+			if transport.codec == "binary":
+				# Binary broadcasts encode vectors relative to the previous one.
+				frames.append(encodeCommands([["sync_end", [self.binaryEncoder.base.toString()]]]))
+			else:
+				frames.append(encodeCommands([["sync_end", []]]))
+
+			transport.postFrames(frames)
+			MetricsResource.syncDuration.observe(time.time() - started)
+
+			transport.acked = self.state.vector
+			transport.resyncing = False
+		elif command == "ack":
+			# The client tells us which state it has reached, so requests before
+			# that state may become unnecessary.
+			vector = Vector(args[0])
+			if transport.acked is None or not vector.causallyBefore(self.state.vector):
+				return
+
+			transport.acked = Vector.leastCommonSuccessor(transport.acked, vector)
+			self.collectLog()
 		elif command in ("insert", "delete", "undo"):
-			# The client has issued an insert, delete or undo command.
-			# Insert the command into the log and broadcast it to all peers.
-			self.log.append([command, args])
-			self.broadcastCommand(command, args)
+			# The client has issued an insert, delete or undo command, which has
+			# to be issued by the sending user.
+			if int(args[0]) != transport.uid:
+				eventLog.log(WARNING, "invalid_request", session=self.path, user=transport.uid)
+				return
+
+			request = self.requestReceived(command, args)
+
+			# The client has obviously seen everything its request is based on.
+			if request is not None and transport.acked is not None:
+				transport.acked = Vector.leastCommonSuccessor(transport.acked, request.vector)
+
+	def requestReceived(self, command, args):
+		"""Executes an insert, delete or undo command issued by a peer on this or
+		another node. Returns the request, or None if it cannot be executed."""
+		request = commandToRequest(command, args)
+
+		# Requests must be the next one we expect from their user, otherwise they
+		# cannot be applied.
+		if not self.state.canExecute(request) or \
+			request.vector.get(request.user) != self.state.vector.get(request.user):
+			eventLog.log(WARNING, "invalid_request", session=self.path, user=request.user)
+			return None
+
+		# Apply the request to our copy of the document, broadcast it to all
+		# peers, publish it to the other nodes and record it in the journal.
+		self.executeRequest(request)
+		encoded = self.broadcastCommand(command, args)
+		self.publish("command", command, args)
+
+		if self.journal is not None:
+			self.journal.append(encoded)
+			self.uncheckpointed += 1
+			if self.uncheckpointed >= self.CHECKPOINT_INTERVAL:
+				self.writeCheckpoint()
+
+		return request
+	
+	def publish(self, kind, *args):
+		"""Publishes a message to the nodes replicating this session. Messages
+		are numbered, so replicas know where to continue after the snapshot
+		they started from."""
+		if not self.replicas:
+			return
+		self.published += 1
+		broker.publish("session/" + self.path,
+			encodeJSON([kind, self.published] + list(args)))
+
+	def replicaMessageReceived(self, kind, node, args):
+		"""Handles a message from a node replicating this session."""
+		if kind == "attach":
+			# Until the node reports otherwise, its peers may still need
+			# everything after the snapshot.
+			self.replicas[node] = (self.state.vector, [])
+			sendToNode(node, "snapshot", self.path, self.published, self.checkpoint())
+		elif node not in self.replicas:
+			# The node has missed messages, e.g. because this session was
+			# reloaded, so it has to start over.
+			if kind != "detach":
+				sendToNode(node, "detached", self.path)
+		elif kind == "detach":
+			del self.replicas[node]
+			self.collectLog()
+		elif kind == "report":
+			self.replicas[node] = (Vector(args[0]), args[1])
+			self.collectLog()
+		elif kind == "request":
+			self.requestReceived(args[0], args[1])
+
+	def executeRequest(self, request):
+		self.state.execute(request)
+		self.encodedLog.append(self.state.log[-1])
+
+		# User IDs must not be handed out again after a restart.
+		self.current_uid = max(self.current_uid, request.user + 1)
 	
 	def broadcastCommand(self, command, args=[]):
-		for peer in self.peers:
-			self.peers[peer].postCommand(command, args)
+		"""Sends a command to all peers. It is encoded only once and sent along
+		with the other commands broadcast within BATCH_DELAY. Returns the encoded
+		command."""
+		encoded = encodeJSON([command, args])
+		self.pendingCommands.append(encoded)
+		self.pendingArgs.append((command, args))
+
+		if self.flushCall is None:
+			self.flushCall = reactor.callLater(self.BATCH_DELAY, self.flushCommands)
+
+		return encoded
+
+	def flushCommands(self):
+		"""Sends all pending broadcast commands in a single frame, which is framed
+		only once for each kind of transport and addressing. Peers using the binary codec
+		receive them in a single binary frame, encoded only once as well."""
+		if self.flushCall is not None:
+			if self.flushCall.active():
+				self.flushCall.cancel()
+			self.flushCall = None
+
+		if not self.pendingCommands:
+			return
+
+		started = time.time()
+		frame = "[%s]" % ",".join(self.pendingCommands)
+		commands = self.pendingArgs
+		self.pendingCommands = []
+		self.pendingArgs = []
+
+		prepared = {}
+		binaryFrame = None
+		binaryPrepared = {}
+		for peer in self.peers.values():
+			if peer.resyncing:
+				continue
+			# Frames to peers multiplexing sessions are addressed to this one.
+			key = (peer.transport.framing, peer.channel)
+			if peer.codec == "binary":
+				# Peers receive all binary broadcasts from their synchronization
+				# on, so they can decode the vectors in them.
+				if not peer.isSynchronized():
+					continue
+				if binaryFrame is None:
+					binaryFrame = self.binaryEncoder.encode(commands)
+				if key not in binaryPrepared:
+					if peer.channel is None:
+						binaryPrepared[key] = peer.transport.prepareBinary(binaryFrame)
+					else:
+						binaryPrepared[key] = peer.transport.prepareBinary(addressMessage(peer.channel, binaryFrame))
+				peer.transport.writePrepared(binaryPrepared[key])
+			else:
+				if key not in prepared:
+					if peer.channel is None:
+						prepared[key] = peer.transport.prepareFrame(frame)
+					else:
+						prepared[key] = peer.transport.prepareFrame(addressFrame(peer.channel, frame))
+				peer.transport.writePrepared(prepared[key])
+		MetricsResource.broadcastDuration.observe(time.time() - started)
+
+class ReplicaSessionResource(SessionResource):
+	"""A session owned by another node. It starts from a snapshot of the
+	owner's session and executes the requests the owner publishes, in the
+	owner's order, while requests of its own peers are forwarded to the owner.
+	Requests are discarded from the log when the owner says so, which takes
+	into account what the peers of all nodes have reached."""
+
+	# Peers' acknowledgements are reported to the owner after this many
+	# seconds, along with all others received in the meantime.
+	REPORT_DELAY = 1
+
+	def __init__(self, path):
+		SessionResource.__init__(self, path)
+		self.owner = sessionOwner(path)
+		self.reportCall = None
+		self.attach()
+
+	def load(self, path):
+		# The owner journals the session.
+		pass
+
+	def attach(self):
+		"""Starts replicating the session. The owner replies with a snapshot,
+		and messages published before it arrives are kept until then."""
+		self.ready = False
+		self.sequence = None
+		self.buffered = []
+		self.reported = None
+
+		# Users joining before the snapshot has arrived, whose user IDs cannot be
+		# assigned before the document's users are known.
+		self.waiting = []
+
+		broker.subscribe("session/" + self.path, self.messageReceived)
+		sendToNode(self.owner, "attach", self.path)
+
+	def detach(self):
+		broker.unsubscribe("session/" + self.path, self.messageReceived)
+		sendToNode(self.owner, "detach", self.path)
+		if self.reportCall is not None:
+			self.reportCall.cancel()
+			self.reportCall = None
+
+	def close(self):
+		self.detach()
+		return None
+
+	def inUse(self):
+		return bool(self.peers or self.waiting)
+
+	def ownerMessageReceived(self, kind, args):
+		if kind == "snapshot":
+			self.snapshotReceived(args[0], args[1])
+		elif kind == "detached":
+			self.resynchronize()
+
+	def snapshotReceived(self, sequence, checkpoint):
+		if self.ready:
+			return
+		self.restoreCheckpoint(checkpoint)
+		self.sequence = sequence
+		self.ready = True
+
+		buffered = self.buffered
+		self.buffered = None
+		for message in buffered:
+			self.replicate(message)
+
+		waiting = self.waiting
+		self.waiting = []
+		for transport in waiting:
+			self.userJoined(transport)
+
+	def resynchronize(self):
+		"""Starts over from a new snapshot after having missed messages from the
+		owner. Peers are disconnected, as their documents cannot be brought up
+		to date anymore."""
+		eventLog.log(WARNING, "owner_lost", session=self.path, owner=self.owner)
+		peers = self.peers.values() + self.waiting
+		self.peers = {}
+		self.detach()
+
+		for peer in peers:
+			peer.transport.loseConnection()
+
+		self.state = State()
+		self.encodedLog = EncodedLog()
+		self.discarded = 0
+		self.collected = None
+		self.pendingCommands = []
+		self.pendingArgs = []
+		self.binaryEncoder = CommandEncoder()
+		self.attach()
+
+	def messageReceived(self, message):
+		message = json.loads(message)
+		if self.ready:
+			self.replicate(message)
+		else:
+			self.buffered.append(message)
+
+	def replicate(self, message):
+		"""Executes a message published by the owner."""
+		kind, sequence, args = message[0], message[1], message[2:]
+		if sequence <= self.sequence:
+			# Already contained in the snapshot.
+			return
+		if sequence != self.sequence + 1:
+			self.resynchronize()
+			return
+		self.sequence = sequence
+
+		if kind == "command":
+			command, commandArgs = args
+			self.executeRequest(commandToRequest(command, commandArgs))
+			self.broadcastCommand(command, commandArgs)
+		elif kind == "prune":
+			stable, undoable = Vector(args[0]), Vector(args[1])
+			discarded = self.state.prune(stable, undoable)
+			if discarded:
+				self.encodedLog.retain(self.state.log)
+				self.discarded += discarded
+				self.prunePeers(stable, undoable)
+
+	def userJoined(self, transport):
+		if not self.ready:
+			transport.session = self
+			self.waiting.append(transport)
+			return
+		SessionResource.userJoined(self, transport)
+		self.collectLog()
+
+	def userDisconnected(self, transport):
+		if transport in self.waiting:
+			self.waiting.remove(transport)
+		else:
+			SessionResource.userDisconnected(self, transport)
+
+	def requestReceived(self, command, args):
+		# The owner executes the request, and it is executed here once the owner
+		# has published it.
+		sendToNode(self.owner, "request", self.path, command, args)
+		return commandToRequest(command, args)
+
+	def collectLog(self):
+		"""Reports which requests the peers may still need to the owner, which
+		publishes when to discard them."""
+		if self.reportCall is None:
+			self.reportCall = reactor.callLater(self.REPORT_DELAY, self.report)
+
+	def report(self):
+		self.reportCall = None
+
+		# Peers synchronizing later on start at the current state at least.
+		acked = [peer.acked for peer in self.peers.values() if peer.acked is not None]
+		stable = Vector.minimum(acked + [self.state.vector]).toString()
+		report = [stable, sorted(self.peers)]
+		if report != self.reported:
+			self.reported = report
+			sendToNode(self.owner, "report", self.path, stable, sorted(self.peers))
+
+# Statistics of the messages passed between nodes are logged in this interval.
+BROKER_STATISTICS_INTERVAL = 60
+
+def logBrokerStatistics():
+	"""Logs how many messages were passed between nodes and how long their
+	delivery took."""
+	statistics = broker.resetStatistics()
+	if statistics["delivered"]:
+		eventLog.log(INFO, "broker", published=statistics["published"], delivered=statistics["delivered"],
+			latencyMs=1000 * statistics["latency"] / statistics["delivered"],
+			maxLatencyMs=1000 * statistics["maxLatency"])
+
+class MetricsResource(resource.Resource):
+	"""Exposes counters and histograms of this process' sessions, peers and
+	transports in the text format of metrics.py."""
+	isLeaf = True
+
+	# Commands received from peers by name, and the commands counted by their
+	# own name. Others are counted as "other".
+	commands = {}
+	COMMANDS = ["join_session", "sync", "ack", "insert", "delete", "undo"]
+
+	# Durations of encoding and writing the synchronization of a peer and of
+	# broadcasting commands to all peers of a session.
+	syncDuration = Histogram()
+	broadcastDuration = Histogram()
+
+	# Open transports, and the frames and bytes of those already closed.
+	transports = set()
+	closed = {"framesReceived": 0, "bytesReceived": 0, "framesSent": 0, "bytesSent": 0}
+
+	# Peers told to synchronize again after falling behind.
+	resyncs = 0
+
+	# Times peers were throttled for exceeding their or their session's limits,
+	# and peers disconnected, by the reason given to them.
+	throttled = 0
+	rejected = {}
+
+	@classmethod
+	def commandReceived(cls, command):
+		if command not in cls.COMMANDS:
+			command = "other"
+		if command not in cls.commands:
+			cls.commands[command] = Meter()
+		cls.commands[command].mark()
+
+	@classmethod
+	def transportClosed(cls, transport):
+		cls.transports.discard(transport)
+		for name in cls.closed:
+			cls.closed[name] += getattr(transport, name)
+
+	@classmethod
+	def tick(cls):
+		for meter in cls.commands.values():
+			meter.tick()
+
+	def render(self, request):
+		sessions = SessionDispatcherResource.sessions.items()
+		def bySession(value):
+			return [({"session": name}, value(session)) for name, session in sessions]
+
+		exposition = Exposition()
+		exposition.add("jinfinote_info", "gauge", "The node this process serves.",
+			[({"node": localNode()}, 1)])
+
+		exposition.add("jinfinote_sessions", "gauge", "Sessions in memory.", len(sessions))
+		exposition.add("jinfinote_session_peers", "gauge",
+			"Peers connected to the session on this node.", bySession(lambda session: len(session.peers)))
+		exposition.add("jinfinote_session_replicas", "gauge",
+			"Other nodes replicating the session.", bySession(lambda session: len(session.replicas)))
+		exposition.add("jinfinote_session_log_requests", "gauge",
+			"Requests in the session's log.", bySession(lambda session: len(session.state.log)))
+		exposition.add("jinfinote_session_log_bytes", "gauge",
+			"Size of the session's encoded log.", bySession(lambda session: session.encodedLog.size))
+		exposition.add("jinfinote_session_discarded_requests_total", "counter",
+			"Requests discarded from the session's log.", bySession(lambda session: session.discarded))
+		exposition.add("jinfinote_session_document_length", "gauge",
+			"Characters in the session's document.", bySession(lambda session: session.state.buffer.getLength()))
+		exposition.add("jinfinote_session_estimated_bytes", "gauge",
+			"Estimated memory used by the session.", bySession(lambda session: session.estimatedSize()))
+		exposition.add("jinfinote_session_evictions_total", "counter",
+			"Sessions evicted from memory.", SessionDispatcherResource.statistics["evictions"])
+		exposition.add("jinfinote_session_reloads_total", "counter",
+			"Evicted sessions loaded again.", SessionDispatcherResource.statistics["reloads"])
+
+		commands = sorted(self.commands.items())
+		exposition.add("jinfinote_commands_total", "counter", "Commands received from peers.",
+			[({"command": command}, meter.count) for command, meter in commands])
+		exposition.add("jinfinote_commands_per_second", "gauge",
+			"Commands received from peers per second, averaged over about a minute.",
+			[({"command": command}, meter.rate) for command, meter in commands])
+
+		# Transports of peers are listed by their session and user, totals
+		# include transports not in a session and those already closed.
+		peers = []
+		for name, session in sessions:
+			for uid, peer in sorted(session.peers.items()):
+				peers.append(({"session": name, "user": uid}, peer.transport))
+		totals = dict(self.closed)
+		for transport in self.transports:
+			for name in totals:
+				totals[name] += getattr(transport, name)
+		exposition.add("jinfinote_transports", "gauge", "Open WebSocket connections.", len(self.transports))
+		for name, attribute, description in [
+			("frames_in", "framesReceived", "Messages received"),
+			("frames_out", "framesSent", "Frames sent"),
+			("bytes_in", "bytesReceived", "Bytes received"),
+			("bytes_out", "bytesSent", "Bytes sent")]:
+			exposition.add("jinfinote_transport_%s_total" % name, "counter",
+				description + " by all transports.", totals[attribute])
+			exposition.add("jinfinote_peer_%s_total" % name, "counter",
+				description + " by the peer's transport.",
+				[(labels, getattr(transport, attribute)) for labels, transport in peers])
+		exposition.add("jinfinote_transport_queued_bytes", "gauge",
+			"Bytes queued for clients not reading fast enough.",
+			sum(getattr(transport, "queuedBytes", 0) for transport in self.transports))
+		exposition.add("jinfinote_peer_resyncs_total", "counter",
+			"Peers told to synchronize again after falling behind.", self.resyncs)
+		exposition.add("jinfinote_peer_throttled_total", "counter",
+			"Times reading from peers was paused for sending too much.", self.throttled)
+		exposition.add("jinfinote_peer_rejected_total", "counter",
+			"Peers disconnected for exceeding limits.",
+			[({"reason": reason}, count) for reason, count in sorted(self.rejected.items())])
+
+		exposition.add("jinfinote_log_records_total", "counter", "Records logged.", eventLog.logged)
+		exposition.add("jinfinote_log_dropped_total", "counter",
+			"Records dropped because too many were waiting to be written.", eventLog.dropped)
+
+		exposition.addHistogram("jinfinote_sync_duration_seconds",
+			"Time taken to encode and write the synchronization of a peer.", self.syncDuration)
+		exposition.addHistogram("jinfinote_broadcast_duration_seconds",
+			"Time taken to send broadcast commands to all peers of a session.", self.broadcastDuration)
+
+		request.setHeader("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+		return exposition.text()
+
+class StaticResource(resource.Resource):
+	"""Serves static files from memory, gzipped to clients accepting it.
+	Responses to URLs carrying the file's current version, as the session page
+	references them, may be cached for good. Others have to be revalidated
+	using their ETag."""
+	isLeaf = True
+
+	# Seconds versioned responses may be cached for.
+	MAX_AGE = 365 * 24 * 60 * 60
+
+	def __init__(self, assets):
+		resource.Resource.__init__(self)
+		self.assets = assets
+
+	def render_GET(self, request):
+		asset = self.assets.get("/".join(request.postpath))
+		if asset is None:
+			return resource.NoResource().render(request)
+
+		data, etag = asset.data, asset.etag
+		if asset.gzipped is not None:
+			request.setHeader("Vary", "Accept-Encoding")
+			if "gzip" in (request.getHeader("Accept-Encoding") or ""):
+				data, etag = asset.gzipped, asset.gzippedEtag
+				request.setHeader("Content-Encoding", "gzip")
+
+		request.setHeader("Content-Type", asset.contentType)
+		request.setHeader("ETag", etag)
+		if request.args.get("v") == [asset.version]:
+			request.setHeader("Cache-Control", "public, max-age=%d, immutable" % self.MAX_AGE)
+		else:
+			request.setHeader("Cache-Control", "no-cache")
+
+		if etag in [tag.strip() for tag in (request.getHeader("If-None-Match") or "").split(",")]:
+			request.setResponseCode(304)
+			return ""
+		return data
 
 class RootResource(resource.Resource):
 	def getChild(self, name, request):
@@ -140,24 +1369,66 @@ class RootResource(resource.Resource):
 		
 		return server.NOT_DONE_YET
 
-if __name__ == "__main__":
+if __name__ == "__main__" and WORKERS > 1 and sys.argv[1:2] != ["--worker"]:
+	# Bind the port and leave everything else to the worker processes.
+	supervisor = sharding.Supervisor(sys.argv[0], WORKERS, PORT, eventLog)
+	supervisor.start()
+
+	eventLog.start()
+	reactor.addSystemEventTrigger("after", "shutdown", eventLog.stop)
+
+	print "EXPERIMENTAL SERVER - Do not use in production environments!"
+	print "Read the README file before using this."
+	print
+	print "Listening for HTTP connections on port %s with %d workers" % (PORT, WORKERS)
+	print
+
+	reactor.run()
+elif __name__ == "__main__":
 	root = RootResource()
 
-	# Mount the directories containing our static files
-	staticDir = static.File("./static/")
-	staticDir.putChild("algorithm", static.File("../algorithm/"))
-	staticDir.directoryListing = lambda: error.ForbiddenResource()
-	root.putChild("static", staticDir)
+	# Serve our static files from memory
+	root.putChild("static", StaticResource(staticAssets))
 
 	# Create a resource that spawns new sessions as they are accessed
 	root.putChild("session", SessionDispatcherResource())
+
+	# Expose metrics of this process
+	root.putChild("metrics", MetricsResource())
+	task.LoopingCall(MetricsResource.tick).start(Meter.TICK_INTERVAL, now=False)
 	
 	# Create a transport endpoint that can be accessed using a WebSocket
 	site = WebSocketSite(root)
 	site.addHandler("/transport", TransportHandler)
 	
-	# Start listening
-	listener = reactor.listenTCP(PORT, site)
+	# Periodically evict idle sessions from memory
+	task.LoopingCall(SessionDispatcherResource.evictSessions).start(
+		SessionDispatcherResource.EVICTION_INTERVAL, now=False)
+
+	# Make sure everything journaled has been written before exiting
+	reactor.addSystemEventTrigger("before", "shutdown", SessionDispatcherResource.flushJournals)
+
+	# Write logged records from a thread of their own until exiting
+	eventLog.start()
+	reactor.addSystemEventTrigger("after", "shutdown", eventLog.stop)
+
+	# Start listening. Workers accept connections on the port bound by the
+	# supervisor and listen for requests forwarded by the other workers.
+	if sys.argv[1:2] == ["--worker"]:
+		shard = sharding.Shard(int(sys.argv[2]), int(sys.argv[3]), eventLog)
+		shard.listen(server.Site(root), TransportHandler)
+		listener = reactor.adoptStreamPort(3, socket.AF_INET, site)
+	else:
+		listener = reactor.listenTCP(PORT, site)
+
+	# Connect to the other nodes hosting peers of the same sessions
+	if BROKER == "local":
+		broker = InProcessBroker()
+	elif BROKER is not None:
+		broker = SocketBroker(BROKER, eventLog)
+	if broker is not None:
+		broker.subscribe("node/" + localNode(), SessionDispatcherResource.nodeMessageReceived)
+		task.LoopingCall(logBrokerStatistics).start(BROKER_STATISTICS_INTERVAL, now=False)
 
 	print "EXPERIMENTAL SERVER - Do not use in production environments!"
 	print "Read the README file before using this."
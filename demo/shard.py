@@ -0,0 +1,321 @@
+"""
+Sharding of sessions over several worker processes sharing one listening
+port.
+
+A supervisor process binds the public port and starts the workers, which all
+accept connections on it. Each session is owned by exactly one worker, chosen
+by consistent hashing of its name. Workers forward requests for sessions they
+do not own to the owner: session pages are proxied over HTTP, and WebSocket
+connections joining a foreign session are relayed message by message, so the
+owner handles them like its own connections. Connections multiplexing several
+sessions relay the messages addressed to each foreign session through a relay
+of its own; the owner closing one closes the client's connection.
+"""
+
+import os
+import socket
+import sys
+
+from bisect import bisect
+from hashlib import md5
+
+from twisted.internet import defer, protocol, reactor
+from twisted.protocols import basic
+from twisted.web import proxy
+from eventlog import ERROR, WARNING
+from websocket import PreparedFrame
+
+# Workers listen on localhost for proxied session pages and relayed
+# connections on these ports plus their index.
+INTERNAL_HTTP_PORT = 9100
+RELAY_PORT = 9200
+
+# Number of points each worker is placed on the hash ring. More points even
+# out the number of sessions each worker owns.
+REPLICAS = 160
+
+# Longest message relayed between workers; synchronization frames can be large.
+RELAY_MAX_LENGTH = 64 * 1024 * 1024
+
+def _hash(key):
+	return int(md5(key).hexdigest()[:8], 16)
+
+class HashRing(object):
+	"""Maps keys to nodes by consistent hashing: every node is placed on a ring
+	of hash values several times, and a key belongs to the node following its
+	hash on the ring. Adding or removing a node only moves the keys of the
+	ring segments it takes over or gives up."""
+
+	def __init__(self, nodes, replicas=REPLICAS):
+		points = sorted((_hash("%s-%d" % (node, replica)), node)
+			for node in nodes for replica in xrange(replicas))
+		self.hashes = [point for point, node in points]
+		self.nodes = [node for point, node in points]
+
+	def owner(self, key):
+		if isinstance(key, unicode):
+			key = key.encode("utf-8")
+		index = bisect(self.hashes, _hash(key))
+		return self.nodes[index % len(self.nodes)]
+
+class Shard(object):
+	"""The part of the sessions owned by this worker process. Relays that fail
+	are logged to the given EventLog."""
+
+	def __init__(self, index, workers, eventLog=None):
+		self.index = index
+		self.workers = workers
+		self.ring = HashRing(range(workers))
+		self.eventLog = eventLog
+
+	def owns(self, name):
+		return self.ring.owner(name) == self.index
+
+	def proxyResource(self, name, path):
+		"""Returns a resource proxying the given path to the owner of the named
+		session."""
+		return proxy.ReverseProxyResource("127.0.0.1",
+			INTERNAL_HTTP_PORT + self.ring.owner(name), path)
+
+	def relay(self, handler, name, binary, frame):
+		"""Relays the WebSocket connection of the given handler to the owner of
+		the named session, starting with the given frame. binary tells whether
+		the client's transport can send binary frames."""
+		factory = RelayClientFactory(handler, ["o" + (binary and "b" or ""), "t" + frame], self.eventLog)
+		reactor.connectTCP("127.0.0.1", RELAY_PORT + self.ring.owner(name), factory)
+		return factory
+
+	def listen(self, site, handlerFactory):
+		"""Starts listening for proxied requests and relayed connections."""
+		reactor.listenTCP(INTERNAL_HTTP_PORT + self.index, site, interface="127.0.0.1")
+		reactor.listenTCP(RELAY_PORT + self.index, RelayServerFactory(handlerFactory),
+			interface="127.0.0.1")
+
+# Relayed messages are netstrings starting with a byte giving their kind:
+# "o" opens the relayed connection (followed by "b" if the client can receive
+# binary frames), "t" and "b" carry text and binary frames and "c" closes the
+# client's connection.
+
+def _netstring(data):
+	return "%d:%s," % (len(data), data)
+
+class RelayClient(basic.NetstringReceiver):
+	"""Forwards frames between a client connected to this worker and the
+	worker owning its session."""
+	MAX_LENGTH = RELAY_MAX_LENGTH
+
+	def connectionMade(self):
+		self.factory.connected(self)
+
+	def stringReceived(self, message):
+		if self.factory.closed:
+			return
+		transport = self.factory.handler.transport
+		kind, data = message[:1], message[1:]
+		if kind == "t":
+			transport.write(data)
+		elif kind == "b":
+			transport.writeBinary(data)
+		elif kind == "c":
+			transport.loseConnection()
+
+	def connectionLost(self, reason):
+		self.factory.disconnected()
+
+class RelayClientFactory(protocol.ClientFactory):
+	protocol = RelayClient
+
+	def __init__(self, handler, pending, eventLog=None):
+		self.handler = handler
+		self.pending = pending
+		self.eventLog = eventLog
+		self.client = None
+		self.closed = False
+
+	def connected(self, client):
+		if self.closed:
+			client.transport.loseConnection()
+			return
+		self.client = client
+		for message in self.pending:
+			client.sendString(message)
+		self.pending = None
+
+	def disconnected(self):
+		# The owner has gone away, so the client has to reconnect.
+		self.client = None
+		if not self.closed:
+			self.closed = True
+			self.handler.transport.loseConnection()
+
+	def clientConnectionFailed(self, connector, reason):
+		if self.eventLog is not None:
+			self.eventLog.log(WARNING, "relay_failed", address=self.handler.address,
+				destination=str(connector.getDestination()), error=reason.getErrorMessage())
+		self.disconnected()
+
+	def forward(self, kind, data):
+		"""Forwards a frame received from the client to the owner."""
+		if self.client is not None:
+			self.client.sendString(kind + data)
+		elif not self.closed:
+			self.pending.append(kind + data)
+
+	def close(self):
+		"""Called when the client has disconnected."""
+		self.closed = True
+		if self.client is not None:
+			self.client.transport.loseConnection()
+
+class RelayTransport(object):
+	"""Stands in for the WebSocket transport of a client connected to another
+	worker, sending everything written to it through the relay."""
+
+	# Frames are prepared once for all relayed clients.
+	framing = "relay"
+
+	# Frames and bytes relayed from and to the client, counted like those of
+	# WebSocket transports.
+	framesReceived = 0
+	bytesReceived = 0
+	framesSent = 0
+	bytesSent = 0
+
+	def __init__(self, relay):
+		self.relay = relay
+
+	def _write(self, data, frames=1):
+		self.framesSent += frames
+		self.bytesSent += len(data)
+		self.relay.transport.write(data)
+
+	def write(self, frame):
+		self._write(_netstring("t" + frame))
+
+	def writeSequence(self, frames):
+		self._write("".join([_netstring("t" + frame) for frame in frames]), len(frames))
+
+	def prepareFrame(self, frame):
+		return PreparedFrame(self.framing, _netstring("t" + frame))
+
+	def writePrepared(self, prepared):
+		self._write(prepared.data)
+
+	def pauseReading(self):
+		self.relay.transport.pauseProducing()
+
+	def resumeReading(self):
+		self.relay.transport.resumeProducing()
+
+	def loseConnection(self):
+		self.relay.sendString("c")
+		self.relay.transport.loseConnection()
+
+class BinaryRelayTransport(RelayTransport):
+	"""RelayTransport for clients that can receive binary frames."""
+
+	def writeBinary(self, data):
+		self._write(_netstring("b" + data))
+
+	def prepareBinary(self, data):
+		return PreparedFrame(self.framing, _netstring("b" + data))
+
+class RelayServer(basic.NetstringReceiver):
+	"""Receives a client connection relayed from another worker and hands it to
+	a handler as if the client was connected directly."""
+	MAX_LENGTH = RELAY_MAX_LENGTH
+
+	handler = None
+
+	def stringReceived(self, message):
+		kind, data = message[:1], message[1:]
+		if self.handler is None:
+			if kind != "o":
+				self.transport.loseConnection()
+				return
+			if data == "b":
+				transport = BinaryRelayTransport(self)
+			else:
+				transport = RelayTransport(self)
+			self.handler = self.factory.handlerFactory(transport)
+			self.handler.connectionMade()
+			return
+
+		self.handler.transport.framesReceived += 1
+		self.handler.transport.bytesReceived += len(message)
+		if kind == "t":
+			self.handler.frameReceived(data)
+		elif kind == "b":
+			self.handler.binaryFrameReceived(data)
+
+	def connectionLost(self, reason):
+		if self.handler is not None:
+			self.handler.connectionLost(reason)
+
+class RelayServerFactory(protocol.ServerFactory):
+	protocol = RelayServer
+
+	def __init__(self, handlerFactory):
+		self.handlerFactory = handlerFactory
+
+class Worker(protocol.ProcessProtocol):
+	def __init__(self, supervisor, index):
+		self.supervisor = supervisor
+		self.index = index
+
+	def processEnded(self, reason):
+		self.supervisor.workerEnded(self.index, reason)
+
+class Supervisor(object):
+	"""Binds the listening port and keeps the given number of worker processes
+	running, each of which runs the given script with the arguments
+	"--worker <index> <workers>" and accepts connections on the port, passed
+	to it as file descriptor 3. Workers ending are logged to the given
+	EventLog."""
+
+	def __init__(self, script, workers, port, eventLog=None):
+		self.script = script
+		self.eventLog = eventLog
+		self.workers = workers
+		self.port = port
+		self.processes = {}
+		self.stopping = False
+		self.stopped = None
+
+	def start(self):
+		self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.socket.bind(("", self.port))
+		self.socket.listen(50)
+		# All workers are woken for a new connection, but only one gets it.
+		self.socket.setblocking(False)
+
+		for index in xrange(self.workers):
+			self.spawn(index)
+		reactor.addSystemEventTrigger("before", "shutdown", self.stop)
+
+	def spawn(self, index):
+		args = [sys.executable, self.script, "--worker", str(index), str(self.workers)]
+		self.processes[index] = reactor.spawnProcess(Worker(self, index), sys.executable,
+			args, env=os.environ, path=os.path.dirname(os.path.abspath(self.script)),
+			childFDs={0: 0, 1: 1, 2: 2, 3: self.socket.fileno()})
+
+	def workerEnded(self, index, reason):
+		del self.processes[index]
+		if not self.stopping:
+			if self.eventLog is not None:
+				self.eventLog.log(ERROR, "worker_ended", worker=index, error=reason.getErrorMessage())
+			self.spawn(index)
+		elif not self.processes and self.stopped is not None:
+			self.stopped.callback(None)
+
+	def stop(self):
+		"""Stops all workers. Returns a Deferred firing once they have exited,
+		which gives them the chance to write their journals."""
+		self.stopping = True
+		if not self.processes:
+			return None
+		self.stopped = defer.Deferred()
+		for process in self.processes.values():
+			process.signalProcess("TERM")
+		return self.stopped
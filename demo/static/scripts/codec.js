@@ -0,0 +1,232 @@
+// A compact binary encoding for insert, delete and undo commands, used instead
+// of JSON when the server supports it. See codec.py for a description of the
+// format. Both sides of a stream have to start from the same base vector, as
+// state vectors are encoded as the difference to the previous command's.
+
+var CommandCodec = {
+	INSERT: 1,
+	DELETE: 2,
+	DELETE_SEGMENTS: 3,
+	UNDO: 4,
+	SESSION: 5
+};
+
+// On connections multiplexing several sessions, messages are addressed to a
+// session by prefixing them with its name.
+
+CommandCodec.addressMessage = function(name, buffer) {
+	var out = [CommandCodec.SESSION];
+	CommandCodec.writeText(out, name);
+	var message = new Uint8Array(out.length + buffer.byteLength);
+	message.set(out);
+	message.set(new Uint8Array(buffer), out.length);
+	return message.buffer;
+};
+
+// Return the name of the session a message is addressed to, or null, and the
+// message without the address.
+
+CommandCodec.splitAddress = function(buffer) {
+	var data = new Uint8Array(buffer);
+	if (data.length == 0 || data[0] != CommandCodec.SESSION)
+		return [null, buffer];
+
+	var reader = new CommandDecoder();
+	reader._data = data;
+	reader._offset = 1;
+	var name = reader._readText();
+	return [name, buffer.slice(reader._offset)];
+};
+
+function CommandEncoder(base) {
+	this.base = new Vector(base);
+}
+
+// Encode a list of [command, args] pairs into an ArrayBuffer. The arguments
+// are the same as for JSON commands, except that the vector may also be a
+// Vector.
+
+CommandEncoder.prototype.encode = function(commands) {
+	var out = [];
+	for (var index = 0; index < commands.length; index++) {
+		var command = commands[index][0];
+		var args = commands[index][1];
+
+		if (command == "insert") {
+			out.push(CommandCodec.INSERT);
+		} else if (command == "delete") {
+			out.push((typeof(args[3]) == "number") ? CommandCodec.DELETE : CommandCodec.DELETE_SEGMENTS);
+		} else {
+			out.push(CommandCodec.UNDO);
+		}
+		CommandCodec.writeVarint(out, args[0]);
+		this._encodeVector(out, new Vector(args[1]));
+
+		if (command == "insert") {
+			CommandCodec.writeVarint(out, args[2]);
+			CommandCodec.writeText(out, args[3]);
+		} else if (command == "delete") {
+			CommandCodec.writeVarint(out, args[2]);
+			if (typeof(args[3]) == "number") {
+				CommandCodec.writeVarint(out, args[3]);
+			} else {
+				CommandCodec.writeVarint(out, args[3].length);
+				for (var segment = 0; segment < args[3].length; segment++) {
+					CommandCodec.writeVarint(out, args[3][segment][0]);
+					CommandCodec.writeText(out, args[3][segment][1]);
+				}
+			}
+		}
+	}
+	return new Uint8Array(out).buffer;
+};
+
+CommandEncoder.prototype._encodeVector = function(out, vector) {
+	var base = this.base;
+	var changed = [];
+	vector.eachUser(function(u, v) {
+		if (base.get(u) != v)
+			changed.push(u, v - base.get(u));
+	});
+	base.eachUser(function(u, v) {
+		if (v > 0 && vector.get(u) == 0)
+			changed.push(u, -v);
+	});
+
+	CommandCodec.writeVarint(out, changed.length / 2);
+	for (var index = 0; index < changed.length; index += 2) {
+		var delta = changed[index + 1];
+		CommandCodec.writeVarint(out, changed[index]);
+		CommandCodec.writeVarint(out, (delta >= 0) ? delta * 2 : -delta * 2 - 1);
+	}
+	this.base = vector;
+};
+
+function CommandDecoder(base) {
+	this.base = new Vector(base);
+}
+
+// Decode an ArrayBuffer into a list of [command, args] pairs. Vectors are
+// returned as Vector objects.
+
+CommandDecoder.prototype.decode = function(buffer) {
+	this._data = new Uint8Array(buffer);
+	this._offset = 0;
+
+	var commands = [];
+	while (this._offset < this._data.length) {
+		var type = this._data[this._offset++];
+		var args = [this._readVarint(), this._decodeVector()];
+
+		if (type == CommandCodec.INSERT) {
+			args.push(this._readVarint(), this._readText());
+			commands.push(["insert", args]);
+		} else if (type == CommandCodec.DELETE) {
+			args.push(this._readVarint(), this._readVarint());
+			commands.push(["delete", args]);
+		} else if (type == CommandCodec.DELETE_SEGMENTS) {
+			var position = this._readVarint();
+			var segments = [];
+			for (var count = this._readVarint(); count > 0; count--)
+				segments.push([this._readVarint(), this._readText()]);
+			args.push(position, segments);
+			commands.push(["delete", args]);
+		} else if (type == CommandCodec.UNDO) {
+			commands.push(["undo", args]);
+		} else {
+			throw new Error("Unknown command type " + type);
+		}
+	}
+
+	this._data = null;
+	return commands;
+};
+
+CommandDecoder.prototype._decodeVector = function() {
+	var vector = new Vector(this.base);
+	for (var count = this._readVarint(); count > 0; count--) {
+		var user = this._readVarint();
+		var delta = this._readVarint();
+		vector.set(user, vector.get(user) + ((delta % 2 == 0) ? delta / 2 : -(delta + 1) / 2));
+	}
+	this.base = vector;
+	return new Vector(vector);
+};
+
+CommandDecoder.prototype._readVarint = function() {
+	var value = 0;
+	var factor = 1;
+	var byte;
+	do {
+		if (this._offset >= this._data.length)
+			throw new Error("Truncated message");
+		byte = this._data[this._offset++];
+		value += (byte & 0x7F) * factor;
+		factor *= 128;
+	} while (byte >= 0x80);
+	return value;
+};
+
+// Text is UTF-8 encoded. Unpaired surrogates are encoded like any other code
+// unit so that positions and lengths, which are measured in UTF-16 code units,
+// stay the same on both sides.
+
+CommandDecoder.prototype._readText = function() {
+	var length = this._readVarint();
+	var end = this._offset + length;
+	if (end > this._data.length)
+		throw new Error("Truncated message");
+
+	var data = this._data;
+	var units = [];
+	while (this._offset < end) {
+		var byte = data[this._offset++];
+		if (byte < 0x80) {
+			units.push(byte);
+		} else if (byte < 0xE0) {
+			units.push((byte & 0x1F) << 6 | data[this._offset++] & 0x3F);
+		} else if (byte < 0xF0) {
+			units.push((byte & 0x0F) << 12 | (data[this._offset++] & 0x3F) << 6 | data[this._offset++] & 0x3F);
+		} else {
+			var code = ((byte & 0x07) << 18 | (data[this._offset++] & 0x3F) << 12 |
+				(data[this._offset++] & 0x3F) << 6 | data[this._offset++] & 0x3F) - 0x10000;
+			units.push(0xD800 + (code >> 10), 0xDC00 + (code & 0x3FF));
+		}
+	}
+
+	// Convert in slices to stay below the maximum number of arguments.
+	var text = "";
+	for (var index = 0; index < units.length; index += 4096)
+		text += String.fromCharCode.apply(null, units.slice(index, index + 4096));
+	return text;
+};
+
+CommandCodec.writeVarint = function(out, value) {
+	while (value > 0x7F) {
+		out.push(value % 128 | 0x80);
+		value = Math.floor(value / 128);
+	}
+	out.push(value);
+};
+
+CommandCodec.writeText = function(out, text) {
+	var bytes = [];
+	for (var index = 0; index < text.length; index++) {
+		var unit = text.charCodeAt(index);
+		var next = text.charCodeAt(index + 1);
+		if (unit < 0x80) {
+			bytes.push(unit);
+		} else if (unit < 0x800) {
+			bytes.push(0xC0 | unit >> 6, 0x80 | unit & 0x3F);
+		} else if (unit >= 0xD800 && unit < 0xDC00 && next >= 0xDC00 && next < 0xE000) {
+			var code = 0x10000 + ((unit - 0xD800) << 10) + (next - 0xDC00);
+			bytes.push(0xF0 | code >> 18, 0x80 | code >> 12 & 0x3F, 0x80 | code >> 6 & 0x3F, 0x80 | code & 0x3F);
+			index++;
+		} else {
+			bytes.push(0xE0 | unit >> 12, 0x80 | unit >> 6 & 0x3F, 0x80 | unit & 0x3F);
+		}
+	}
+	CommandCodec.writeVarint(out, bytes.length);
+	for (var index = 0; index < bytes.length; index++)
+		out.push(bytes[index]);
+};
@@ -25,13 +25,28 @@ function CollaborativeEditor(ctl, url, session_id) {
 	var ce = this;
 	ce._localUser = 0;
 	ce._initialized = false;
+	ce._synchronizing = false;
+	ce._undoDepth = null;
+	ce._ackTimeout = null;
+	ce._ackedVector = "";
+	ce._codec = null;
+	ce._encoder = null;
+	ce._decoder = null;
 	ce._state = new State();
 	ce._session_id = session_id;
-	
-	function invokeUpdateHandler() { ce._handleUpdates(); }
-	
+	ce._view = new AuthorshipView($("#buffer")[0]);
+	ce._inputEvents = false;
+	ce._pendingInput = null;
+
+	// Browsers firing "beforeinput" events tell about each change as it is
+	// made, so the text only needs to be compared when they don't.
+	function invokeUpdateHandler() { if (!ce._inputEvents) ce._handleUpdates(); }
+
 	ce._ctl = ctl;
-	ce._ctl.addEventListener("change", invokeUpdateHandler);
+	ce._ctl.addEventListener("beforeinput", function(event) { ce._beforeInput(event); });
+	ce._ctl.addEventListener("input", function(event) { ce._input(event); });
+	ce._ctl.addEventListener("compositionend", function(event) { ce._handleUpdates(); });
+	ce._ctl.addEventListener("change", function(event) { ce._handleUpdates(); });
 	ce._ctl.addEventListener("paste", invokeUpdateHandler);
 	ce._ctl.addEventListener("textInput", invokeUpdateHandler);
 	ce._ctl.addEventListener("keyup", invokeUpdateHandler);
@@ -52,42 +67,131 @@ function CollaborativeEditor(ctl, url, session_id) {
 			event.preventDefault();
 			return false;
 		}
-		
-		ce._handleUpdates();
+
+		invokeUpdateHandler();
 	});
 	
 	// Disable drag and drop - there doesn't seem to be a reliable way of detecting such changes
 	ce._ctl.addEventListener("dragover", function(event) { event.preventDefault(); return false; });
 	
 	ce._ctl.readonly = "readonly";
-	
-	ce._prevValue = ce._ctl.value;
-	
-	console.debug("Opening WebSocket URL", url);
-	ce._socket = new WebSocket(url);
-	ce._socket.onopen = function(event) { ce._onSocketOpen(event); };
-	ce._socket.onclose = ce._socket.onerror = function(event) { ce._onSocketConnectionLost(); };
-	ce._socket.onmessage = function(event) { ce._onSocketMessage(event); }
+
+	// Editors of several sessions may share one connection, given instead of
+	// the WebSocket URL.
+	ce._connection = (typeof(url) == "string") ? new SessionConnection(url) : url;
+	ce._connection.attach(ce);
 	
 	return true;
 }
 
-// Post a command and arguments to the server.
+// Interval in milliseconds in which the client acknowledges the state it has
+// reached, which allows the server to discard old requests from its log.
+
+CollaborativeEditor.ACK_INTERVAL = 1000;
+
+// Post a command and arguments to the server. Insert, delete and undo commands
+// are sent in binary if the server supports it.
 
 CollaborativeEditor.prototype._postCommand = function(command, args) {
 	console.debug("<--", command, args);
-	var jsonData = JSON.stringify([[command, args], ]);
-	this._socket.send(jsonData);
+	if (this._encoder !== null && (command == "insert" || command == "delete" || command == "undo")) {
+		this._connection.sendBinary(this._session_id, this._encoder.encode([[command, args], ]));
+	} else {
+		this._connection.send(this._session_id, [[command, args], ]);
+	}
+};
+
+// Leave the session. The connection stays open for other editors sharing it.
+
+CollaborativeEditor.prototype.close = function() {
+	this._postCommand("leave_session");
+	this._connection.detach(this);
+	this._initialized = false;
+	this._ctl.readonly = "readonly";
+};
+
+// Input types whose changes lie between the selection before and the cursor
+// after them, such as typing, pasting or deleting at the cursor.
+
+CollaborativeEditor.SELECTION_INPUT_TYPES = {
+	insertText: true, insertLineBreak: true, insertParagraph: true,
+	insertFromPaste: true, deleteByCut: true,
+	deleteContentBackward: true, deleteContentForward: true,
+	deleteWordBackward: true, deleteWordForward: true,
+	deleteSoftLineBackward: true, deleteSoftLineForward: true,
+	deleteHardLineBackward: true, deleteHardLineForward: true
+};
+
+CollaborativeEditor.prototype._beforeInput = function(event) {
+	// Remember the selection the input is about to replace.
+	this._inputEvents = true;
+	this._pendingInput = {
+		type: event.inputType,
+		start: this._ctl.selectionStart,
+		end: this._ctl.selectionEnd,
+		length: this._textLength()
+	};
+};
+
+CollaborativeEditor.prototype._input = function(event) {
+	var pending = this._pendingInput;
+	this._pendingInput = null;
+
+	// Text being composed by an input method is sent once it is complete.
+	if (!this._initialized || event.isComposing) return;
+
+	if (pending === null || pending.type != event.inputType || !this._captureInput(pending, event.data))
+		this._handleUpdates();
+};
+
+// Derive the change made by an input from the selection before and the cursor
+// after it, reading only the text inserted, so that its cost depends on the
+// size of the change rather than that of the document. Returns false if the
+// change can't be told this way.
+
+CollaborativeEditor.prototype._captureInput = function(pending, data) {
+	if (!CollaborativeEditor.SELECTION_INPUT_TYPES[pending.type] || lineSeparator_local != lineSeparator_network)
+		return false;
+
+	// The text between start and end has been replaced by inserted characters,
+	// after which the cursor is placed.
+	var cursor = this._ctl.selectionEnd;
+	var delta = this._textLength() - pending.length;
+	var start = Math.min(pending.start, cursor);
+	var end = Math.max(pending.end, cursor - delta);
+	var inserted = end + delta - start;
+	if (start < 0 || end > pending.length || inserted < 0)
+		return false;
+
+	var text = "";
+	if (inserted > 0) {
+		// Typed text comes with the event, pasted text has to be read.
+		if (data != null && data.length == inserted)
+			text = data;
+		else
+			text = this._ctl.value.substr(start, inserted);
+	}
+
+	if (end > start)
+		this._deleteText(start, end - start);
+	if (text.length > 0)
+		this._insertText(start, text);
+	return true;
+};
+
+CollaborativeEditor.prototype._textLength = function() {
+	return (this._ctl.textLength != undefined) ? this._ctl.textLength : this._ctl.value.length;
 };
 
-// Check if changes have been made to the input control.
+// Check if changes have been made to the input control by comparing its text
+// to the buffer's.
 
 CollaborativeEditor.prototype._handleUpdates = function() {
 	// Don't process updates while we're not done with synchronization yet.
 	if (!this._initialized) return false;
 	
 	// Call Diff-Match-Patch to obtain a list of differences.
-	var diffs = dmp.diff_main(lineSeparator_toNetwork(this._prevValue), lineSeparator_toNetwork(this._ctl.value));
+	var diffs = dmp.diff_main(this._state.buffer.toString(), lineSeparator_toNetwork(this._ctl.value));
 	
 	var offset = 0;
 	for (var diffIndex in diffs) {
@@ -96,35 +200,40 @@ CollaborativeEditor.prototype._handleUpdates = function() {
 		var diffText = diffData[1];
 
 		if (diffType == 1) {
-			// Text has been inserted. Create an insert request out of the change.
-			
-			var buffer = new Buffer([new Segment(this._localUser, diffText)]);
-			var operation = new Operations.Insert(offset, buffer);
-			var request = new DoRequest(this._localUser, this._state.vector, operation);
-			
-			// Post the request to the server.
-			this._postCommand("insert", [this._localUser, request.vector.toString(), offset, diffText]);
-			
-			// Execute the request locally to update the internal buffer.
-			this._state.execute(request);
-			
+			// Text has been inserted.
+			this._insertText(offset, diffText);
 			offset += diffText.length;
 		} else if (diffType == -1) {
 			// Text has been removed.
-			
-			var buffer = this._state.buffer.slice(offset, offset + diffText.length);
-			var operation = new Operations.Delete(offset, buffer);
-			var request = new DoRequest(this._localUser, this._state.vector, operation);
-			
-			this._postCommand("delete", [this._localUser, request.vector.toString(), offset, diffText.length]);
-			this._state.execute(request);
+			this._deleteText(offset, diffText.length);
 		} else {
 			offset += diffText.length;
 		}
 	}
+};
+
+CollaborativeEditor.prototype._insertText = function(offset, text) {
+	// Create an insert request out of the change.
+	var buffer = new Buffer([new Segment(this._localUser, text)]);
+	var operation = new Operations.Insert(offset, buffer);
+	var request = new DoRequest(this._localUser, this._state.vector, operation);
+	
+	// Post the request to the server.
+	this._postCommand("insert", [this._localUser, request.vector, offset, text]);
+	
+	// Execute the request locally to update the internal buffer.
+	this._state.execute(request);
+	this._view.apply(operation);
+};
+
+CollaborativeEditor.prototype._deleteText = function(offset, length) {
+	var buffer = this._state.buffer.slice(offset, offset + length);
+	var operation = new Operations.Delete(offset, buffer);
+	var request = new DoRequest(this._localUser, this._state.vector, operation);
 	
-	this._prevValue = this._ctl.value;
-	$("#buffer").html(this._state.buffer.toHTML());
+	this._postCommand("delete", [this._localUser, request.vector, offset, length]);
+	this._state.execute(request);
+	this._view.apply(operation);
 };
 
 CollaborativeEditor.prototype._undo = function() {
@@ -132,10 +241,10 @@ CollaborativeEditor.prototype._undo = function() {
 	var request = new UndoRequest(this._localUser, this._state.vector);
 
 	// Check whether the undo request is valid, i.e. there is a request to be
-	// undone at all.
-	if (this._state.canExecute(request)) {
+	// undone at all and the server still keeps it in its log.
+	if (this._state.canExecute(request) && this._canUndo(request)) {
 		// Post the undo request to the other peers
-		this._postCommand("undo", [this._localUser, request.vector.toString()]);
+		this._postCommand("undo", [this._localUser, request.vector]);
 
 		// Execute the undo request, then update the control to reflect the changes
 		var executedRequest = this._state.execute(request);
@@ -143,71 +252,98 @@ CollaborativeEditor.prototype._undo = function() {
 	}
 };
 
+CollaborativeEditor.prototype._canUndo = function(request) {
+	// Requests older than the undo depth may have been discarded by the server.
+	if (this._undoDepth === null)
+		return true;
+	
+	var associated = request.associatedRequest(this._state.log);
+	return associated.vector.get(this._localUser) >=
+		this._state.vector.get(this._localUser) - this._undoDepth;
+};
+
+CollaborativeEditor.prototype._scheduleAck = function() {
+	// Tell the server which state we have reached, but not more often than
+	// every ACK_INTERVAL milliseconds.
+	if (this._ackTimeout !== null)
+		return;
+	
+	var ce = this;
+	this._ackTimeout = window.setTimeout(function() {
+		ce._ackTimeout = null;
+		
+		var vector = ce._state.vector.toString();
+		if (vector != ce._ackedVector) {
+			ce._ackedVector = vector;
+			ce._postCommand("ack", [vector]);
+		}
+	}, CollaborativeEditor.ACK_INTERVAL);
+};
+
 CollaborativeEditor.prototype._updateControl = function(executedRequest) {
 	// Update the control to account for the given request and (try to) make sure
-	// the edit cursor is positioned correctly afterwards.
+	// the edit cursor is positioned correctly afterwards. Only the text changed
+	// is replaced if the browser allows for it.
 
 	if (this._initialized) {
-		if (executedRequest.operation instanceof Operations.Insert) {
-			// Backup cursor position
-			var selectionStart = this._ctl.selectionStart;
-			var selectionEnd = this._ctl.selectionEnd;
-			
-			this._updateFromBuffer();
-			
-			var textLength = executedRequest.operation.text.getLength();
-			
-			if (executedRequest.operation.position < selectionStart) {
-				// Text was inserted before our selection, so we shift it entirely.
-				selectionStart += textLength;
-				selectionEnd += textLength;
-			} else if (executedRequest.operation.position >= selectionStart && executedRequest.operation.position < selectionEnd) {
-				// Text was inserted inside our selection, so we only adjust its end position.
-				selectionEnd += textLength;
-			}
-			
-			// Restore cursor position
-			this._ctl.selectionStart = selectionStart;
-			this._ctl.selectionEnd = selectionEnd;
-		} else if (executedRequest.operation instanceof Operations.Delete) {
-			// Backup cursor position
-			var selectionStart = this._ctl.selectionStart;
-			var selectionEnd = this._ctl.selectionEnd;
-			
-			this._updateFromBuffer();
-			
-			function processDeleteOperation(operation) {
-				if (operation instanceof Operations.Split) {
-					// Delete operations might have been split; we therefore need to process
-					// them recursively.
-					return processDeleteOperation(operation.first) + processDeleteOperation(operation.second);
-				} else {
-					var textLength = operation.getLength();
-					
-					if (operation.position < selectionStart) {
-						// Text was removed before our selection.
-						selectionStart -= textLength;
-						selectionEnd -= textLength;
-					} else if (operation.position >= selectionStart && operation.position < selectionEnd) {
-						// Text was removed inside our selection.
-						selectionEnd -= textLength;
-					}
+		var ctl = this._ctl;
+		var view = this._view;
+		var inPlace = (ctl.setRangeText != undefined && lineSeparator_local == lineSeparator_network);
+		
+		// Backup cursor position
+		var selectionStart = ctl.selectionStart;
+		var selectionEnd = ctl.selectionEnd;
+		
+		eachOperation(executedRequest.operation, function(operation) {
+			if (operation instanceof Operations.Insert) {
+				var textLength = operation.text.getLength();
+				
+				if (operation.position < selectionStart) {
+					// Text was inserted before our selection, so we shift it entirely.
+					selectionStart += textLength;
+					selectionEnd += textLength;
+				} else if (operation.position >= selectionStart && operation.position < selectionEnd) {
+					// Text was inserted inside our selection, so we only adjust its end position.
+					selectionEnd += textLength;
+				}
+				
+				if (inPlace)
+					ctl.setRangeText(operation.text.toString(), operation.position, operation.position);
+			} else {
+				var textLength = operation.getLength();
+				
+				if (operation.position < selectionStart) {
+					// Text was removed before our selection.
+					selectionStart -= textLength;
+					selectionEnd -= textLength;
+				} else if (operation.position >= selectionStart && operation.position < selectionEnd) {
+					// Text was removed inside our selection.
+					selectionEnd -= textLength;
 				}
+				
+				if (inPlace)
+					ctl.setRangeText("", operation.position, operation.position + textLength);
 			}
 			
-			processDeleteOperation(executedRequest.operation);
-			
-			// Restore cursor position
-			this._ctl.selectionStart = selectionStart;
-			this._ctl.selectionEnd = selectionEnd;
-		}
+			if (inPlace)
+				view.apply(operation);
+		});
+		
+		if (!inPlace)
+			this._updateFromBuffer();
+		
+		// Restore cursor position
+		ctl.selectionStart = selectionStart;
+		ctl.selectionEnd = selectionEnd;
 	}
 };
 
 CollaborativeEditor.prototype._onSocketOpen = function(event) {
 	// The WebSocket has been established - request an user ID from the server.
+	// Offer the binary codec if the browser can handle binary data.
 	console.debug("WebSocket opened, attempting to join session", this._session_id);
-	this._postCommand("join_session", [this._session_id,]);
+	var codecs = (window.Uint8Array != undefined) ? ["binary"] : [];
+	this._postCommand("join_session", [this._session_id, codecs]);
 };
 
 CollaborativeEditor.prototype._onSocketConnectionLost = function() {
@@ -217,55 +353,70 @@ CollaborativeEditor.prototype._onSocketConnectionLost = function() {
 	this._ctl.readonly = "readonly";
 }
 
-CollaborativeEditor.prototype._onSocketMessage = function(event) {
-	// Process commands sent by the server.
-	
-	var jsonData = JSON.parse(event.data);
+CollaborativeEditor.prototype._commandsReceived = function(commands) {
+	// Process commands sent by the server to this editor's session.
 	
-	for (var commandIndex in jsonData) {
-		var command = jsonData[commandIndex][0];
-		var args = jsonData[commandIndex][1];
+	for (var commandIndex = 0; commandIndex < commands.length; commandIndex++) {
+		var command = commands[commandIndex][0];
+		var args = commands[commandIndex][1];
 		
 		console.debug("-->", command, args);
 
 		if (command == "assign_uid") {
 			// The server has assigned us an user ID.
 			this._localUser = parseInt(args[0]);
-			console.debug("Assigned user ID:", this._localUser);
+			this._undoDepth = (args[1] == null) ? null : parseInt(args[1]);
+			this._codec = (args[2] == undefined) ? null : args[2];
+			if (this._codec == "binary")
+				this._encoder = new CommandEncoder();
+			console.debug("Assigned user ID:", this._localUser, "codec:", this._codec);
 			this._synchronize();
+		} else if (command == "sync_begin") {
+			this._synchronizing = true;
+		} else if (command == "sync_snapshot") {
+			// The server has sent the current document contents and state vector.
+			var buffer = segmentsToBuffer(args[0]);
+			this._state = new State(buffer, new Vector(args[1]));
 		} else if (command == "sync_end") {
 			// Synchronization is done. Update and unlock the edit control.
 			console.debug("Synchronization completed");
+			this._synchronizing = false;
 			this._initialized = true;
+			if (this._codec == "binary") {
+				// Binary commands from now on encode their vectors relative to
+				// the given one.
+				this._decoder = new CommandDecoder(args[0]);
+			}
+			this._ackedVector = this._state.vector.toString();
 			this._updateFromBuffer();
 			this._unlockCtl();
-		} else if (command == "insert") {
-			if (args[0] != this._localUser) {
-				// We have received an insert request from another user.
-				
-				var buffer = new Buffer([new Segment(args[0], args[3])]);
-				var operation = new Operations.Insert(args[2], buffer);
-				var request = new DoRequest(args[0], new Vector(args[1]), operation);
-				
-				var executedRequest = this._state.execute(request);
-				this._updateControl(executedRequest);
-			}
-		} else if (command == "delete") {
-			if (args[0] != this._localUser) {
-				// We have received a delete request from another user.
-				
-				var operation = new Operations.Delete(args[2], args[3]);
-				var request = new DoRequest(args[0], new Vector(args[1]), operation);
-				
-				var executedRequest = this._state.execute(request);
-				this._updateControl(executedRequest);
-			}
-		} else if (command == "undo") {
-			if (args[0] != this._localUser) {
-				var request = new UndoRequest(args[0], new Vector(args[1]));
-				
+		} else if (command == "resync") {
+			// We fell behind reading broadcasts, so the server stopped sending
+			// them. Send the changes made so far and lock the edit control until
+			// we have obtained the current state again.
+			console.warn("Fell behind, synchronizing again");
+			this._handleUpdates();
+			this._initialized = false;
+			this._ctl.readonly = "readonly";
+			this._synchronize();
+		} else if (command == "prune") {
+			// The server has discarded requests nobody needs anymore, so we can
+			// discard them as well. The log of a synchronization in progress
+			// is already pruned.
+			if (this._initialized && !this._synchronizing)
+				this._state.prune(new Vector(args[0]), new Vector(args[1]));
+		} else if (command == "insert" || command == "delete" || command == "undo") {
+			var request = requestFromCommand(command, args);
+
+			if (this._synchronizing) {
+				// Requests sent during synchronization are already contained in
+				// the snapshot; we only need them in our log.
+				this._state.log.push(request);
+			} else if (args[0] != this._localUser) {
+				// We have received a request from another user.
 				var executedRequest = this._state.execute(request);
 				this._updateControl(executedRequest);
+				this._scheduleAck();
 			}
 		}
 	}
@@ -285,10 +436,315 @@ CollaborativeEditor.prototype._synchronize = function() {
 CollaborativeEditor.prototype._updateFromBuffer = function() {
 	// Update the displayed text using the current buffer contents.
 	
-	this._prevValue = this._ctl.value = lineSeparator_fromNetwork(this._state.buffer.toString());
-	$("#buffer").html(this._state.buffer.toHTML());
+	this._ctl.value = lineSeparator_fromNetwork(this._state.buffer.toString());
+	this._view.reset(this._state.buffer);
+};
+
+// Shows the authorship of the text in the given element like Buffer.toHTML,
+// as one span per segment. Operations only change the spans they touch, so
+// they take no longer on long documents. The span last edited is remembered
+// along with its position, as edits tend to follow each other closely.
+
+function AuthorshipView(element) {
+	this._element = (element != undefined) ? element : null;
+	this._root = null;
+	this._node = null;
+	this._start = 0;
+}
+
+AuthorshipView.prototype.reset = function(buffer) {
+	if (this._element === null) return;
+	
+	this._root = document.createElement("span");
+	this._root.className = "buffer";
+	for (var index = 0; index < buffer.segments.length; index++) {
+		var segment = buffer.segments[index];
+		if (segment.text.length > 0)
+			this._root.appendChild(this._createSegment(segment.user, segment.text));
+	}
+	
+	while (this._element.firstChild)
+		this._element.removeChild(this._element.firstChild);
+	this._element.appendChild(this._root);
+	this._node = null;
+};
+
+// Apply an Insert, Delete or Split operation to the view.
+
+AuthorshipView.prototype.apply = function(operation) {
+	if (this._root === null) return;
+	
+	var view = this;
+	eachOperation(operation, function(operation) {
+		if (operation instanceof Operations.Insert)
+			view._insert(operation.position, operation.text.segments);
+		else
+			view._remove(operation.position, operation.getLength());
+	});
+};
+
+AuthorshipView.prototype._createSegment = function(user, text) {
+	var node = document.createElement("span");
+	node.className = "segment user-" + user;
+	node.user = user;
+	node.appendChild(document.createTextNode(text));
+	return node;
+};
+
+// Find the span containing the given position, or the last one if the
+// position is at the end. Its position is stored in _start.
+
+AuthorshipView.prototype._locate = function(position) {
+	var node = this._node;
+	var start = this._start;
+	if (node === null || node.parentNode !== this._root) {
+		node = this._root.firstChild;
+		start = 0;
+	}
+	
+	if (node !== null) {
+		while (position < start && node.previousSibling !== null) {
+			node = node.previousSibling;
+			start -= node.firstChild.length;
+		}
+		while (position >= start + node.firstChild.length && node.nextSibling !== null) {
+			start += node.firstChild.length;
+			node = node.nextSibling;
+		}
+	}
+	
+	this._node = node;
+	this._start = start;
+	return node;
+};
+
+AuthorshipView.prototype._insert = function(position, segments) {
+	var node = this._locate(position);
+	var offset = position - this._start;
+	
+	if (node !== null && segments.length == 1 && segments[0].user == node.user) {
+		// Text typed into a segment of the same user.
+		node.firstChild.insertData(offset, segments[0].text);
+		return;
+	}
+	
+	// Split the span at the position and put the inserted segments between.
+	var previous = node, next = null;
+	if (node !== null && offset == 0) {
+		previous = node.previousSibling;
+		next = node;
+		if (previous !== null)
+			this._start -= previous.firstChild.length;
+	} else if (node !== null && offset < node.firstChild.length) {
+		next = this._createSegment(node.user, node.firstChild.data.substr(offset));
+		node.firstChild.deleteData(offset, node.firstChild.length - offset);
+		this._root.insertBefore(next, node.nextSibling);
+	}
+	
+	for (var index = 0; index < segments.length; index++) {
+		if (segments[index].text.length > 0)
+			this._root.insertBefore(this._createSegment(segments[index].user, segments[index].text), next);
+	}
+	
+	// Merge the inserted spans with each other and their neighbours where they
+	// are by the same user, as Buffer.compact does.
+	var current = (previous !== null) ? previous : this._root.firstChild;
+	while (current !== null && current !== next && current.nextSibling !== null) {
+		var following = current.nextSibling;
+		if (following.user == current.user) {
+			current.firstChild.appendData(following.firstChild.data);
+			this._root.removeChild(following);
+			if (following === next)
+				break;
+		} else {
+			current = following;
+		}
+	}
+	this._node = previous;
+};
+
+AuthorshipView.prototype._remove = function(position, length) {
+	var node = this._locate(position);
+	var offset = position - this._start;
+	
+	// The span before the removed text, which is kept.
+	var previous = node;
+	if (node !== null && offset == 0) {
+		previous = node.previousSibling;
+		if (previous !== null)
+			this._start -= previous.firstChild.length;
+	}
+	
+	while (length > 0 && node !== null) {
+		var next = node.nextSibling;
+		var count = Math.min(length, node.firstChild.length - offset);
+		if (count == node.firstChild.length)
+			this._root.removeChild(node);
+		else
+			node.firstChild.deleteData(offset, count);
+		
+		length -= count;
+		offset = 0;
+		node = next;
+	}
+	
+	// The spans around the removed text may be by the same user now.
+	if (previous !== null && previous.nextSibling !== null && previous.nextSibling.user == previous.user) {
+		previous.firstChild.appendData(previous.nextSibling.firstChild.data);
+		this._root.removeChild(previous.nextSibling);
+	}
+	this._node = previous;
+};
+
+// A WebSocket connection to the server, shared by the editors of any number of
+// sessions. Commands are addressed to a session by a "session" command before
+// them, and binary messages start with the session's name, so each session
+// has a user ID and codec of its own.
+
+function SessionConnection(url) {
+	var connection = this;
+	connection._editors = {};
+	connection._open = false;
+	
+	console.debug("Opening WebSocket URL", url);
+	connection._socket = new WebSocket(url);
+	connection._socket.binaryType = "arraybuffer";
+	connection._socket.onopen = function(event) { connection._onSocketOpen(); };
+	connection._socket.onclose = connection._socket.onerror = function(event) { connection._onSocketConnectionLost(); };
+	connection._socket.onmessage = function(event) { connection._onSocketMessage(event); };
+}
+
+// Add an editor, which joins its session once the connection is open.
+
+SessionConnection.prototype.attach = function(editor) {
+	this._editors[editor._session_id] = editor;
+	if (this._open)
+		editor._onSocketOpen();
+};
+
+SessionConnection.prototype.detach = function(editor) {
+	delete this._editors[editor._session_id];
+};
+
+// Send commands, or a message encoded with the binary codec, to a session.
+
+SessionConnection.prototype.send = function(session, commands) {
+	this._socket.send(JSON.stringify([["session", [session]]].concat(commands), encodeVector));
+};
+
+SessionConnection.prototype.sendBinary = function(session, buffer) {
+	this._socket.send(CommandCodec.addressMessage(session, buffer));
+};
+
+SessionConnection.prototype._onSocketOpen = function() {
+	this._open = true;
+	for (var session in this._editors)
+		this._editors[session]._onSocketOpen();
+};
+
+SessionConnection.prototype._onSocketConnectionLost = function() {
+	this._open = false;
+	for (var session in this._editors)
+		this._editors[session]._onSocketConnectionLost();
+};
+
+SessionConnection.prototype._onSocketMessage = function(event) {
+	// Binary messages contain insert, delete and undo commands encoded with the
+	// codec negotiated by the session's editor.
+	if (typeof(event.data) != "string") {
+		var message = CommandCodec.splitAddress(event.data);
+		var editor = this._editors[message[0]];
+		if (editor !== undefined)
+			editor._commandsReceived(editor._decoder.decode(message[1]));
+		return;
+	}
+	
+	var commands = JSON.parse(event.data);
+	var session = null;
+	var addressed = [];
+	for (var index = 0; index <= commands.length; index++) {
+		if (index == commands.length || commands[index][0] == "session") {
+			if (addressed.length > 0)
+				this._commandsReceived(session, addressed);
+			if (index < commands.length)
+				session = commands[index][1][0];
+			addressed = [];
+		} else {
+			addressed.push(commands[index]);
+		}
+	}
+};
+
+SessionConnection.prototype._commandsReceived = function(session, commands) {
+	if (session !== null) {
+		var editor = this._editors[session];
+		if (editor !== undefined)
+			editor._commandsReceived(commands);
+		return;
+	}
+	
+	// Commands not addressed to a session concern the whole connection.
+	for (var index = 0; index < commands.length; index++) {
+		var command = commands[index][0];
+		var args = commands[index][1];
+		
+		console.debug("-->", command, args);
+		
+		if (command == "throttle") {
+			// We sent more than the server admits. It processes what we sent
+			// later, so there is nothing to do but wait.
+			console.warn("Sending too fast, throttled for", args[0], "seconds");
+		} else if (command == "error") {
+			// The server refuses to serve us and is about to disconnect.
+			console.error("Disconnected by the server: " + args[1] + " (" + args[0] + ")");
+		}
+	}
 };
 
+// Create a request object out of a command sent by the server. Delete requests
+// from the log sent during synchronization carry the removed segments instead
+// of a length, which makes them reversible.
+
+function requestFromCommand(command, args) {
+	var user = args[0];
+	var vector = new Vector(args[1]);
+
+	if (command == "insert") {
+		var buffer = new Buffer([new Segment(user, args[3])]);
+		return new DoRequest(user, vector, new Operations.Insert(args[2], buffer));
+	} else if (command == "delete") {
+		var what = (typeof(args[3]) == "number") ? args[3] : segmentsToBuffer(args[3]);
+		return new DoRequest(user, vector, new Operations.Delete(args[2], what));
+	} else if (command == "undo") {
+		return new UndoRequest(user, vector);
+	}
+}
+
+// Call the given function with the Insert and Delete operations an operation
+// consists of, in the order Operations.Split.apply applies them.
+
+function eachOperation(operation, callback) {
+	if (operation instanceof Operations.Split) {
+		eachOperation(operation.first, callback);
+		eachOperation(operation.second.transform(operation.first), callback);
+	} else if (!(operation instanceof Operations.NoOp)) {
+		callback(operation);
+	}
+}
+
+// Replacer for JSON.stringify encoding vectors as strings.
+
+function encodeVector(key, value) {
+	return (value instanceof Vector) ? value.toString() : value;
+}
+
+function segmentsToBuffer(segments) {
+	var result = new Array();
+	for (var index = 0; index < segments.length; index++)
+		result.push(new Segment(segments[index][0], segments[index][1]));
+	return new Buffer(result);
+}
+
 // Line separator conversion - some browsers use \n as line breaks, whereas
 // some use \r\n (e.g. Opera)
 
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+"""
+Compares the throughput of servers speaking the demo's /transport protocol,
+e.g. server.py and aioserver.py running side by side:
+
+	python server.py                       (port 8080)
+	python3 aioserver.py 8081
+	python3 transportbench.py localhost:8080 localhost:8081
+
+Each server gets the same number of sessions with the same number of
+simulated peers. Every peer inserts text, waiting for the server to broadcast
+each insertion back before sending the next one, so the round trip time of an
+edit and the rate at which broadcasts are delivered can be measured. Peers use
+JSON commands only, so both servers do the same work. Redirect the servers'
+output to /dev/null, as they print every command, and run server.py without a
+journal.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from wsclient import WebSocketClient
+
+def parseVector(text):
+	components = {}
+	for component in text.split(";") if text else []:
+		user, value = component.split(":")
+		components[int(user)] = int(value)
+	return components
+
+def vectorToString(components):
+	return ";".join("%d:%d" % item for item in sorted(components.items()) if item[1])
+
+class Client(WebSocketClient):
+	"""A simulated editor connected to one session."""
+
+	def __init__(self, host, port, session):
+		WebSocketClient.__init__(self, host, port)
+		self.session = session
+		self.uid = None
+		self.known = {}
+		self.received = 0
+		self.latencies = []
+		self.waiting = {}
+		self.echo = None
+
+	async def connect(self):
+		await WebSocketClient.connect(self)
+		self.send([["join_session", [self.session]]])
+		await self.expect("assign_uid")
+		self.send([["sync", []]])
+		await self.expect("sync_end")
+
+	def expect(self, command):
+		self.waiting[command] = asyncio.get_event_loop().create_future()
+		return self.waiting[command]
+
+	def send(self, commands):
+		self.sendText(json.dumps(commands))
+
+	def messageReceived(self, data):
+		for command, args in json.loads(data.decode("utf-8")):
+			self.commandReceived(command, args)
+
+	def commandReceived(self, command, args):
+		if command == "assign_uid":
+			self.uid = args[0]
+		elif command == "sync_snapshot":
+			self.known = parseVector(args[1])
+		elif command in ("insert", "delete", "undo"):
+			self.received += 1
+			user = args[0]
+			count = parseVector(args[1]).get(user, 0) + 1
+			self.known[user] = max(self.known.get(user, 0), count)
+			if user == self.uid and self.echo is not None:
+				self.echo.set_result(None)
+				self.echo = None
+
+		if command in self.waiting:
+			self.waiting.pop(command).set_result(args)
+
+	async def edit(self, count):
+		for index in range(count):
+			sent = time.time()
+			self.echo = asyncio.get_event_loop().create_future()
+			echoed = self.echo
+			self.send([["insert", [self.uid, vectorToString(self.known), 0, "x"]]])
+			await echoed
+			self.latencies.append(time.time() - sent)
+
+			# Acknowledge the state reached now and then, so the log is pruned.
+			if index % 20 == 19:
+				self.send([["ack", [vectorToString(self.known)]]])
+
+async def createSession(host, port, name):
+	reader, writer = await asyncio.open_connection(host, port)
+	writer.write(("GET /session/%s HTTP/1.1\r\nHost: %s:%d\r\nConnection: close\r\n\r\n"
+		% (name, host, port)).encode("ascii"))
+	await reader.read()
+	writer.close()
+
+async def benchmark(address, sessions, peers, edits):
+	host, port = address.rsplit(":", 1)
+	port = int(port)
+
+	names = ["bench%s" % os.urandom(4).hex() for index in range(sessions)]
+	for name in names:
+		await createSession(host, port, name)
+
+	clients = [Client(host, port, name) for name in names for index in range(peers)]
+	for index in range(0, len(clients), 100):
+		await asyncio.gather(*[client.connect() for client in clients[index:index + 100]])
+
+	started = time.time()
+	await asyncio.gather(*[client.edit(edits) for client in clients])
+	elapsed = time.time() - started
+
+	# Give the last broadcasts a moment to arrive before counting them.
+	await asyncio.sleep(0.5)
+	for client in clients:
+		client.close()
+
+	latencies = sorted(latency for client in clients for latency in client.latencies)
+	return {
+		"edits": len(latencies) / elapsed,
+		"deliveries": sum(client.received for client in clients) / elapsed,
+		"p50": 1000 * latencies[len(latencies) // 2],
+		"p99": 1000 * latencies[int(len(latencies) * 0.99)],
+	}
+
+async def main():
+	parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n")[0])
+	parser.add_argument("addresses", nargs="+", metavar="host:port")
+	parser.add_argument("-s", "--sessions", type=int, default=10)
+	parser.add_argument("-p", "--peers", type=int, default=10, help="peers per session")
+	parser.add_argument("-e", "--edits", type=int, default=100, help="edits per peer")
+	options = parser.parse_args()
+
+	print("%d sessions with %d peers making %d edits each" % (options.sessions, options.peers, options.edits))
+	print("%-22s %12s %14s %10s %10s" % ("server", "edits/s", "deliveries/s", "p50 ms", "p99 ms"))
+	for address in options.addresses:
+		result = await benchmark(address, options.sessions, options.peers, options.edits)
+		print("%-22s %12.0f %14.0f %10.1f %10.1f" % (address, result["edits"],
+			result["deliveries"], result["p50"], result["p99"]))
+
+if __name__ == "__main__":
+	asyncio.run(main())
@@ -9,15 +9,22 @@ and includes support for the hixie-76 handshake.
 WebSocket server protocol.
 
 See U{http://tools.ietf.org/html/draft-hixie-thewebsocketprotocol} for the
-current version of the specification.
+hixie-75 and hixie-76 drafts and U{http://tools.ietf.org/html/rfc6455} for
+the final version of the specification, which is supported along with the
+permessage-deflate extension (U{http://tools.ietf.org/html/rfc7692}).
 
 @since: 10.1
 """
 
-from hashlib import md5
+from base64 import b64encode
+from binascii import hexlify, unhexlify
+from collections import deque
+from hashlib import md5, sha1
 import struct
+import time
+import zlib
 
-from twisted.internet import interfaces
+from twisted.internet import interfaces, task
 from twisted.web.http import datetimeToString
 from twisted.web.http import _IdentityTransferDecoder
 from twisted.web.server import Request, Site, version, unquote
@@ -26,14 +33,42 @@ from zope.interface import implements
 
 _ascii_numbers = frozenset(['0', '1', '2', '3', '4', '5', '6', '7', '8', '9'])
 
+# Appended to the client's key to compute the RFC 6455 handshake response.
+_RFC6455_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+# RFC 6455 frame opcodes.
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+# RFC 6455 close status codes.
+CLOSE_NORMAL = 1000
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_TOO_BIG = 1009
+
+# The RSV1 bit marking compressed messages when permessage-deflate is used.
+_RSV_COMPRESSED = 0x4
+
+# Appended to each compressed message by the compressor's sync flush, and
+# stripped from messages on the wire.
+_DEFLATE_TAIL = "\x00\x00\xff\xff"
+
 class WebSocketRequest(Request):
     """
     A general purpose L{Request} supporting connection upgrade for WebSocket.
     """
 
     def process(self):
-        if (self.requestHeaders.getRawHeaders("Upgrade") == ["WebSocket"] and
-            self.requestHeaders.getRawHeaders("Connection") == ["Upgrade"]):
+        upgradeHeaders = self.requestHeaders.getRawHeaders("Upgrade", [])
+        connectionHeaders = self.requestHeaders.getRawHeaders("Connection", [])
+        connectionTokens = [token.strip().lower()
+                            for header in connectionHeaders
+                            for token in header.split(",")]
+        if ([header.lower() for header in upgradeHeaders] == ["websocket"] and
+            "upgrade" in connectionTokens):
             return self.processWebSocket()
         else:
             return Request.process(self)
@@ -216,6 +251,81 @@ class WebSocketRequest(Request):
         return originHeaders[0], hostHeaders[0], protocolHeader, handler
 
 
+    def _clientHandshake6455(self):
+        """
+        Complete an RFC 6455 handshake, negotiating the permessage-deflate
+        extension if the client offers it and the site allows it.
+
+        If the request is not identified with a proper WebSocket handshake, the
+        connection will be closed. Otherwise, the response to the handshake is
+        sent and a C{WebSocketHandler} is created to handle the request.
+        """
+        def finish():
+            self.channel.transport.loseConnection()
+        if self.queued:
+            return finish()
+
+        keyHeaders = self.requestHeaders.getRawHeaders("Sec-WebSocket-Key", [])
+        if len(keyHeaders) != 1:
+            return finish()
+        versionHeaders = self.requestHeaders.getRawHeaders(
+            "Sec-WebSocket-Version", [])
+        if versionHeaders != ["13"]:
+            return finish()
+        hostHeaders = self.requestHeaders.getRawHeaders("Host", [])
+        if len(hostHeaders) != 1:
+            return finish()
+        handlerFactory = self.site.handlers.get(self.uri)
+        if not handlerFactory:
+            return finish()
+
+        # the client lists the protocols it supports, pick the first one we
+        # support as well
+        protocolHeader = None
+        offeredProtocols = [protocol.strip()
+            for header in self.requestHeaders.getRawHeaders(
+                "Sec-WebSocket-Protocol", [])
+            for protocol in header.split(",")]
+        if offeredProtocols:
+            for protocol in offeredProtocols:
+                if protocol in self.site.supportedProtocols:
+                    protocolHeader = protocol
+                    break
+            else:
+                return finish()
+
+        deflate = None
+        if self.site.deflate:
+            deflate = PerMessageDeflate.negotiate(
+                self.requestHeaders.getRawHeaders(
+                    "Sec-WebSocket-Extensions", []))
+
+        transport = RFC6455Transport(self, deflate)
+        handler = handlerFactory(transport)
+        transport._attachHandler(handler)
+
+        accept = b64encode(sha1(keyHeaders[0].strip() + _RFC6455_GUID).digest())
+        self.startedWriting = True
+        handshake = [
+            "HTTP/1.1 101 Switching Protocols",
+            "Upgrade: websocket",
+            "Connection: Upgrade",
+            "Sec-WebSocket-Accept: %s" % accept]
+        if protocolHeader is not None:
+            handshake.append("Sec-WebSocket-Protocol: %s" % protocolHeader)
+        if deflate is not None:
+            handshake.append("Sec-WebSocket-Extensions: %s" % deflate.response())
+
+        self.write("".join(["%s\r\n" % header for header in handshake]) + "\r\n")
+        self.channel.setRawMode()
+        # in raw mode, HTTPChannel passes everything it receives to its
+        # transfer decoder, so replacing it hands all further data to the
+        # frame decoder
+        self.channel._transferDecoder = RFC6455FrameDecoder(
+            self, handler, deflate)
+        transport._connectionMade()
+
+
     def renderWebSocket(self):
         """
         Render a WebSocket request.
@@ -224,9 +334,12 @@ class WebSocketRequest(Request):
         connection will be closed. Otherwise, the response to the handshake is
         sent and a C{WebSocketHandler} is created to handle the request.
         """
-        # check for post-75 handshake requests
+        # check for RFC 6455 and post-75 handshake requests
+        isRFC6455Handshake = self.requestHeaders.getRawHeaders("Sec-WebSocket-Key", [])
         isSecHandshake = self.requestHeaders.getRawHeaders("Sec-WebSocket-Key1", [])
-        if isSecHandshake:
+        if isRFC6455Handshake:
+            self._clientHandshake6455()
+        elif isSecHandshake:
             self._clientHandshake76()
         else:
             check = self._checkClientHandshake()
@@ -271,14 +384,59 @@ class WebSocketSite(Site):
         values. If a value is passed at handshake and doesn't figure in this
         list, the connection is closed.
     @type supportedProtocols: C{list}
+    @ivar deflate: whether to compress messages on RFC 6455 connections whose
+        clients offer the permessage-deflate extension.
+    @type deflate: C{bool}
+    @ivar highWaterMark: number of bytes queued for a client not reading fast
+        enough, after which its handler's C{sendQueueExceeded} is called.
+    @type highWaterMark: C{int}
+    @ivar heartbeatInterval: seconds between checks of all connections, or
+        C{None} not to check them. Clients of RFC 6455 connections nothing
+        was received from since the previous check are pinged, and their
+        connections aborted if they do not answer until the next one.
+    @type heartbeatInterval: C{int}
+    @ivar stallTimeout: seconds after which the connection of a client which
+        does not read what is sent to it is aborted.
+    @type stallTimeout: C{int}
+    @ivar transports: the transports of open connections.
+    @type transports: C{set} of L{WebSocketTransport}
     """
     requestFactory = WebSocketRequest
 
     def __init__(self, resource, logPath=None, timeout=60*60*12,
-                 supportedProtocols=None):
+                 supportedProtocols=None, deflate=True,
+                 highWaterMark=256*1024, heartbeatInterval=30,
+                 stallTimeout=60):
         Site.__init__(self, resource, logPath, timeout)
         self.handlers = {}
         self.supportedProtocols = supportedProtocols or []
+        self.deflate = deflate
+        self.highWaterMark = highWaterMark
+        self.heartbeatInterval = heartbeatInterval
+        self.stallTimeout = stallTimeout
+        self.transports = set()
+        self._heartbeat = None
+
+    def startFactory(self):
+        Site.startFactory(self)
+        if self.heartbeatInterval:
+            self._heartbeat = task.LoopingCall(self._checkTransports)
+            self._heartbeat.start(self.heartbeatInterval, now=False)
+
+    def stopFactory(self):
+        if self._heartbeat is not None:
+            self._heartbeat.stop()
+            self._heartbeat = None
+        Site.stopFactory(self)
+
+    def _checkTransports(self):
+        """
+        Check the connections of all transports, aborting those of clients
+        which stalled or stopped answering.
+        """
+        now = time.time()
+        for transport in list(self.transports):
+            transport._heartbeat(now, self.stallTimeout)
 
     def addHandler(self, name, handlerFactory):
         """
@@ -295,18 +453,66 @@ class WebSocketSite(Site):
 
 
 
+class PreparedFrame(object):
+    """
+    A frame as it goes over the wire, shared by all transports using the
+    same framing.
+
+    @ivar framing: the framing of the transports the frame was made for.
+    @ivar data: the framed data.
+    @ivar opcode: C{None}, or the opcode of a message which is only framed
+        when it is written, because framing it depends on the messages
+        written before.
+    """
+
+    def __init__(self, framing, data, opcode=None):
+        self.framing = framing
+        self.data = data
+        self.opcode = opcode
+
+
 class WebSocketTransport(object):
     """
     Transport abstraction over WebSocket, providing classic Twisted methods and
     callbacks.
+
+    The transport is registered as a producer with the connection, which
+    pauses it while the client does not read what is written. Messages sent
+    in the meantime are queued and written once the client catches up.
+
+    @ivar framesReceived: number of messages received from the client.
+    @ivar bytesReceived: number of bytes received from the client, including
+        framing.
+    @ivar framesSent: number of frames sent to the client.
+    @ivar bytesSent: number of bytes sent to the client, including framing.
+    @ivar paused: whether the connection does not take more data for now.
+    @ivar queuedBytes: number of bytes queued while paused, not counting
+        those written with L{writeSequence}.
+    @ivar highWaterMark: number of queued bytes after which the handler's
+        C{sendQueueExceeded} is called.
     """
-    implements(interfaces.ITransport)
+    implements(interfaces.ITransport, interfaces.IPushProducer)
 
     _handler = None
 
+    framesReceived = 0
+    bytesReceived = 0
+    framesSent = 0
+    bytesSent = 0
+
+    paused = False
+    queuedBytes = 0
+    highWaterMark = 256 * 1024
+    _pausedSince = None
+
+    # Identifies the framing used by this transport for sharing prepared
+    # frames.
+    framing = "hixie"
+
     def __init__(self, request):
         self._request = request
         self._request.notifyFinish().addErrback(self._connectionLost)
+        self._queue = deque()
 
     def _attachHandler(self, handler):
         """
@@ -318,17 +524,120 @@ class WebSocketTransport(object):
         """
         Called when a connection is made.
         """
+        site = self._request.site
+        self.highWaterMark = site.highWaterMark
+        site.transports.add(self)
+        self._request.registerProducer(self, True)
         self._handler.connectionMade()
 
     def _connectionLost(self, reason):
         """
         Forward connection lost event to the L{WebSocketHandler}.
         """
+        self.discardQueued()
+        self._request.site.transports.discard(self)
         self._handler.connectionLost(reason)
         del self._request.transport
         del self._request
         del self._handler
 
+    def _write(self, data, frames=1):
+        """
+        Write framed data to the connection, counting the frames and bytes
+        sent.
+        """
+        self.framesSent += frames
+        self.bytesSent += len(data)
+        self._request.write(data)
+
+    def _frame(self, opcode, data):
+        """
+        Frame the given message.
+        """
+        return "\x00%s\xff" % data
+
+    def _send(self, data, opcode=None, counted=True):
+        """
+        Write a message, or queue it while paused.
+
+        @param data: the framed message, or the message to frame with the
+            given opcode when it is written.
+        @param opcode: C{None} if C{data} is framed already.
+        @param counted: whether the message counts towards the high-water
+            mark.
+        """
+        if not self.paused and not self._queue:
+            if opcode is not None:
+                data = self._frame(opcode, data)
+            self._write(data)
+            return
+
+        self._queue.append((data, opcode, counted))
+        if counted:
+            self.queuedBytes += len(data)
+            if self.queuedBytes - len(data) <= self.highWaterMark < self.queuedBytes:
+                self._handler.sendQueueExceeded()
+
+    def pauseProducing(self):
+        """
+        Queue messages until the connection has written what it buffers.
+        """
+        self.paused = True
+        self._pausedSince = time.time()
+
+    def resumeProducing(self):
+        """
+        Write the queued messages, until the connection is paused again.
+        """
+        self.paused = False
+        self._pausedSince = None
+        while self._queue and not self.paused:
+            data, opcode, counted = self._queue.popleft()
+            if counted:
+                self.queuedBytes -= len(data)
+            if opcode is not None:
+                data = self._frame(opcode, data)
+            self._write(data)
+
+    def stopProducing(self):
+        """
+        Discard the queued messages, as the connection is gone.
+        """
+        self.discardQueued()
+
+    def discardQueued(self):
+        """
+        Discard the messages queued while paused, so they are never sent.
+        """
+        self._queue.clear()
+        self.queuedBytes = 0
+
+    def pauseReading(self):
+        """
+        Stop reading from the connection until L{resumeReading} is called, so
+        the client cannot send more messages meanwhile. Messages read already
+        are still passed to the handler.
+        """
+        self._request.transport.pauseProducing()
+
+    def resumeReading(self):
+        """
+        Read from the connection again after L{pauseReading}.
+        """
+        self._request.transport.resumeProducing()
+
+    def _heartbeat(self, now, stallTimeout):
+        """
+        Check the connection, aborting it if the client has not been reading
+        for longer than C{stallTimeout} seconds.
+
+        @return: whether the connection is still open.
+        """
+        if self.paused and now - self._pausedSince > stallTimeout:
+            self.abortConnection()
+            return False
+        return True
+
     def getPeer(self):
         """
         Return a tuple describing the other side of the connection.
@@ -354,22 +663,171 @@ class WebSocketTransport(object):
         @param frame: a I{UTF-8} encoded C{str} to send to the client.
         @type frame: C{str}
         """
-        self._request.write("\x00%s\xff" % frame)
+        self._send(frame, OPCODE_TEXT)
 
     def writeSequence(self, frames):
         """
-        Send a sequence of frames to the connected client.
+        Send a sequence of frames to the connected client. The frames are
+        only framed when they are written and do not count towards the
+        high-water mark, as they are expected to be shared with other
+        transports, like the log sent when synchronizing.
         """
-        self._request.write("".join(["\x00%s\xff" % f for f in frames]))
+        for frame in frames:
+            self._send(frame, OPCODE_TEXT, False)
 
-    def loseConnection(self):
+    def prepareFrame(self, frame):
+        """
+        Frame the given data once, so it can be sent to several clients
+        using the same framing without framing it again.
+
+        @param frame: a I{UTF-8} encoded C{str} to send to clients.
+        @type frame: C{str}
+        @return: a L{PreparedFrame} to pass to L{writePrepared}.
+        """
+        return PreparedFrame(self.framing, "\x00%s\xff" % frame)
+
+    def writePrepared(self, prepared):
+        """
+        Send a frame created by L{prepareFrame}.
+
+        @type prepared: L{PreparedFrame}
         """
-        Close the connection.
+        self._send(prepared.data, prepared.opcode)
+
+    def _close(self):
+        """
+        Close the connection once the data it buffers has been written,
+        discarding queued messages.
         """
+        self.discardQueued()
+        self._request.unregisterProducer()
         self._request.transport.loseConnection()
-        del self._request.transport
-        del self._request
-        del self._handler
+
+    def loseConnection(self):
+        """
+        Close the connection. Messages still queued are discarded. The
+        handler is told when the connection is actually lost, like for
+        connections closed by the client.
+        """
+        self._close()
+
+    def abortConnection(self):
+        """
+        Close the connection right away, discarding everything not written
+        yet.
+        """
+        self.discardQueued()
+        self._request.transport.abortConnection()
+
+class RFC6455Transport(WebSocketTransport):
+    """
+    L{WebSocketTransport} for connections using RFC 6455 framing, optionally
+    compressing messages with the permessage-deflate extension.
+
+    Frames prepared by a transport compressing with context takeover depend
+    on the messages sent on it before, so they are only framed when they are
+    written to that transport.
+    """
+
+    _pinged = False
+    _lastBytesReceived = 0
+
+    def __init__(self, request, deflate=None):
+        """
+        @param deflate: the negotiated permessage-deflate extension, or
+            C{None} to send messages uncompressed.
+        @type deflate: L{PerMessageDeflate}
+        """
+        WebSocketTransport.__init__(self, request)
+        self._deflate = deflate
+        if deflate is None:
+            self.framing = "rfc6455"
+        elif deflate.serverNoContextTakeover:
+            # compressing a message gives the same result on every transport
+            # compressing with the same window size
+            self.framing = "rfc6455-deflate-%d" % deflate.serverMaxWindowBits
+        else:
+            self.framing = "rfc6455-deflate-%x" % id(self)
+        self._takeover = deflate is not None and not deflate.serverNoContextTakeover
+
+    def _frame(self, opcode, data):
+        """
+        Frame the given message, compressing it if permessage-deflate is used.
+        """
+        if self._deflate is not None:
+            data = self._deflate.compress(data)
+            return _frameHeader(opcode, len(data), _RSV_COMPRESSED) + data
+        return _frameHeader(opcode, len(data)) + data
+
+    def _writeControl(self, opcode, data=""):
+        """
+        Send a control frame, which is never compressed.
+        """
+        self._write(_frameHeader(opcode, len(data)) + data)
+
+    def _heartbeat(self, now, stallTimeout):
+        """
+        Check the connection, pinging the client if nothing was received
+        since the previous check and aborting the connection if the client
+        did not answer the previous ping.
+
+        @return: whether the connection is still open.
+        """
+        if not WebSocketTransport._heartbeat(self, now, stallTimeout):
+            return False
+        if self.bytesReceived != self._lastBytesReceived:
+            self._lastBytesReceived = self.bytesReceived
+            self._pinged = False
+        elif self._pinged:
+            self.abortConnection()
+            return False
+        elif not self.paused:
+            self._writeControl(OPCODE_PING)
+            self._pinged = True
+        return True
+
+    def writeBinary(self, data):
+        """
+        Send the given data to the connected client as a binary message.
+
+        @type data: C{str}
+        """
+        self._send(data, OPCODE_BINARY)
+
+    def prepareFrame(self, frame):
+        """
+        Frame the given data once, so it can be sent to several clients
+        using the same framing without framing it again.
+
+        @param frame: a I{UTF-8} encoded C{str} to send to clients.
+        @type frame: C{str}
+        @return: a L{PreparedFrame} to pass to L{writePrepared}.
+        """
+        if self._takeover:
+            return PreparedFrame(self.framing, frame, OPCODE_TEXT)
+        return PreparedFrame(self.framing, self._frame(OPCODE_TEXT, frame))
+
+    def prepareBinary(self, data):
+        """
+        Frame the given data as a binary message once, so it can be sent to
+        several clients using the same framing without framing it again.
+
+        @type data: C{str}
+        @return: a L{PreparedFrame} to pass to L{writePrepared}.
+        """
+        if self._takeover:
+            return PreparedFrame(self.framing, data, OPCODE_BINARY)
+        return PreparedFrame(self.framing, self._frame(OPCODE_BINARY, data))
+
+    def loseConnection(self):
+        """
+        Send a close frame and close the connection. Messages still queued
+        are discarded.
+        """
+        self.discardQueued()
+        self._writeControl(OPCODE_CLOSE, struct.pack("!H", CLOSE_NORMAL))
+        self._close()
+
 
 class WebSocketHandler(object):
     """
@@ -397,6 +855,15 @@ class WebSocketHandler(object):
         """
 
 
+    def binaryFrameReceived(self, data):
+        """
+        Called when a binary message is received. Only clients using RFC 6455
+        framing can send binary messages; they are ignored by default.
+
+        @type data: C{str}
+        """
+
+
     def frameLengthExceeded(self):
         """
         Called when too big a frame is received. The default behavior is to
@@ -405,6 +872,16 @@ class WebSocketHandler(object):
         self.transport.loseConnection()
 
 
+    def sendQueueExceeded(self):
+        """
+        Called when more than the transport's C{highWaterMark} bytes are
+        queued because the client does not read fast enough. The default
+        behavior is to abort the connection, but it can be customized, e.g.
+        to discard what is queued with C{discardQueued}.
+        """
+        self.transport.abortConnection()
+
+
     def connectionMade(self):
         """
         Called when a connection is made.
@@ -430,10 +907,12 @@ class WebSocketFrameDecoder(object):
     @type request: L{twisted.web.server.Request}
     @ivar handler: L{WebSocketHandler} instance handling the request.
     @type handler: L{WebSocketHandler}
-    @ivar _data: C{list} of C{str} buffering the received data.
+    @ivar _data: C{list} of C{str} buffering the part of the current frame
+        received so far.
     @type _data: C{list} of C{str}
-    @ivar _currentFrameLength: length of the current handled frame, plus the
-        additional leading byte.
+    @ivar _inFrame: whether the start of the current frame has been received.
+    @type _inFrame: C{bool}
+    @ivar _currentFrameLength: length of the current frame received so far.
     @type _currentFrameLength: C{int}
     """
 
@@ -444,44 +923,473 @@ class WebSocketFrameDecoder(object):
         self.request = request
         self.handler = handler
         self._data = []
+        self._inFrame = False
         self._currentFrameLength = 0
 
     def dataReceived(self, data):
         """
         Parse data to read WebSocket frames.
 
+        The data is scanned from an offset, so each byte is looked at once and
+        only copied into the frame containing it, no matter how many frames
+        are received at once.
+
         @param data: data received over the WebSocket connection.
         @type data: C{str}
         """
-        if not data:
-            return
-        while True:
-            endIndex = data.find("\xff")
-            if endIndex != -1:
-                self._currentFrameLength += endIndex
+        self.handler.transport.bytesReceived += len(data)
+        offset = 0
+        length = len(data)
+        while offset < length:
+            if not self._inFrame:
+                if data[offset] != "\x00":
+                    self.handler.transport._close()
+                    return
+                self._inFrame = True
+                offset += 1
+
+            endIndex = data.find("\xff", offset)
+            if endIndex == -1:
+                # The frame continues in the data received next.
+                self._currentFrameLength += length - offset
                 if self._currentFrameLength > self.MAX_LENGTH:
                     self.handler.frameLengthExceeded()
-                    break
-                self._currentFrameLength = 0
-                frame = "".join(self._data) + data[:endIndex]
-                self._data[:] = []
-                if frame[0] != "\x00":
-                    self.request.transport.loseConnection()
-                    break
-                self.handler.frameReceived(frame[1:])
-                data = data[endIndex + 1:]
-                if not data:
-                    break
-                if data[0] != "\x00":
-                    self.request.transport.loseConnection()
-                    break
+                else:
+                    self._data.append(data[offset:])
+                return
+
+            self._currentFrameLength += endIndex - offset
+            if self._currentFrameLength > self.MAX_LENGTH:
+                self.handler.frameLengthExceeded()
+                return
+
+            if self._data:
+                self._data.append(data[offset:endIndex])
+                frame = "".join(self._data)
+                self._data = []
             else:
-                self._currentFrameLength += len(data)
-                if self._currentFrameLength > self.MAX_LENGTH + 1:
-                    self.handler.frameLengthExceeded()
+                frame = data[offset:endIndex]
+
+            self._inFrame = False
+            self._currentFrameLength = 0
+            self.handler.transport.framesReceived += 1
+            self.handler.frameReceived(frame)
+
+            offset = endIndex + 1
+
+
+class RFC6455FrameDecoder(object):
+    """
+    Decode RFC 6455 frames, reassemble the messages they form and pass them
+    to the attached C{WebSocketHandler} instance. Control frames are answered
+    directly.
+
+    Frames carry their length in their header, so the payload is not scanned
+    but collected as it arrives and unmasked once the frame is complete.
+
+    @ivar MAX_LENGTH: maximum length of a message allowed, before and after
+        decompressing it, before calling C{frameLengthExceeded} on the
+        handler.
+    @type MAX_LENGTH: C{int}
+    @ivar request: C{Request} instance.
+    @type request: L{twisted.web.server.Request}
+    @ivar handler: L{WebSocketHandler} instance handling the request.
+    @type handler: L{WebSocketHandler}
+    @ivar deflate: the negotiated permessage-deflate extension, or C{None}.
+    @type deflate: L{PerMessageDeflate}
+    @ivar _header: the part of the current frame header received so far.
+    @type _header: C{str}
+    @ivar _frame: the parsed header of the current frame, or C{None} while
+        its header is incomplete.
+    @type _frame: C{tuple}
+    @ivar _parts: C{list} of C{str} buffering the current frame's payload.
+    @type _parts: C{list} of C{str}
+    @ivar _remaining: number of payload bytes of the current frame still to
+        be received.
+    @type _remaining: C{int}
+    @ivar _message: C{list} of C{str} buffering the payloads of the frames
+        of the current message.
+    @type _message: C{list} of C{str}
+    @ivar _messageLength: length of the current message received so far.
+    @type _messageLength: C{int}
+    @ivar _opcode: opcode of the current message, or C{None} between
+        messages.
+    @type _opcode: C{int}
+    @ivar _compressed: whether the current message is compressed.
+    @type _compressed: C{bool}
+    @ivar _closed: whether the connection is being closed, after which
+        received data is ignored.
+    @type _closed: C{bool}
+    """
+
+    MAX_LENGTH = 16384
+
+
+    def __init__(self, request, handler, deflate=None):
+        self.request = request
+        self.handler = handler
+        self.deflate = deflate
+        self._header = ""
+        self._frame = None
+        self._parts = []
+        self._remaining = 0
+        self._message = []
+        self._messageLength = 0
+        self._opcode = None
+        self._compressed = False
+        self._closed = False
+
+    def dataReceived(self, data):
+        """
+        Parse data to read RFC 6455 frames.
+
+        @param data: data received over the WebSocket connection.
+        @type data: C{str}
+        """
+        self.handler.transport.bytesReceived += len(data)
+        offset = 0
+        length = len(data)
+        while offset < length and not self._closed:
+            if self._frame is None:
+                header = self._header + data[offset:offset + _MAX_HEADER_LENGTH]
+                frame = _parseFrameHeader(header)
+                if frame is None:
+                    # The header continues in the data received next.
+                    self._header = header
+                    return
+                offset += frame[-1] - len(self._header)
+                self._header = ""
+                if not self._checkFrame(*frame[:-1]):
+                    return
+                self._frame = frame
+                self._remaining = frame[4]
+
+            if self._remaining:
+                end = min(offset + self._remaining, length)
+                self._parts.append(data[offset:end])
+                self._remaining -= end - offset
+                offset = end
+                if self._remaining:
+                    return
+
+            self._frameReceived()
+
+    def _fail(self, code=CLOSE_PROTOCOL_ERROR):
+        """
+        Close the connection because of a protocol error.
+        """
+        self._closed = True
+        self.handler.transport._writeControl(OPCODE_CLOSE,
+                                             struct.pack("!H", code))
+        self.handler.transport._close()
+
+    def _checkFrame(self, fin, rsv, opcode, mask, length):
+        """
+        Check the header of a frame, closing the connection if it is invalid.
+
+        @return: whether the frame is valid.
+        @rtype: C{bool}
+        """
+        if mask is None:
+            # clients have to mask all frames they send
+            self._fail()
+            return False
+
+        if opcode >= OPCODE_CLOSE:
+            if (opcode not in (OPCODE_CLOSE, OPCODE_PING, OPCODE_PONG) or
+                not fin or rsv or length > 125):
+                self._fail()
+                return False
+            return True
+
+        if opcode == OPCODE_CONTINUATION:
+            valid = self._opcode is not None and not rsv
+        elif opcode in (OPCODE_TEXT, OPCODE_BINARY):
+            valid = self._opcode is None and (
+                not rsv or (rsv == _RSV_COMPRESSED and self.deflate is not None))
+        else:
+            valid = False
+        if not valid:
+            self._fail()
+            return False
+
+        if self._messageLength + length > self.MAX_LENGTH:
+            self._closed = True
+            self.handler.frameLengthExceeded()
+            return False
+        return True
+
+    def _frameReceived(self):
+        """
+        Handle the frame whose payload has been received completely.
+        """
+        fin, rsv, opcode, mask, length, headerLength = self._frame
+        self._frame = None
+        if len(self._parts) == 1:
+            payload = self._parts[0]
+        else:
+            payload = "".join(self._parts)
+        self._parts = []
+        payload = _unmask(payload, mask)
+
+        if opcode == OPCODE_PING:
+            self.handler.transport._writeControl(OPCODE_PONG, payload)
+            return
+        elif opcode == OPCODE_PONG:
+            return
+        elif opcode == OPCODE_CLOSE:
+            # echo the status code and close the connection
+            self._closed = True
+            self.handler.transport._writeControl(OPCODE_CLOSE, payload[:2])
+            self.handler.transport._close()
+            return
+
+        if opcode != OPCODE_CONTINUATION:
+            self._opcode = opcode
+            self._compressed = bool(rsv & _RSV_COMPRESSED)
+        self._message.append(payload)
+        self._messageLength += length
+        if not fin:
+            return
+
+        opcode = self._opcode
+        if len(self._message) == 1:
+            message = self._message[0]
+        else:
+            message = "".join(self._message)
+        self._message = []
+        self._messageLength = 0
+        self._opcode = None
+
+        if self._compressed:
+            message = self.deflate.decompress(message, self.MAX_LENGTH)
+            if message is None:
+                self._closed = True
+                self.handler.frameLengthExceeded()
+                return
+
+        self.handler.transport.framesReceived += 1
+        if opcode == OPCODE_TEXT:
+            self.handler.frameReceived(message)
+        else:
+            self.handler.binaryFrameReceived(message)
+
+
+
+class PerMessageDeflate(object):
+    """
+    The permessage-deflate extension as negotiated for one connection. Each
+    connection keeps its own compressor and decompressor, so with context
+    takeover a message can refer back to data of the previous messages.
+
+    @ivar serverNoContextTakeover: whether the compressor is reset after
+        each message sent.
+    @type serverNoContextTakeover: C{bool}
+    @ivar clientNoContextTakeover: whether the client resets its compressor
+        after each message, so the decompressor is reset as well.
+    @type clientNoContextTakeover: C{bool}
+    @ivar serverMaxWindowBits: base-2 logarithm of the compressor's window.
+    @type serverMaxWindowBits: C{int}
+    """
+
+    EXTENSION = "permessage-deflate"
+
+    # Compression level passed to zlib.
+    LEVEL = zlib.Z_DEFAULT_COMPRESSION
+
+
+    def __init__(self, serverNoContextTakeover=False,
+                 clientNoContextTakeover=False, serverMaxWindowBits=None):
+        self.serverNoContextTakeover = serverNoContextTakeover
+        self.clientNoContextTakeover = clientNoContextTakeover
+        self._requestedWindowBits = serverMaxWindowBits
+        self.serverMaxWindowBits = serverMaxWindowBits or zlib.MAX_WBITS
+        self._compressor = None
+        self._decompressor = None
+
+    @classmethod
+    def negotiate(cls, headers):
+        """
+        Accept the first permessage-deflate offer in the given
+        I{Sec-WebSocket-Extensions} headers that we support.
+
+        @type headers: C{list} of C{str}
+        @return: a L{PerMessageDeflate} instance, or C{None} if no offer was
+            accepted.
+        """
+        for name, params in _parseExtensions(headers):
+            if name != cls.EXTENSION or len(params) != len(dict(params)):
+                continue
+            params = dict(params)
+            accepted = True
+            for key, value in params.items():
+                if key in ("server_no_context_takeover",
+                           "client_no_context_takeover"):
+                    accepted = value is None
+                elif key == "server_max_window_bits":
+                    # zlib silently uses a window of 512 bytes instead of 256
+                    # for raw streams, so a window of 8 bits is declined.
+                    accepted = value in [str(bits) for bits in range(9, 16)]
+                elif key == "client_max_window_bits":
+                    # messages are decompressed using the largest window, so
+                    # any window the client uses is fine
+                    accepted = value is None or value in [
+                        str(bits) for bits in range(8, 16)]
+                else:
+                    accepted = False
+                if not accepted:
+                    break
+            if accepted:
+                windowBits = params.get("server_max_window_bits")
+                return cls("server_no_context_takeover" in params,
+                           "client_no_context_takeover" in params,
+                           windowBits and int(windowBits))
+        return None
+
+    def response(self):
+        """
+        @return: the I{Sec-WebSocket-Extensions} header value accepting the
+            offer.
+        @rtype: C{str}
+        """
+        response = [self.EXTENSION]
+        if self.serverNoContextTakeover:
+            response.append("server_no_context_takeover")
+        if self.clientNoContextTakeover:
+            response.append("client_no_context_takeover")
+        if self._requestedWindowBits is not None:
+            response.append(
+                "server_max_window_bits=%d" % self._requestedWindowBits)
+        return "; ".join(response)
+
+    def compress(self, data):
+        """
+        Compress a message to send.
+
+        @type data: C{str}
+        @rtype: C{str}
+        """
+        if self._compressor is None or self.serverNoContextTakeover:
+            self._compressor = zlib.compressobj(
+                self.LEVEL, zlib.DEFLATED, -self.serverMaxWindowBits)
+        data = (self._compressor.compress(data) +
+                self._compressor.flush(zlib.Z_SYNC_FLUSH))
+        if data.endswith(_DEFLATE_TAIL):
+            data = data[:-len(_DEFLATE_TAIL)]
+        return data
+
+    def decompress(self, data, maxLength):
+        """
+        Decompress a received message.
+
+        @type data: C{str}
+        @param maxLength: maximum length of the decompressed message.
+        @type maxLength: C{int}
+        @return: the decompressed message, or C{None} if it is longer than
+            C{maxLength}.
+        """
+        if self._decompressor is None or self.clientNoContextTakeover:
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        data = self._decompressor.decompress(data + _DEFLATE_TAIL,
+                                             maxLength + 1)
+        if len(data) > maxLength or self._decompressor.unconsumed_tail:
+            return None
+        return data
+
+
+
+# The length of the longest RFC 6455 frame header: two bytes, a 64 bit length
+# and the masking key.
+_MAX_HEADER_LENGTH = 14
+
+
+def _frameHeader(opcode, length, rsv=0):
+    """
+    Build the header of an unmasked RFC 6455 frame with the FIN bit set.
+
+    @rtype: C{str}
+    """
+    first = 0x80 | rsv << 4 | opcode
+    if length < 126:
+        return struct.pack("!BB", first, length)
+    elif length < 0x10000:
+        return struct.pack("!BBH", first, 126, length)
+    return struct.pack("!BBQ", first, 127, length)
+
+
+def _parseFrameHeader(data):
+    """
+    Parse the RFC 6455 frame header at the start of the given data.
+
+    @return: C{None} if the header is incomplete, or a tuple of the FIN bit,
+        the RSV bits, the opcode, the masking key (C{None} for unmasked
+        frames), the payload length and the length of the header.
+    """
+    if len(data) < 2:
+        return None
+    first, second = struct.unpack("!BB", data[:2])
+    length = second & 0x7F
+    offset = 2
+    if length == 126:
+        if len(data) < 4:
+            return None
+        length, = struct.unpack("!H", data[2:4])
+        offset = 4
+    elif length == 127:
+        if len(data) < 10:
+            return None
+        length, = struct.unpack("!Q", data[2:10])
+        offset = 10
+    mask = None
+    if second & 0x80:
+        if len(data) < offset + 4:
+            return None
+        mask = data[offset:offset + 4]
+        offset += 4
+    return (bool(first & 0x80), (first >> 4) & 0x7, first & 0xF, mask,
+            length, offset)
+
+
+def _unmask(data, mask):
+    """
+    Unmask a frame payload by XORing it with the masking key repeated to its
+    length. Both are converted to integers, so this runs in C rather than
+    byte by byte.
+
+    @rtype: C{str}
+    """
+    length = len(data)
+    if not length:
+        return data
+    key = (mask * (length // 4 + 1))[:length]
+    value = int(hexlify(data), 16) ^ int(hexlify(key), 16)
+    return unhexlify("%0*x" % (length * 2, value))
+
+
+def _parseExtensions(headers):
+    """
+    Parse I{Sec-WebSocket-Extensions} headers.
+
+    @type headers: C{list} of C{str}
+    @return: a C{list} of extension names and C{list}s of their parameters
+        as tuples of names and values, which are C{None} for parameters
+        without a value.
+    """
+    extensions = []
+    for header in headers:
+        for extension in header.split(","):
+            parts = [part.strip() for part in extension.split(";")]
+            if not parts[0]:
+                continue
+            params = []
+            for part in parts[1:]:
+                if "=" in part:
+                    key, value = part.split("=", 1)
+                    params.append((key.strip(), value.strip().strip('"')))
                 else:
-                    self._data.append(data)
-                break
+                    params.append((part, None))
+            extensions.append((parts[0], params))
+    return extensions
 
 
 
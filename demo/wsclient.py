@@ -0,0 +1,90 @@
+"""
+A minimal WebSocket client on asyncio, for Python 3.7 and above, shared by
+the tools simulating editors (loadgen.py and transportbench.py). It speaks
+the final WebSocket protocol (RFC 6455) without extensions: frames it sends
+are masked, and frames it receives are passed on whole, as servers do not
+fragment them.
+"""
+
+import asyncio
+import os
+import struct
+
+from base64 import b64encode
+
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+class WebSocketClient(object):
+	"""A connection to a WebSocket on the given server. Messages received are
+	passed to messageReceived, and pings are answered."""
+
+	def __init__(self, host, port):
+		self.host = host
+		self.port = port
+		self.reading = None
+
+	async def connect(self, path="/transport"):
+		"""Connects and completes the handshake, after which messages are read
+		until the connection is closed."""
+		self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+		key = b64encode(os.urandom(16)).decode("ascii")
+		self.writer.write(("GET %s HTTP/1.1\r\nHost: %s:%d\r\nUpgrade: websocket\r\n"
+			"Connection: Upgrade\r\nSec-WebSocket-Key: %s\r\nSec-WebSocket-Version: 13\r\n\r\n"
+			% (path, self.host, self.port, key)).encode("ascii"))
+		response = await self.reader.readuntil(b"\r\n\r\n")
+		if response.split(None, 2)[1:2] != [b"101"]:
+			self.writer.close()
+			raise ConnectionError("WebSocket handshake failed: %s" % response.split(b"\r\n", 1)[0].decode("latin-1"))
+
+		self.reading = asyncio.ensure_future(self.read())
+
+	def sendFrame(self, opcode, data):
+		"""Sends a frame with the given opcode and payload."""
+		length = len(data)
+		if length < 126:
+			header = struct.pack("!BB", 0x80 | opcode, 0x80 | length)
+		elif length < 0x10000:
+			header = struct.pack("!BBH", 0x80 | opcode, 0x80 | 126, length)
+		else:
+			header = struct.pack("!BBQ", 0x80 | opcode, 0x80 | 127, length)
+		mask = os.urandom(4)
+		key = (mask * (length // 4 + 1))[:length]
+		masked = (int.from_bytes(data, "big") ^ int.from_bytes(key, "big")).to_bytes(length, "big")
+		self.writer.write(header + mask + masked)
+
+	def sendText(self, text):
+		self.sendFrame(OPCODE_TEXT, text.encode("utf-8"))
+
+	async def read(self):
+		try:
+			while True:
+				first, second = await self.reader.readexactly(2)
+				size = second & 0x7F
+				if size == 126:
+					size, = struct.unpack("!H", await self.reader.readexactly(2))
+				elif size == 127:
+					size, = struct.unpack("!Q", await self.reader.readexactly(8))
+				data = await self.reader.readexactly(size)
+
+				opcode = first & 0x0F
+				if opcode == OPCODE_CLOSE:
+					break
+				elif opcode == OPCODE_PING:
+					# Answer the server's heartbeat.
+					self.sendFrame(OPCODE_PONG, data)
+				elif opcode != OPCODE_PONG:
+					self.messageReceived(data)
+		except (asyncio.IncompleteReadError, ConnectionError):
+			pass
+
+	def messageReceived(self, data):
+		pass
+
+	def close(self):
+		self.writer.close()
+		if self.reading is not None:
+			self.reading.cancel()
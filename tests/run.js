@@ -0,0 +1,617 @@
+/* Runs the tests in sources/ without a browser and measures how long the
+ * algorithm takes, using Node.js:
+ *
+ *   node tests/run.js [options] [sources/test-01.xml ...]
+ *
+ * Each test is executed in the order of its requests, like test-helper.js
+ * does, and in random orders, like random/test-helper.js does. Synthetic
+ * tests with many users issuing requests concurrently are run as well; their
+ * result is compared among the orders, as they have no expected buffer. Run
+ * with --expose-gc to measure the heap of each run from a clean start.
+ */
+
+var fs = require("fs");
+var path = require("path");
+var vm = require("vm");
+
+var root = path.join(__dirname, "..");
+var files = ["state.js", "request.js", "text.js", "operations.js"];
+for(var index = 0; index < files.length; index++) {
+	var file = path.join(root, "algorithm", files[index]);
+	vm.runInThisContext(fs.readFileSync(file, "utf8"), {filename: file});
+}
+
+var USAGE = [
+	"Usage: node run.js [options] [test.xml ...]",
+	"",
+	"  --rounds N       random orders per test (default 5)",
+	"  --seed N         seed of the random orders and the first synthetic test,",
+	"                   the next ones use the following numbers (default 1)",
+	"  --synthetic N    synthetic tests to generate (default 1)",
+	"  --users N        users of a synthetic test (default 20)",
+	"  --requests N     requests of a synthetic test (default 2000)",
+	"  --lag N          latest requests a user may not have received when",
+	"                   issuing one in synthetic tests (default 10)",
+	"  --cache-size N   translations cached by each state, 0 to disable",
+	"  --prune          also run each order pruning the log after every request",
+	"                   and compare the buffer after every request",
+	"  --json FILE      write the results to FILE",
+	"  --verbose        report every run"
+].join("\n");
+
+var options = {
+	rounds: 5, seed: 1, synthetic: 1, users: 20, requests: 2000,
+	lag: 10, cacheSize: null, prune: false, json: null, verbose: false
+};
+
+/** Parses the command line into options, returning the test files given.
+ *  @type Array
+ */
+function parseArguments(args) {
+	var numeric = {"--rounds": "rounds", "--seed": "seed",
+		"--synthetic": "synthetic", "--users": "users", "--requests": "requests",
+		"--lag": "lag", "--cache-size": "cacheSize"};
+	var sources = new Array();
+
+	for(var index = 0; index < args.length; index++) {
+		var arg = args[index];
+		if(numeric.hasOwnProperty(arg) && index + 1 < args.length && !isNaN(args[index + 1])) {
+			options[numeric[arg]] = parseFloat(args[++index]);
+		} else if(arg == "--json" && index + 1 < args.length) {
+			options.json = args[++index];
+		} else if(arg == "--verbose") {
+			options.verbose = true;
+		} else if(arg == "--prune") {
+			options.prune = true;
+		} else if(arg.charAt(0) == "-") {
+			console.error(USAGE);
+			process.exit(arg == "--help" || arg == "-h" ? 0 : 2);
+		} else {
+			sources.push(arg);
+		}
+	}
+
+	if(sources.length == 0) {
+		var directory = path.join(__dirname, "sources");
+		sources = fs.readdirSync(directory).filter(function(name) {
+			return /\.xml$/.test(name);
+		}).sort().map(function(name) {
+			return path.join(directory, name);
+		});
+	}
+
+	return sources;
+}
+
+/** Returns a function generating random numbers in [0, 1) from a seed, so
+ *  that runs can be repeated.
+ *  @type Function
+ */
+function randomGenerator(seed) {
+	var state = seed >>> 0;
+	return function() {
+		// mulberry32
+		state = (state + 0x6d2b79f5) >>> 0;
+		var t = state;
+		t = Math.imul(t ^ (t >>> 15), t | 1);
+		t ^= t + Math.imul(t ^ (t >>> 7), t | 61);
+		return ((t ^ (t >>> 14)) >>> 0) / 4294967296;
+	};
+}
+
+var ENTITIES = {lt: "<", gt: ">", amp: "&", quot: "\"", apos: "'"};
+
+function decodeEntities(text) {
+	return text.replace(/&(#x[0-9a-fA-F]+|#\d+|\w+);/g, function(match, name) {
+		if(name.charAt(0) != "#")
+			return ENTITIES.hasOwnProperty(name) ? ENTITIES[name] : match;
+		if(name.charAt(1) == "x")
+			return String.fromCharCode(parseInt(name.substr(2), 16));
+		return String.fromCharCode(parseInt(name.substr(1), 10));
+	});
+}
+
+/** Parses the elements of an XML document, which are returned as objects
+ *  with a name, attributes, child elements and the text they contain
+ *  directly. Only what the tests use is supported.
+ *  @type Object
+ */
+function parseXML(text) {
+	var token = /<\?[\s\S]*?\?>|<!--[\s\S]*?-->|<(\/?)([\w-]+)((?:\s+[\w-]+\s*=\s*"[^"]*")*)\s*(\/?)>|([^<]+)/g;
+	var document = {name: null, attributes: {}, children: [], text: ""};
+	var stack = [document];
+	var match;
+
+	while((match = token.exec(text)) != null) {
+		var current = stack[stack.length - 1];
+		if(match[5] != undefined) {
+			current.text += decodeEntities(match[5]);
+		} else if(match[2] == undefined) {
+			// Processing instructions and comments
+			continue;
+		} else if(match[1]) {
+			if(match[2] != current.name)
+				throw new Error("Unexpected </" + match[2] + ">");
+			stack.pop();
+		} else {
+			var element = {name: match[2], attributes: {}, children: [], text: ""};
+			var attribute = /([\w-]+)\s*=\s*"([^"]*)"/g, pair;
+			while((pair = attribute.exec(match[3])) != null)
+				element.attributes[pair[1]] = decodeEntities(pair[2]);
+			current.children.push(element);
+			if(!match[4])
+				stack.push(element);
+		}
+	}
+
+	if(stack.length != 1 || document.children.length != 1)
+		throw new Error("Malformed document");
+	return document.children[0];
+}
+
+/** Reads a test from a file. Tests list the segments of the initial and the
+ *  expected buffer, as pairs of a user and a text, and their requests with
+ *  complete state vectors.
+ *  @type Object
+ */
+function loadTest(file) {
+	var element = parseXML(fs.readFileSync(file, "utf8"));
+	var test = {name: path.basename(file), initial: [], expected: [], requests: []};
+	var vectors = {};
+
+	function segments(element) {
+		return element.children.filter(function(child) {
+			return child.name == "segment";
+		}).map(function(child) {
+			return [parseInt(child.attributes.author), child.text];
+		});
+	}
+
+	for(var index = 0; index < element.children.length; index++) {
+		var child = element.children[index];
+		if(child.name == "initial-buffer") {
+			test.initial = segments(child);
+		} else if(child.name == "final-buffer") {
+			test.expected = segments(child);
+		} else if(child.name == "request") {
+			// Like in test-helper.js, the time given is relative to the
+			// previous request of the same user.
+			var user = parseInt(child.attributes.user);
+			var vector = (vectors[user] || new Vector()).add(new Vector(child.attributes.time));
+			var operation = child.children[0];
+			var request = {user: user, vector: vector.toString(), kind: operation.name};
+
+			if(operation.name == "insert") {
+				request.position = parseInt(operation.attributes.pos);
+				request.text = operation.text;
+			} else if(operation.name == "delete") {
+				request.position = parseInt(operation.attributes.pos);
+				request.length = parseInt(operation.attributes.len);
+			}
+
+			test.requests.push(request);
+			vectors[user] = vector.incr(user);
+		}
+	}
+
+	return test;
+}
+
+/** Creates the request a test describes. Requests are created anew for every
+ *  run, so that no run sees what an earlier one did to them.
+ *  @type Request
+ */
+function createRequest(request) {
+	var vector = new Vector(request.vector);
+	if(request.kind == "insert") {
+		var text = new Buffer([new Segment(request.user, request.text)]);
+		return new DoRequest(request.user, vector, new Operations.Insert(request.position, text));
+	} else if(request.kind == "delete") {
+		return new DoRequest(request.user, vector, new Operations.Delete(request.position, request.length));
+	} else if(request.kind == "undo") {
+		return new UndoRequest(request.user, vector);
+	} else if(request.kind == "redo") {
+		return new RedoRequest(request.user, vector);
+	}
+	throw new Error("Unknown request " + request.kind);
+}
+
+function createBuffer(segments) {
+	return new Buffer(segments.map(function(segment) {
+		return new Segment(segment[0], segment[1]);
+	}));
+}
+
+/** Returns a buffer's segments as pairs of a user and a text.
+ *  @type Array
+ */
+function bufferSegments(buffer) {
+	return buffer.segments.map(function(segment) {
+		return [segment.user, segment.text];
+	});
+}
+
+/** Compares the segments of two buffers exactly, like test-helper.js does.
+ *  @type Boolean
+ */
+function sameSegments(a, b) {
+	if(a.length != b.length)
+		return false;
+	for(var index = 0; index < a.length; index++) {
+		if(a[index][0] != b[index][0] || a[index][1] != b[index][1])
+			return false;
+	}
+	return true;
+}
+
+var translations = 0;
+var translate = State.prototype.translate;
+State.prototype.translate = function(request, targetVector, noCache) {
+	translations++;
+	return translate.call(this, request, targetVector, noCache);
+};
+
+/** Returns the order in which to execute a test's requests. Without a random
+ *  number generator, this is the order they are listed in. Otherwise, like
+ *  random/test-helper.js does, a user is picked at random until one is found
+ *  whose next request can be executed.
+ *  @type Array
+ */
+function deliveryOrder(test, random) {
+	if(random == undefined)
+		return test.requests;
+
+	var queues = {}, users = new Array();
+	for(var index = 0; index < test.requests.length; index++) {
+		var request = test.requests[index];
+		if(!queues.hasOwnProperty(request.user)) {
+			queues[request.user] = new Array();
+			users.push(request.user);
+		}
+		queues[request.user].push(request);
+	}
+
+	var order = new Array(), heads = {};
+	var vector = new Vector();
+	for(var index = 0; index < users.length; index++)
+		heads[users[index]] = 0;
+
+	while(users.length > 0) {
+		var userIndex = Math.floor(users.length * random());
+		var user = users[userIndex];
+		var request = queues[user][heads[user]];
+		if(!new Vector(request.vector).causallyBefore(vector))
+			continue;
+
+		order.push(request);
+		vector = vector.incr(user);
+		if(++heads[user] == queues[user].length)
+			users.splice(userIndex, 1);
+	}
+
+	return order;
+}
+
+/** Executes a test's requests in the given order, measuring the time taken,
+ *  the calls of State.translate, the translation cache's hits and misses and
+ *  the largest heap used.
+ *  @type Object
+ */
+function execute(test, order) {
+	if(global.gc)
+		global.gc();
+
+	var requests = order.map(createRequest);
+	var state = new State(createBuffer(test.initial));
+	if(options.cacheSize === 0)
+		state.cache = undefined;
+
+	var heap = process.memoryUsage().heapUsed;
+	var result = {translations: 0, hits: 0, misses: 0, peakHeap: heap, error: null};
+	translations = 0;
+	var started = process.hrtime();
+
+	try {
+		for(var index = 0; index < requests.length; index++) {
+			state.execute(requests[index]);
+			if(index % 64 == 63)
+				result.peakHeap = Math.max(result.peakHeap, process.memoryUsage().heapUsed);
+		}
+	} catch(e) {
+		result.error = e.message ? e.message : String(e);
+	}
+
+	var elapsed = process.hrtime(started);
+	result.milliseconds = elapsed[0] * 1e3 + elapsed[1] / 1e6;
+	result.peakHeap = Math.max(result.peakHeap, process.memoryUsage().heapUsed);
+	result.translations = translations;
+	if(state.cache != undefined) {
+		result.hits = state.cache.hits;
+		result.misses = state.cache.misses;
+	}
+	result.segments = bufferSegments(state.buffer);
+	return result;
+}
+
+/** Returns the componentwise minimum of two vectors.
+ *  @type Vector
+ */
+function minimumVector(a, b) {
+	var result = new Vector();
+	a.eachUser(function(u, v) {
+		result.set(u, Math.min(v, b.get(u)));
+	});
+	return result;
+}
+
+/** Executes a test's requests in the given order twice, once pruning the log
+ *  after every request, and compares the buffers after every request. The
+ *  stable vector taken for pruning is the minimum of the current state and
+ *  the requests still to come, and undos still to come keep the requests
+ *  they refer to. Returns the number of requests pruned, and an error if
+ *  the buffers differ.
+ *  @type Object
+ */
+function checkPruning(test, order) {
+	var result = {pruned: 0, error: null};
+	var requests = order.map(createRequest);
+	var state = new State(createBuffer(test.initial));
+	var buffers = new Array(), undone = new Array();
+
+	try {
+		for(var index = 0; index < requests.length; index++) {
+			var request = requests[index];
+			if(request instanceof DoRequest)
+				undone.push(null);
+			else
+				undone.push(request.associatedRequest(state.log).vector.get(request.user));
+			state.execute(request);
+			buffers.push(bufferSegments(state.buffer));
+		}
+	} catch(e) {
+		result.error = e.message ? e.message : String(e);
+		return result;
+	}
+
+	// The minimum vector of the requests after each one, and for each user,
+	// the first request undone or redone after it.
+	var stable = new Array(requests.length), undo = new Array(requests.length);
+	var vector = null, first = {};
+	for(var index = requests.length - 1; index >= 0; index--) {
+		stable[index] = vector;
+		undo[index] = first;
+
+		var request = requests[index];
+		vector = (vector == null) ? request.vector : minimumVector(request.vector, vector);
+		if(undone[index] != null) {
+			first = Object.create(first);
+			first[request.user] = Math.min(undone[index],
+				(request.user in first) ? first[request.user] : Infinity);
+		}
+	}
+
+	requests = order.map(createRequest);
+	state = new State(createBuffer(test.initial));
+
+	try {
+		for(var index = 0; index < requests.length; index++) {
+			state.execute(requests[index]);
+			if(!sameSegments(bufferSegments(state.buffer), buffers[index]))
+				throw new Error("Buffers differ after request " + (index + 1));
+
+			var stableVector = state.vector;
+			if(stable[index] != null)
+				stableVector = minimumVector(stableVector, stable[index]);
+			var undoVector = new Vector();
+			stableVector.eachUser(function(u, v) {
+				undoVector.set(u, (u in undo[index]) ? Math.min(v, undo[index][u]) : v);
+			});
+			result.pruned += state.prune(stableVector, undoVector);
+		}
+	} catch(e) {
+		result.error = e.message ? e.message : String(e);
+	}
+
+	return result;
+}
+
+/** Generates a test in which options.users users issue random
+ *  insertions and deletions, each at a replica of its own. Before
+ *  issuing a request, a user receives all requests issued so far but up to
+ *  options.lag of the latest ones, which its request is concurrent to.
+ *  @type Object
+ */
+function generateTest(name, random) {
+	var initial = [[0, new Array(201).join("-")]];
+	var sites = new Array();
+	for(var user = 1; user <= options.users; user++)
+		sites.push({user: user, state: new State(createBuffer(initial)), received: 0});
+
+	var test = {name: name, initial: initial, expected: null, requests: []};
+
+	while(test.requests.length < options.requests) {
+		var site = sites[Math.floor(sites.length * random())];
+		var state = site.state;
+
+		// Requests are received in the order they were issued, which keeps
+		// them causally ordered. The user's own ones are executed already.
+		var known = test.requests.length - Math.floor((options.lag + 1) * random());
+		for(; site.received < known; site.received++) {
+			var description = test.requests[site.received];
+			if(description.user != site.user)
+				state.execute(createRequest(description));
+		}
+
+		var vector = state.vector.toString();
+		var length = state.buffer.getLength();
+		var description;
+
+		if(random() < 0.7 || length == 0) {
+			var text = "";
+			for(var count = 1 + Math.floor(4 * random()); count > 0; count--)
+				text += String.fromCharCode(97 + Math.floor(26 * random()));
+			description = {user: site.user, vector: vector, kind: "insert",
+				position: Math.floor((length + 1) * random()), text: text};
+		} else {
+			var position = Math.floor(length * random());
+			description = {user: site.user, vector: vector, kind: "delete",
+				position: position, length: Math.min(length - position, 1 + Math.floor(3 * random()))};
+		}
+
+		state.execute(createRequest(description));
+		test.requests.push(description);
+	}
+
+	return test;
+}
+
+/** Counts the pairs of a test's requests that are concurrent, i.e. neither
+ *  was known to the user issuing the other.
+ *  @type Number
+ */
+function concurrentPairs(test) {
+	var vectors = test.requests.map(function(request) {
+		return new Vector(request.vector).incr(request.user);
+	});
+	var pairs = 0;
+	for(var i = 0; i < vectors.length; i++) {
+		for(var j = i + 1; j < vectors.length; j++) {
+			if(!vectors[i].causallyBefore(vectors[j]) && !vectors[j].causallyBefore(vectors[i]))
+				pairs++;
+		}
+	}
+	return pairs;
+}
+
+/** Runs a test in its own order and the configured number of random orders.
+ *  A run fails if it raises an error or ends with another buffer than the
+ *  expected one, or for tests without one, than the first run.
+ *  @type Array
+ */
+function runTest(test, random) {
+	var runs = new Array();
+	var expected = (test.expected == null) ? null : bufferSegments(createBuffer(test.expected));
+
+	for(var round = 0; round <= options.rounds; round++) {
+		var order = deliveryOrder(test, round == 0 ? undefined : random);
+		var run = execute(test, order);
+		run.test = test.name;
+		run.order = (round == 0) ? "fixed" : "random";
+		if(expected == null && run.error == null)
+			expected = run.segments;
+		run.passed = run.error == null && sameSegments(run.segments, expected);
+		delete run.segments;
+
+		if(options.prune) {
+			var pruning = checkPruning(test, order);
+			run.pruned = pruning.pruned;
+			if(pruning.error != null) {
+				run.passed = false;
+				run.error = "with pruning: " + pruning.error;
+			}
+		}
+		runs.push(run);
+
+		if(options.verbose)
+			console.log(formatRun(run.test + " " + run.order, [run]));
+	}
+
+	return runs;
+}
+
+function megabytes(bytes) {
+	return (bytes / 1048576).toFixed(1) + " MB";
+}
+
+/** Summarizes the given runs in a line. */
+function formatRun(label, runs) {
+	var passed = 0, milliseconds = 0, translations = 0, hits = 0, misses = 0, peakHeap = 0, pruned = 0;
+	for(var index = 0; index < runs.length; index++) {
+		var run = runs[index];
+		if(run.passed)
+			passed++;
+		if(run.pruned)
+			pruned += run.pruned;
+		milliseconds += run.milliseconds;
+		translations += run.translations;
+		hits += run.hits;
+		misses += run.misses;
+		peakHeap = Math.max(peakHeap, run.peakHeap);
+	}
+
+	var hitRate = (hits + misses > 0) ? (100 * hits / (hits + misses)).toFixed(1) + "%" : "-";
+	return label + ": " + passed + "/" + runs.length + " passed, " +
+		milliseconds.toFixed(1) + " ms, " + translations + " translations, " +
+		"cache hit rate " + hitRate + ", peak heap " + megabytes(peakHeap) +
+		(options.prune ? ", " + pruned + " requests pruned" : "");
+}
+
+function main() {
+	var sources = parseArguments(process.argv.slice(2));
+	if(options.cacheSize !== null && options.cacheSize > 0)
+		State.cacheSize = options.cacheSize;
+
+	var random = randomGenerator(options.seed);
+	var results = {options: options, runs: [], synthetic: []};
+	var failures = new Array();
+
+	var runs = new Array();
+	for(var index = 0; index < sources.length; index++) {
+		var test = loadTest(sources[index]);
+		runs = runs.concat(runTest(test, random));
+	}
+
+	if(runs.length > 0) {
+		console.log(formatRun("Tests, fixed order", runs.filter(function(run) {
+			return run.order == "fixed";
+		})));
+		if(options.rounds > 0) {
+			console.log(formatRun("Tests, random orders", runs.filter(function(run) {
+				return run.order == "random";
+			})));
+		}
+	}
+
+	for(var index = 0; index < options.synthetic; index++) {
+		var name = "synthetic-" + (index + 1);
+		try {
+			// Each test is generated from a seed of its own, so that it can be
+			// generated again regardless of the other tests run.
+			var test = generateTest(name, randomGenerator(options.seed + index));
+		} catch(e) {
+			// The users' replicas could not execute the requests either.
+			runs.push({test: name, order: null, passed: false,
+				error: e.message ? e.message : String(e)});
+			continue;
+		}
+		var testRuns = runTest(test, random);
+		var pairs = concurrentPairs(test);
+		console.log(formatRun(name + " (" + options.users + " users, " +
+			test.requests.length + " requests, " + pairs + " concurrent pairs)", testRuns));
+		results.synthetic.push({test: name, requests: test.requests.length, concurrentPairs: pairs});
+		runs = runs.concat(testRuns);
+	}
+
+	for(var index = 0; index < runs.length; index++) {
+		if(!runs[index].passed)
+			failures.push(runs[index]);
+	}
+	for(var index = 0; index < failures.length; index++) {
+		var run = failures[index];
+		console.log("FAILED " + run.test + (run.order ? " (" + run.order + " order)" : "") +
+			(run.error ? ": " + run.error : ""));
+	}
+
+	var usage = process.resourceUsage();
+	console.log("Largest resident set: " + megabytes(usage.maxRSS * 1024));
+
+	if(options.json != null) {
+		results.runs = runs;
+		results.maxRSS = usage.maxRSS * 1024;
+		fs.writeFileSync(options.json, JSON.stringify(results, null, "\t") + "\n");
+	}
+
+	process.exit(failures.length > 0 ? 1 : 0);
+}
+
+main();
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+"""
+Runs the tests in sources/ against the Python port of the algorithm in
+demo/algorithm.py, the counterpart of run.js for the JavaScript one:
+
+	python run.py [--prune] [sources/test-01.xml ...]
+
+Each test is executed in the order of its requests, and its final buffer is
+compared with the expected one. With --prune, each test is executed once more
+while pruning the log after every request, as the server does, and the buffer
+is compared after every request. The stable vector taken for pruning is the
+minimum of the current state and the requests still to come, and undos and
+redos still to come keep the requests they refer to.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import xml.etree.ElementTree as ElementTree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "demo"))
+
+from algorithm import Buffer, Delete, DoRequest, Insert, RedoRequest, \
+	Segment, State, UndoRequest, Vector
+
+def loadTest(path):
+	"""Reads a test from a file. Returns the segments of its initial and
+	expected buffer, as pairs of a user and a text, and its requests with
+	complete state vectors."""
+	root = ElementTree.parse(path).getroot()
+
+	def segments(element):
+		return [(int(segment.get("author")), segment.text or "")
+			for segment in element.findall("segment")]
+
+	initial = segments(root.find("initial-buffer"))
+	expected = segments(root.find("final-buffer"))
+
+	requests = []
+	vectors = {}
+	for element in root.findall("request"):
+		# Like in test-helper.js, the time given is relative to the previous
+		# request of the same user.
+		user = int(element.get("user"))
+		vector = vectors.get(user, Vector()).add(Vector(element.get("time")))
+		operation = element[0]
+		requests.append((user, vector.toString(), operation.tag, dict(operation.attrib), operation.text or ""))
+		vectors[user] = vector.incr(user)
+
+	return initial, expected, requests
+
+def createRequest(description):
+	"""Creates the request a test describes. Requests are created anew for
+	every run, so that no run sees what an earlier one did to them."""
+	user, vector, kind, attributes, text = description
+	vector = Vector(vector)
+	if kind == "insert":
+		return DoRequest(user, vector, Insert(int(attributes["pos"]), Buffer([Segment(user, text)])))
+	elif kind == "delete":
+		return DoRequest(user, vector, Delete(int(attributes["pos"]), int(attributes["len"])))
+	elif kind == "undo":
+		return UndoRequest(user, vector)
+	elif kind == "redo":
+		return RedoRequest(user, vector)
+	raise ValueError("Unknown request %s" % kind)
+
+def createBuffer(segments):
+	return Buffer([Segment(user, text) for user, text in segments])
+
+def bufferSegments(buffer):
+	"""Returns a buffer's segments as pairs of a user and a text, to be
+	compared exactly, like test-helper.js does."""
+	return [(segment.user, segment.text) for segment in buffer.segments]
+
+def execute(initial, requests):
+	"""Executes the given requests in order. Returns the final buffer's
+	segments."""
+	state = State(createBuffer(initial))
+	for description in requests:
+		state.execute(createRequest(description))
+	return bufferSegments(state.buffer)
+
+def checkPruning(initial, requests):
+	"""Executes the given requests in order twice, once pruning the log after
+	every request, and compares the buffers after every request. Returns the
+	number of requests pruned."""
+	state = State(createBuffer(initial))
+	buffers = []
+	undone = []
+	for description in requests:
+		request = createRequest(description)
+		if isinstance(request, DoRequest):
+			undone.append(None)
+		else:
+			undone.append(request.associatedRequest(state.log).vector.get(request.user))
+		state.execute(request)
+		buffers.append(bufferSegments(state.buffer))
+
+	# The minimum vector of the requests after each one, and for each user,
+	# the first request undone or redone after it.
+	stable = [None] * len(requests)
+	undo = [None] * len(requests)
+	vector = None
+	first = {}
+	for index in range(len(requests) - 1, -1, -1):
+		stable[index] = vector
+		undo[index] = first
+
+		user = requests[index][0]
+		requestVector = Vector(requests[index][1])
+		vector = requestVector if vector is None else Vector.minimum([requestVector, vector])
+		if undone[index] is not None:
+			first = dict(first)
+			first[user] = min(undone[index], first.get(user, undone[index]))
+
+	state = State(createBuffer(initial))
+	pruned = 0
+	for index, description in enumerate(requests):
+		state.execute(createRequest(description))
+		if bufferSegments(state.buffer) != buffers[index]:
+			raise AssertionError("Buffers differ after request %d" % (index + 1))
+
+		stableVector = state.vector
+		if stable[index] is not None:
+			stableVector = Vector.minimum([stableVector, stable[index]])
+		undoVector = {}
+		for user in stableVector.users():
+			undoVector[user] = min(stableVector.get(user), undo[index].get(user, stableVector.get(user)))
+		pruned += state.prune(stableVector, Vector(undoVector))
+
+	return pruned
+
+def main(args):
+	prune = "--prune" in args
+	sources = [arg for arg in args if arg != "--prune"]
+	if any(arg.startswith("-") for arg in sources):
+		print(__doc__.strip(), file=sys.stderr)
+		return 2
+
+	if not sources:
+		directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sources")
+		sources = [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+			if name.endswith(".xml")]
+
+	passed = 0
+	pruned = 0
+	failures = []
+	for path in sources:
+		name = os.path.basename(path)
+		initial, expected, requests = loadTest(path)
+		try:
+			if execute(initial, requests) != bufferSegments(createBuffer(expected)):
+				raise AssertionError("Unexpected final buffer")
+			if prune:
+				pruned += checkPruning(initial, requests)
+		except Exception as e:
+			failures.append("%s: %s" % (name, e))
+			continue
+		passed += 1
+
+	print("%d/%d passed%s" % (passed, len(sources),
+		", %d requests pruned" % pruned if prune else ""))
+	for failure in failures:
+		print("FAILED", failure)
+
+	return 1 if failures else 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]))